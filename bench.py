@@ -0,0 +1,286 @@
+"""Нагрузочный тест экономических команд без Discord.
+
+Команды когов вызываются напрямую с поддельными Context/Member/Guild против
+локальной PostgreSQL. Пример:
+
+    BENCH_DATABASE_URL=postgresql://localhost/bench python bench.py --users 200 --duration 30
+
+Бенчмарк создаёт своих пользователей в отдельной гильдии и удаляет их
+в конце, но всё равно используйте отдельную базу, а не боевую.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+# main.py читает переменные окружения при импорте
+if os.getenv("BENCH_DATABASE_URL"):
+    os.environ["DATABASE_URL"] = os.environ["BENCH_DATABASE_URL"]
+
+import main  # noqa: E402
+from cogs.economy import Economy  # noqa: E402
+from cogs.fun import Fun  # noqa: E402
+
+BENCH_USER_BASE = 9_000_000_000_000_000
+BENCH_GUILD_ID = 9_000_000_000_000_000
+SCENARIO = {"баланс": 4, "фарм": 2, "перевести": 2, "рулетка": 3, "топ": 1}
+
+
+# ==================== ПОДДЕЛЬНЫЕ ОБЪЕКТЫ DISCORD ====================
+class FakeRole:
+    def __init__(self, role_id, name):
+        self.id = role_id
+        self.name = name
+        self.mention = f"<@&{role_id}>"
+
+
+class FakeAsset:
+    url = "https://cdn.discordapp.com/embed/avatars/0.png"
+
+
+class FakeMember:
+    def __init__(self, user_id, guild, roles):
+        self.id = user_id
+        self.name = f"bench{user_id - BENCH_USER_BASE}"
+        self.mention = f"<@{user_id}>"
+        self.guild = guild
+        self.roles = list(roles)
+        self.color = main.discord.Color.default()
+        self.avatar = None
+        self.default_avatar = FakeAsset()
+        self.bot = False
+
+    def get_role(self, role_id):
+        return next((role for role in self.roles if role.id == role_id), None)
+
+    async def add_roles(self, *roles, reason=None):
+        self.roles.extend(role for role in roles if role not in self.roles)
+
+    async def remove_roles(self, *roles, reason=None):
+        self.roles = [role for role in self.roles if role not in roles]
+
+
+class FakeGuild:
+    def __init__(self, guild_id, users):
+        self.id = guild_id
+        self.name = "bench"
+        self.patriot = FakeRole(guild_id + 1, main.ROLE_NAME)
+        self.roles = [FakeRole(guild_id, "@everyone"), self.patriot]
+        self._roles = {role.id: role for role in self.roles}
+        self.members = {}
+        for i in range(users):
+            member = FakeMember(BENCH_USER_BASE + i, self, [self.patriot])
+            self.members[member.id] = member
+        self.member_ids = list(self.members)
+
+    def get_role(self, role_id):
+        return self._roles.get(role_id)
+
+    def get_member(self, user_id):
+        return self.members.get(user_id)
+
+
+class FakeChannel:
+    def __init__(self):
+        self.id = 1
+        self.sent = 0
+
+    async def send(self, content=None, **kwargs):
+        self.sent += 1
+
+
+class FakeContext:
+    def __init__(self, author, guild, channel):
+        self.author = author
+        self.guild = guild
+        self.channel = channel
+        self.command = None
+        self.message = None
+        self.replies = []
+
+    async def send(self, content=None, **kwargs):
+        self.replies.append(content)
+        await self.channel.send(content, **kwargs)
+
+
+# ==================== ПРОГОН ====================
+async def seed(users, balance):
+    ids = [BENCH_USER_BASE + i for i in range(users)]
+    async with main.bot.db.acquire() as conn:
+        await conn.execute("""
+            INSERT INTO users (guild_id, user_id, balance)
+            SELECT $1, unnest($2::bigint[]), $3
+            ON CONFLICT (guild_id, user_id) DO UPDATE SET balance = EXCLUDED.balance
+        """, BENCH_GUILD_ID, ids, balance)
+
+
+async def cleanup():
+    # Экономика бенчмарка живёт в своей гильдии
+    async with main.bot.db.acquire() as conn:
+        await conn.execute("DELETE FROM users WHERE guild_id = $1", BENCH_GUILD_ID)
+        await conn.execute("DELETE FROM ledger WHERE guild_id = $1", BENCH_GUILD_ID)
+
+
+def command_call(name, cogs, guild, member):
+    # Возвращает (callback, аргументы) для команды по её имени
+    economy, fun = cogs
+    if name == "баланс":
+        return Economy.balance.callback, (economy,)
+    if name == "фарм":
+        return Economy.farm.callback, (economy,)
+    if name == "топ":
+        return Economy.top.callback, (economy,)
+    if name == "перевести":
+        target_id = random.choice(guild.member_ids)
+        if target_id == member.id:
+            target_id = guild.member_ids[(guild.member_ids.index(target_id) + 1) % len(guild.member_ids)]
+        target = guild.get_member(target_id)
+        return Economy.transfer.callback, (economy, target, 1)
+    if name == "рулетка":
+        return Fun.roulette.callback, (fun, 1)
+    raise ValueError(f"Неизвестная команда: {name}")
+
+
+async def simulated_user(member, guild, channel, cogs, deadline, samples, errors):
+    names = list(SCENARIO)
+    weights = list(SCENARIO.values())
+    while time.perf_counter() < deadline:
+        name = random.choices(names, weights)[0]
+        callback, args = command_call(name, cogs, guild, member)
+        ctx = FakeContext(member, guild, channel)
+        # Как before_invoke: запросы к БД засчитываются этой команде
+        main.current_command.set(name)
+        started = time.perf_counter()
+        try:
+            await callback(args[0], ctx, *args[1:])
+        except Exception as e:
+            errors[name] = errors.get(name, 0) + 1
+            if errors[name] == 1:
+                print(f"⚠ Ошибка в !{name}: {e!r}")
+        samples.setdefault(name, []).append((time.perf_counter() - started) * 1000)
+        main.current_command.set(None)
+
+
+def percentile(values, q):
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+def build_report(samples, errors, elapsed):
+    report = {"elapsed_s": round(elapsed, 2), "commands": {}}
+    total = 0
+    for name, values in sorted(samples.items()):
+        stats = main.bot.stats.commands.get(name)
+        queries = stats.queries if stats else 0
+        total += len(values)
+        report["commands"][name] = {
+            "count": len(values),
+            "per_second": round(len(values) / elapsed, 1),
+            "p50_ms": round(percentile(values, 50), 2),
+            "p99_ms": round(percentile(values, 99), 2),
+            "db_round_trips": round(queries / len(values), 2),
+            "errors": errors.get(name, 0),
+        }
+    report["total_per_second"] = round(total / elapsed, 1)
+    return report
+
+
+def print_report(report):
+    print(f"\n{'команда':<12}{'кол-во':>9}{'ком/с':>10}{'p50 мс':>10}{'p99 мс':>10}{'БД/ком':>9}{'ошибок':>8}")
+    for name, item in report["commands"].items():
+        print(f"!{name:<11}{item['count']:>9}{item['per_second']:>10}{item['p50_ms']:>10}"
+              f"{item['p99_ms']:>10}{item['db_round_trips']:>9}{item['errors']:>8}")
+    print(f"\nВсего: {report['total_per_second']} команд/с за {report['elapsed_s']} с")
+
+
+def compare(report, baseline, tolerance):
+    # Регрессия — падение пропускной способности или рост p99 больше допуска
+    problems = []
+    if report["total_per_second"] < baseline["total_per_second"] * (1 - tolerance):
+        problems.append(f"пропускная способность {report['total_per_second']} < {baseline['total_per_second']}")
+    for name, item in report["commands"].items():
+        old = baseline["commands"].get(name)
+        if old is None:
+            continue
+        if item["p99_ms"] > old["p99_ms"] * (1 + tolerance):
+            problems.append(f"!{name}: p99 {item['p99_ms']} мс > {old['p99_ms']} мс")
+        if item["db_round_trips"] > old["db_round_trips"]:
+            problems.append(f"!{name}: запросов к БД {item['db_round_trips']} > {old['db_round_trips']}")
+    return problems
+
+
+async def run(args):
+    main.bot.db = await main.create_db_pool()
+    if main.BALANCE_CACHE:
+        main.bot.balance_cache = main.BalanceCache(main.bot)
+        main.bot.balance_cache.start()
+    main.bot.ledger.start()
+
+    guild = FakeGuild(BENCH_GUILD_ID, args.users)
+    channel = FakeChannel()
+    cogs = (Economy(main.bot), Fun(main.bot))
+    samples, errors = {}, {}
+
+    await seed(args.users, args.balance)
+    try:
+        print(f"🚀 {args.users} пользователей, {args.duration} с, пул до {main.DB_POOL_MAX_SIZE} соединений"
+              f"{', кэш балансов включён' if main.BALANCE_CACHE else ''}")
+        started = time.perf_counter()
+        deadline = started + args.duration
+        await asyncio.gather(*(
+            simulated_user(member, guild, channel, cogs, deadline, samples, errors)
+            for member in guild.members.values()
+        ))
+        elapsed = time.perf_counter() - started
+        await main.bot.outbox.close()
+        if main.bot.balance_cache:
+            await main.bot.balance_cache.close()
+            main.bot.balance_cache = None
+        await main.bot.ledger.close()
+    finally:
+        if not args.keep:
+            await cleanup()
+        await main.bot.db.close()
+    return build_report(samples, errors, elapsed)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест экономических команд")
+    parser.add_argument("--users", type=int, default=100, help="одновременных пользователей")
+    parser.add_argument("--duration", type=float, default=20, help="длительность, с")
+    parser.add_argument("--balance", type=int, default=100_000, help="стартовый баланс пользователей")
+    parser.add_argument("--seed", type=int, help="seed генератора случайных чисел")
+    parser.add_argument("--json", help="сохранить отчёт в файл")
+    parser.add_argument("--compare", help="сравнить с сохранённым отчётом")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="допустимое ухудшение, доля")
+    parser.add_argument("--keep", action="store_true", help="не удалять тестовых пользователей")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.users < 2:
+        sys.exit("❌ Нужно минимум 2 пользователя (для переводов)")
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    report = asyncio.run(run(args))
+    print_report(report)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            problems = compare(report, json.load(f), args.tolerance)
+        if problems:
+            print("\n❌ Регрессия производительности:")
+            for problem in problems:
+                print(f"  {problem}")
+            sys.exit(1)
+        print("\n✅ Регрессий нет")
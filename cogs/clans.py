@@ -0,0 +1,90 @@
+import discord
+from discord.ext import commands
+
+from main import CLAN_CREATION_PRICE, CLAN_SORTS, bot, create_clan_for, get_clan_info, join_clan, leave_clan
+
+
+class Clans(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+
+    @commands.command(name="создатьклан")
+    async def create_clan(self, ctx, clan_name: str):
+        user = ctx.author
+        error, _ = await create_clan_for(ctx.guild.id, user.id, clan_name, CLAN_CREATION_PRICE)
+
+        if error == "in_clan":
+            await ctx.send("❌ Вы уже состоите в клане!")
+            return
+        if error == "clan_exists":
+            await ctx.send("❌ Клан с таким именем уже существует!")
+            return
+        if error == "no_funds":
+            await ctx.send(f"❌ Нужно {CLAN_CREATION_PRICE} кредитов для создания клана!")
+            return
+
+        await ctx.send(f"✅ Клан '{clan_name}' создан! Вы стали лидером.")
+
+    @commands.command(name="войтивклан")
+    async def join(self, ctx, clan_name: str):
+        error = await join_clan(ctx.guild.id, ctx.author.id, clan_name)
+
+        if error == "in_clan":
+            await ctx.send("❌ Вы уже состоите в клане!")
+            return
+        if error == "no_clan":
+            await ctx.send("❌ Такого клана не существует!")
+            return
+
+        await ctx.send(f"✅ Вы вступили в клан '{clan_name}'!")
+
+    @commands.command(name="покинутьклан")
+    async def leave(self, ctx):
+        error, clan_name, dissolved = await leave_clan(ctx.guild.id, ctx.author.id)
+
+        if error == "not_in_clan":
+            await ctx.send("❌ Вы не состоите в клане!")
+            return
+        if error == "owner":
+            await ctx.send(f"❌ Лидер не может покинуть клан '{clan_name}', пока в нём есть другие участники!")
+            return
+
+        if dissolved:
+            await ctx.send(f"✅ Вы покинули клан '{clan_name}'. Клан распущен.")
+        else:
+            await ctx.send(f"✅ Вы покинули клан '{clan_name}'.")
+
+    @commands.command(name="клан")
+    async def clan_info(self, ctx, *, clan_name: str = None):
+        clan = await get_clan_info(ctx.guild.id, clan_name, ctx.author.id)
+        if clan is None:
+            await ctx.send("❌ Такого клана не существует!" if clan_name else "❌ Вы не состоите в клане!")
+            return
+
+        embed = discord.Embed(title=f"👥 Клан {clan['name']}", color=discord.Color.gold())
+        embed.add_field(name="👑 Лидер", value=f"<@{clan['owner_id']}>", inline=True)
+        embed.add_field(name="👥 Участников", value=str(clan["member_count"]), inline=True)
+        embed.add_field(name="💰 Казна", value=f"{clan['balance']} кредитов", inline=True)
+        embed.add_field(name="💎 Богатство участников", value=f"{clan['member_balance']} кредитов", inline=True)
+        await ctx.send(embed=embed)
+
+    @commands.command(name="клантоп")
+    async def clan_top(self, ctx, sort: str = "казна"):
+        if sort not in CLAN_SORTS:
+            await ctx.send(f"❌ Сортировка: {', '.join(CLAN_SORTS)}")
+            return
+        label = CLAN_SORTS[sort][1]
+
+        async def build(rows, start):
+            if not rows:
+                return "😔 Кланов пока нет."
+            leaderboard = []
+            for i, (name, value) in enumerate(rows, start=1):
+                leaderboard.append(f"{i}. {name} — {value} {label}")
+            return f"🏆 **Топ кланов ({sort}):**\n" + "\n".join(leaderboard)
+
+        await ctx.send(await bot.top_clans[sort].get(ctx.guild.id).render(build))
+
+
+async def setup(bot):
+    await bot.add_cog(Clans(bot))
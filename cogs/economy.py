@@ -0,0 +1,291 @@
+import random
+from typing import Union
+
+import discord
+from discord.ext import commands
+
+from main import (
+    CRIT_CHANCE, CUSTOM_ROLE_PRICE, CachedMember, HistoryView, SUCCESS_CHANCE, admin_only, bot,
+    bulk_change_balance, create_custom_role, get_balance, reply, role_members, shared_cooldown,
+    take_balance, transfer_balance, update_balance, withdraw_balance,
+)
+
+
+class Economy(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+
+    @commands.command(name="славанн")
+    @shared_cooldown(1, 7200)
+    async def slav_party(self, ctx):
+        user = ctx.author
+        role = bot.role_cache.patriot_role(ctx.guild)
+
+        if not role:
+            await ctx.send('❌ Роль не найдена!')
+            return
+
+        if user.get_role(role.id):
+            await ctx.send(f'🟥 {user.mention}, ты уже Патриот!')
+            return
+
+        roll = random.randint(1, 100)
+
+        if roll <= CRIT_CHANCE:
+            await user.add_roles(role)
+            balance = await update_balance(ctx.guild.id, user.id, 1000, "patriot")
+            reply(ctx, f'💥 **КРИТ!** {user.mention}, ты получил роль + 1000 социального рейтинга! (Баланс: {balance})')
+
+        elif roll <= SUCCESS_CHANCE:
+            await user.add_roles(role)
+            balance = await update_balance(ctx.guild.id, user.id, 100, "patriot")
+            reply(ctx, f'🟥 {user.mention}, ты получил роль + 100 рейтинга! (Баланс: {balance})')
+
+        else:
+            penalty, balance = await take_balance(ctx.guild.id, user.id, 10, "patriot")
+            reply(ctx, f'🕊 {user.mention}, -{penalty} рейтинга. Попробуй ещё! (Баланс: {balance})')
+
+    @commands.command(name="фарм")
+    @shared_cooldown(1, 1200)
+    async def farm(self, ctx):
+        user = ctx.author
+        role = bot.role_cache.patriot_role(ctx.guild)
+
+        if not role or not user.get_role(role.id):
+            await ctx.send("⛔ Эта команда доступна только для Патриотов.")
+            return
+
+        reward = random.randint(30, 70)
+        balance = await update_balance(ctx.guild.id, user.id, reward, "farm")
+        reply(ctx, f"🌾 {user.mention}, вы заработали {reward} соц. кредитов! (Баланс: {balance})")
+
+    @commands.command(name="баланс")
+    @shared_cooldown(1, 5)
+    async def balance(self, ctx):
+        bal = await get_balance(ctx.guild.id, ctx.author.id)
+        reply(ctx, f'💰 {ctx.author.mention}, ваш баланс: {bal}')
+
+    @commands.command(name="перевести")
+    async def transfer(self, ctx, member: CachedMember, amount: int):
+        if amount <= 0:
+            await ctx.send("❌ Сумма должна быть положительной!")
+            return
+        if member == ctx.author:
+            await ctx.send("❌ Нельзя переводить самому себе!")
+            return
+
+        if await transfer_balance(ctx.guild.id, ctx.author.id, member.id, amount) is None:
+            await ctx.send("❌ Недостаточно средств!")
+            return
+
+        reply(ctx, f'✅ {ctx.author.mention} перевел {amount} рейтинга {member.mention}!')
+
+    @commands.command(name="топ")
+    @shared_cooldown(1, 5)
+    async def top(self, ctx, page: int = 1):
+        if page < 1:
+            await ctx.send("❌ Номер страницы должен быть положительным!")
+            return
+
+        async def build(rows, start):
+            if not rows:
+                return "😔 Таблица пуста." if page == 1 else "😔 Такой страницы нет."
+            names = await bot.names.resolve([user_id for user_id, _ in rows], ctx.guild)
+            leaderboard = []
+            for i, (user_id, balance) in enumerate(rows, start=start + 1):
+                name = names.get(user_id) or "[Неизвестный пользователь]"
+                leaderboard.append(f"{i}. {name} — {balance} кредитов")
+            title = "🏆 **Топ 10 Патриотов:**" if page == 1 else f"🏆 **Топ Патриотов — страница {page}:**"
+            return title + "\n" + "\n".join(leaderboard)
+
+        await ctx.send(await bot.top_users.get(ctx.guild.id).render(build, page))
+
+    @commands.command(name="ранг")
+    @shared_cooldown(1, 5)
+    async def rank(self, ctx, member: CachedMember = None):
+        member = member or ctx.author
+        balance = await get_balance(ctx.guild.id, member.id)
+        position = await bot.top_users.get(ctx.guild.id).rank(member.id, balance)
+        reply(ctx, f"📊 {member.mention} на {position} месте с балансом {balance} кредитов")
+
+    @commands.command(name="допкредит")
+    @admin_only()
+    async def add_credits(self, ctx, member: CachedMember, amount: int):
+        if amount <= 0:
+            await ctx.send("❌ Сумма должна быть положительной!")
+            return
+        
+        new_balance = await update_balance(ctx.guild.id, member.id, amount, "admin", ctx.author.id)
+        await ctx.send(f"✅ Администратор {ctx.author.mention} добавил {amount} кредитов пользователю {member.mention}\n💰 Новый баланс: {new_balance} кредитов")
+
+    @commands.command(name="минускредит")
+    @admin_only()
+    async def remove_credits(self, ctx, member: CachedMember, amount: int):
+        if amount <= 0:
+            await ctx.send("❌ Сумма должна быть положительной!")
+            return
+        
+        success, new_balance = await withdraw_balance(ctx.guild.id, member.id, amount, "admin", ctx.author.id)
+        if not success:
+            await ctx.send(f"❌ У пользователя только {new_balance} кредитов, нельзя снять {amount}!")
+            return
+        
+        await ctx.send(f"✅ Администратор {ctx.author.mention} снял {amount} кредитов у пользователя {member.mention}\n💰 Новый баланс: {new_balance} кредитов")
+
+    @commands.command(name="массдопкредит")
+    @admin_only()
+    async def bulk_add_credits(self, ctx, amount: int,
+                               targets: commands.Greedy[Union[discord.Role, CachedMember]], mode: str = None):
+        if amount <= 0:
+            await ctx.send("❌ Сумма должна быть положительной!")
+            return
+        await self._bulk_credits(ctx, amount, targets, mode)
+
+    @commands.command(name="массминускредит")
+    @admin_only()
+    async def bulk_remove_credits(self, ctx, amount: int,
+                                  targets: commands.Greedy[Union[discord.Role, CachedMember]], mode: str = None):
+        if amount <= 0:
+            await ctx.send("❌ Сумма должна быть положительной!")
+            return
+        await self._bulk_credits(ctx, -amount, targets, mode)
+
+    async def _bulk_credits(self, ctx, amount: int, targets, mode):
+        # amount со знаком: положительный — начисление, отрицательный — списание
+        if mode is not None and mode != "проверка":
+            await ctx.send(f"❌ Не удалось распознать роль или участника: {mode}")
+            return
+
+        user_ids = []
+        for target in targets:
+            if isinstance(target, discord.Role):
+                user_ids.extend(member.id for member in await role_members(target) if not member.bot)
+            elif not target.bot:
+                user_ids.append(target.id)
+        if not user_ids:
+            await ctx.send("❌ Укажите роли или участников!")
+            return
+
+        dry_run = mode == "проверка"
+        affected, skipped = await bulk_change_balance(ctx.guild.id, user_ids, amount, "admin", ctx.author.id, dry_run)
+        action = "начислено" if amount > 0 else "списано"
+        summary = f"{abs(amount)} кредитов × {affected} участников = {abs(amount) * affected} кредитов"
+        if skipped:
+            summary += f"\n⚠ Пропущено {skipped}: не хватает кредитов"
+        if dry_run:
+            await ctx.send(f"🔍 Проверка: будет {action} {summary}\nНичего не изменено.")
+        else:
+            await ctx.send(f"✅ Администратор {ctx.author.mention}: {action} {summary}")
+
+    @commands.command(name="история")
+    @shared_cooldown(1, 5)
+    async def history(self, ctx, member: CachedMember = None):
+        if not member:
+            member = ctx.author
+        if member != ctx.author and not bot.role_cache.is_admin(ctx.author):
+            await ctx.send("❌ Чужую историю могут смотреть только администраторы!")
+            return
+
+        # Последние операции могут быть ещё в буфере журнала; пустой буфер сбрасывается сразу
+        try:
+            await bot.ledger.flush()
+        except Exception as e:
+            print(f"⚠ Ошибка записи журнала операций: {e}")
+
+        view = HistoryView(ctx.author.id, member)
+        await view.load()
+        view.message = await ctx.send(embed=view.embed(), view=view)
+
+    @commands.command(name="магазин")
+    async def shop(self, ctx):
+        shop_text = f"""
+🛍 **Магазин социального кредита:**
+
+🎨 `!купитьроль "Название" #Цвет` - Купить кастомную роль ({CUSTOM_ROLE_PRICE} кредитов)
+Пример: `!купитьроль "Богач" #ff0000`
+
+💰 Ваш баланс: {await get_balance(ctx.guild.id, ctx.author.id)} кредитов
+"""
+        await ctx.send(shop_text)
+
+    @commands.command(name="купитьроль")
+    async def buy_role(self, ctx, role_name: str, role_color: str):
+        user = ctx.author
+
+        try:
+            color = discord.Color.from_str(role_color)
+        except ValueError:
+            await ctx.send("❌ Неверный формат цвета! Используйте HEX формат, например: `#ff0000`")
+            return
+
+        # Сначала списываем: параллельные покупки не уведут баланс в минус
+        success, balance = await withdraw_balance(ctx.guild.id, user.id, CUSTOM_ROLE_PRICE, "buy_role")
+        if not success:
+            await ctx.send(f"❌ Недостаточно средств! Нужно {CUSTOM_ROLE_PRICE} кредитов, у вас {balance}.")
+            return
+        
+        try:
+            new_role = await ctx.guild.create_role(
+                name=role_name,
+                color=color,
+                reason=f"Кастомная роль для {user.name}"
+            )
+            
+            await user.add_roles(new_role)
+            old_role_id = await create_custom_role(ctx.guild.id, user.id, new_role.id, role_name, role_color)
+        except Exception as e:
+            print(f"Ошибка при создании роли: {e}")
+            await update_balance(ctx.guild.id, user.id, CUSTOM_ROLE_PRICE, "refund")
+            await ctx.send("❌ Произошла ошибка при создании роли. Попробуйте позже.")
+            return
+
+        if old_role_id and old_role_id != new_role.id:
+            old_role = ctx.guild.get_role(old_role_id)
+            if old_role:
+                try:
+                    await old_role.delete()
+                except discord.HTTPException:
+                    pass
+
+        await ctx.send(f"✅ {user.mention}, вы успешно купили роль {new_role.mention} за {CUSTOM_ROLE_PRICE} кредитов!")
+
+    # КОМАНДА ПОМОЩЬ - ИСПРАВЛЕННАЯ
+    @commands.command(name="помощь")
+    async def help_command(self, ctx):
+        try:
+            help_text = """
+📜 Команды бота:
+
+🔴 !славанн — попытка стать Патриотом (2ч кд)
+🌾 !фарм — заработать кредиты (20м кд, только для Патриотов)  
+💰 !баланс — показать баланс (5с кд)
+💸 !перевести @юзер сумма — перевод кредитов
+🏆 !топ [страница] — топ по балансу (5с кд)
+📊 !ранг [@юзер] — место в топе (5с кд)
+🎰 !рулетка ставка — игра в рулетку (30с кд)
+🛍 !магазин — просмотреть магазин
+🎨 !купитьроль "Название" #Цвет — купить кастомную роль (2000 кредитов)
+➕ !допкредит @юзер сумма — добавить кредиты (админы)
+➖ !минускредит @юзер сумма — снять кредиты (админы)  
+📜 !история [@юзер] — история операций с балансом
+➕ !массдопкредит сумма @роль/@юзеры [проверка] — начислить всем сразу (админы)
+➖ !массминускредит сумма @роль/@юзеры [проверка] — снять у всех сразу (админы)
+👥 !создатьклан название — создать клан
+👥 !войтивклан название — вступить в клан
+👥 !покинутьклан — покинуть клан
+👥 !клан [название] — информация о клане
+🏆 !клантоп [казна|участники|богатство] — топ кланов
+👤 !профиль @юзер — посмотреть профиль
+📝 !описание_профиль текст — изменить описание профиля
+🎁 !ежедневный — ежедневная награда (24ч кд)
+ℹ️ !помощь — это сообщение
+"""
+            await ctx.send(help_text)
+        except Exception as e:
+            print(f"Ошибка в команде помощь: {e}")
+            await ctx.send("Произошла ошибка при выполнении команды")
+            
+
+
+async def setup(bot):
+    await bot.add_cog(Economy(bot))
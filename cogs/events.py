@@ -0,0 +1,68 @@
+from discord.ext import commands
+
+from main import NotAdmin, bot, reply
+
+
+class Events(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        print("✅ Таблицы в БД готовы!")
+
+    @commands.Cog.listener()
+    async def on_message(self, message):
+        # Команды не считаются: за них и так начисляют
+        if message.author.bot or message.guild is None:
+            return
+        if message.content.startswith(bot.command_prefix):
+            return
+        bot.activity.record(message.guild.id, message.author.id)
+
+    @commands.Cog.listener()
+    async def on_raw_member_remove(self, payload):
+        bot.members.forget(payload.guild_id, payload.user.id)
+
+    @commands.Cog.listener()
+    async def on_guild_role_create(self, role):
+        bot.role_cache.role_changed(role)
+
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before, after):
+        bot.role_cache.role_changed(after)
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role):
+        bot.role_cache.role_deleted(role)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        bot.role_cache.forget_guild(guild)
+        bot.top_users.forget(guild.id)
+        for boards in bot.top_clans.values():
+            boards.forget(guild.id)
+
+    @commands.Cog.listener()
+    async def on_command_error(self, ctx, error):
+        if ctx.command and not hasattr(ctx, "started_at"):
+            # Кулдаун, проверка прав или разбор аргументов: до выполнения дело не дошло
+            bot.stats.reject(ctx.command.qualified_name)
+        if isinstance(error, NotAdmin):
+            await ctx.send("❌ Эта команда доступна только для администраторов!")
+        elif isinstance(error, commands.NoPrivateMessage):
+            await ctx.send("❌ Команды работают только на сервере")
+        elif isinstance(error, commands.CommandOnCooldown):
+            seconds = int(error.retry_after)
+            minutes = seconds // 60
+            seconds = seconds % 60
+            # Повторные попытки во время кулдауна не плодят одинаковых уведомлений
+            reply(ctx, f"⏳ {ctx.author.mention}, подождите {minutes}м {seconds}с, прежде чем использовать эту команду снова.",
+                  key=("cooldown", ctx.channel.id, ctx.author.id, ctx.command.qualified_name))
+        else:
+            print(f"⚠ Ошибка команды: {error}")
+            await ctx.send("❌ Произошла ошибка при выполнении команды")
+
+
+async def setup(bot):
+    await bot.add_cog(Events(bot))
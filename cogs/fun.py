@@ -0,0 +1,44 @@
+import random
+
+from discord.ext import commands
+
+from main import change_balance, reply, shared_cooldown, update_balance
+
+
+class Fun(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+
+    @commands.command(name="ежедневный")
+    @shared_cooldown(1, 86400)
+    async def daily(self, ctx):
+        reward = random.randint(100, 500)
+        await update_balance(ctx.guild.id, ctx.author.id, reward, "daily")
+        reply(ctx, f"🎁 {ctx.author.mention}, вы получили {reward} кредитов!")
+
+    @commands.command(name="рулетка")
+    @shared_cooldown(1, 30)
+    async def roulette(self, ctx, bet: int):
+        if bet <= 0:
+            await ctx.send("❌ Ставка должна быть положительной!")
+            return
+
+        outcome = random.choice(["win", "lose", "refund"])
+        delta = {"win": bet, "lose": -bet, "refund": 0}[outcome]
+
+        # Проверка ставки и изменение баланса одним запросом
+        success, _ = await change_balance(ctx.guild.id, ctx.author.id, delta, bet, "roulette")
+        if not success:
+            await ctx.send("❌ Недостаточно кредитов!")
+            return
+
+        if outcome == "win":
+            reply(ctx, f"🎉 {ctx.author.mention} выиграл {bet} кредитов!")
+        elif outcome == "lose":
+            reply(ctx, f"💀 {ctx.author.mention} проиграл {bet} кредитов...")
+        else:
+            reply(ctx, f"🔄 {ctx.author.mention} вернул свои {bet} кредитов.")
+
+
+async def setup(bot):
+    await bot.add_cog(Fun(bot))
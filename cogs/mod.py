@@ -0,0 +1,176 @@
+import io
+import json
+import time
+from datetime import timedelta
+from typing import Optional
+
+import discord
+from discord.ext import commands
+
+from main import (
+    CachedMember, MUTE_ROLE_NAME, MessagePurge, PURGE_MAX, PURGE_SCAN_LIMIT, PermissionFanout,
+    PurgeFlags, SHARD_COUNT, admin_only, bot, shard_stats, start_permission_fanout,
+)
+
+
+class Mod(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+
+    @commands.command(name="мут")
+    @admin_only()
+    async def mute(self, ctx, member: CachedMember, minutes: int, *, reason: str = "Не указана"):
+        if minutes <= 0:
+            await ctx.send("❌ Время должно быть положительным!")
+            return
+
+        mute_role = bot.role_cache.mute_role(ctx.guild)
+        if not mute_role:
+            mute_role = await ctx.guild.create_role(
+                name=MUTE_ROLE_NAME,
+                reason="Создание роли для мьюта"
+            )
+            bot.role_cache.role_changed(mute_role)
+        
+        await member.add_roles(mute_role)
+        await bot.mute_scheduler.schedule(ctx.guild.id, member.id, time.time() + minutes * 60)
+        await ctx.send(f"✅ {member.mention} замьючен на {minutes} минут по причине: {reason}")
+        await self.ensure_mute_permissions(ctx, mute_role)
+
+    async def ensure_mute_permissions(self, ctx, mute_role):
+        # Права настраиваются в фоне; если прошлый прогон прервался, он продолжится
+        key = (ctx.guild.id, mute_role.id)
+        if key in bot.permission_jobs:
+            return
+        fanout = PermissionFanout(
+            ctx.guild, mute_role, reason="Настройка роли для мьюта", send_messages=False, speak=False
+        )
+        if not any(fanout.plan()):
+            return
+
+        status = await ctx.send(f"🔧 Настраиваю права роли {MUTE_ROLE_NAME} в каналах...")
+
+        async def progress(job):
+            text = f"🔧 Права роли {MUTE_ROLE_NAME}: {job.done}/{job.total} каналов"
+            if job.done == job.total:
+                text = f"✅ Права роли {MUTE_ROLE_NAME} настроены: {job.total - len(job.failed)}/{job.total} каналов"
+                if job.failed:
+                    text += f", ошибок: {len(job.failed)} (повторный !мут продолжит)"
+            await status.edit(content=text)
+
+        start_permission_fanout(fanout, progress)
+
+    @commands.command(name="очистить")
+    @admin_only()
+    async def purge(self, ctx, amount: Optional[int] = None, *, flags: PurgeFlags):
+        # Optional: при "!очистить от: @юзер" разбор откатывается и "от:" уходит во флаги
+        if amount is None:
+            amount = 100
+        if not 1 <= amount <= PURGE_MAX:
+            await ctx.send(f"❌ Количество должно быть от 1 до {PURGE_MAX}!")
+            return
+        if flags.minutes is not None and flags.minutes <= 0:
+            await ctx.send("❌ Время должно быть положительным!")
+            return
+        if ctx.channel.id in bot.purge_jobs:
+            await ctx.send("❌ В этом канале уже идёт очистка!")
+            return
+
+        after = discord.utils.utcnow() - timedelta(minutes=flags.minutes) if flags.minutes else None
+        # Без фильтров каждое просмотренное сообщение подходит, кроме закреплённых
+        filtered = flags.author or flags.contains or flags.bots
+        job = MessagePurge(
+            ctx.channel, amount, before=ctx.message, after=after, author=flags.author,
+            contains=flags.contains, bots=flags.bots, scan_limit=PURGE_SCAN_LIMIT if filtered else amount * 2,
+        )
+        status = await ctx.send(f"🧹 Очищаю до {amount} сообщений...")
+
+        async def progress(job):
+            text = f"🧹 Просмотрено {job.scanned}, удалено {job.deleted}/{min(job.matched, amount)}"
+            if job.finished:
+                text = f"✅ Удалено сообщений: {job.deleted} (просмотрено {job.scanned})"
+                if job.old:
+                    text += f", из них старше 14 дней по одному: {job.old}"
+                if job.failed:
+                    text += f", ошибок: {job.failed}"
+            await status.edit(content=text)
+
+        bot.purge_jobs[ctx.channel.id] = job
+        try:
+            await job.run(progress)
+        except discord.Forbidden:
+            await status.edit(content="❌ У бота нет прав читать историю или удалять сообщения в этом канале!")
+            return
+        finally:
+            del bot.purge_jobs[ctx.channel.id]
+        try:
+            await ctx.message.delete()
+        except discord.HTTPException:
+            pass
+
+    @commands.command(name="пул")
+    @admin_only()
+    async def pool_health(self, ctx):
+        health = bot.db.health()
+        await ctx.send(
+            f"🗄 Пул БД: занято {health['in_use']}/{health['size']} "
+            f"(мин {health['min_size']}, макс {health['max_size']}), свободно {health['idle']}\n"
+            f"⏳ Ждут соединения: {health['waiting']} (максимум {health['max_waiting']}), "
+            f"таймаутов: {health['acquire_timeouts']}"
+        )
+
+    @commands.command(name="шарды")
+    @admin_only()
+    async def shards(self, ctx):
+        stats = shard_stats()
+        total = SHARD_COUNT or 1
+        lines = [f"🧩 Шарды этого процесса: {len(stats)} из {total}, гильдия на шарде {ctx.guild.shard_id}"]
+        for shard_id, latency, guilds in stats:
+            ping = f"{latency * 1000:.0f} мс" if latency is not None else "нет связи"
+            lines.append(f"#{shard_id} — {ping}, гильдий: {guilds}")
+        await ctx.send("\n".join(lines))
+
+    @commands.command(name="статистика")
+    @admin_only()
+    async def stats(self, ctx, mode: str = None):
+        data = bot.stats.as_dict()
+        if mode == "json":
+            payload = io.BytesIO(json.dumps(data, ensure_ascii=False, indent=2).encode())
+            await ctx.send("📊 Полная статистика:", file=discord.File(payload, "stats.json"))
+            return
+
+        lines = [f"📊 **Статистика за {data['uptime_s'] // 60} мин**", "", "**Команды (самые медленные по p99):**"]
+        commands_by_p99 = sorted(data["commands"].items(), key=lambda item: item[1]["p99_ms"], reverse=True)
+        for name, item in commands_by_p99[:10]:
+            queries = item["queries"] / item["count"] if item["count"] else 0
+            lines.append(
+                f"`!{name}` — {item['count']} раз, p50 {item['p50_ms']:.0f} мс, p99 {item['p99_ms']:.0f} мс, "
+                f"ошибок {item['errors']}, отклонено {item['rejected']}, запросов к БД {queries:.1f}"
+            )
+
+        lines += ["", "**Запросы (больше всего суммарного времени):**"]
+        queries_by_total = sorted(data["queries"].items(), key=lambda item: item[1]["avg_ms"] * item[1]["count"], reverse=True)
+        for key, item in queries_by_total[:5]:
+            lines.append(f"`{key[:60]}` — {item['count']} раз, p99 {item['p99_ms']:.0f} мс, ошибок {item['errors']}")
+
+        waits = [item for item in data["pool_wait"].values() if item["count"]]
+        if waits:
+            worst = max(item["p99_ms"] for item in waits)
+            lines += ["", f"⏳ Ожидание пула: p99 до {worst:.0f} мс (подробно: `!статистика json`)"]
+
+        await ctx.send("\n".join(lines)[:2000])
+
+    @commands.command(name="размут")
+    @admin_only()
+    async def unmute(self, ctx, member: CachedMember):
+        mute_role = bot.role_cache.mute_role(ctx.guild)
+        await bot.mute_scheduler.cancel(ctx.guild.id, member.id)
+        if mute_role and member.get_role(mute_role.id):
+            await member.remove_roles(mute_role)
+            await ctx.send(f"✅ {member.mention} размьючен!")
+        else:
+            await ctx.send("❌ Пользователь не замьючен!")
+
+
+async def setup(bot):
+    await bot.add_cog(Mod(bot))
@@ -0,0 +1,53 @@
+import discord
+from discord.ext import commands
+
+from main import CachedMember, get_profile, update_profile_description
+
+
+class Profile(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+
+    @commands.command(name="профиль")
+    async def profile(self, ctx, member: CachedMember = None):
+        if not member:
+            member = ctx.author
+        
+        profile = await get_profile(ctx.guild.id, member.id)
+        avatar_url = member.avatar.url if member.avatar else member.default_avatar.url
+
+        # Embed пересобирается, только если изменились данные или сам участник
+        signature = (member.name, member.color.value, avatar_url)
+        cached = profile.get("embed")
+        if cached and cached[0] == signature:
+            await ctx.send(embed=cached[1])
+            return
+        
+        embed = discord.Embed(
+            title=f"Профиль {member.name}",
+            color=member.color
+        )
+        
+        embed.set_thumbnail(url=avatar_url)
+        
+        embed.add_field(name="💰 Баланс", value=f"{profile['balance']} кредитов", inline=True)
+        embed.add_field(name="👥 Клан", value=profile["clan"] or "Нет клана", inline=True)
+        embed.add_field(name="💬 Сообщений", value=str(profile["messages"]), inline=True)
+        embed.add_field(name="📝 Описание", value=profile["description"], inline=False)
+        embed.set_footer(text=f"ID: {member.id}")
+        profile["embed"] = (signature, embed)
+        
+        await ctx.send(embed=embed)
+
+    @commands.command(name="описание_профиль")
+    async def set_profile_description(self, ctx, *, description: str):
+        if len(description) > 200:
+            await ctx.send("❌ Описание не должно превышать 200 символов!")
+            return
+        
+        await update_profile_description(ctx.guild.id, ctx.author.id, description)
+        await ctx.send("✅ Описание профиля обновлено!")
+
+
+async def setup(bot):
+    await bot.add_cog(Profile(bot))
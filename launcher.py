@@ -0,0 +1,121 @@
+"""Запуск бота несколькими процессами: каждый обслуживает свой диапазон шардов
+и держит свой пул соединений с БД. Пример:
+
+    SHARD_COUNT=8 python launcher.py --workers 4
+
+Процесс N получает SHARD_IDS своего диапазона и порт здоровья PORT + N.
+Упавший процесс перезапускается с нарастающей паузой, Ctrl+C/SIGTERM
+корректно останавливает все процессы.
+"""
+import argparse
+import asyncio
+import os
+import signal
+import sys
+import time
+
+MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+# Discord принимает подключение шарда не чаще раза в 5 секунд
+IDENTIFY_DELAY = 5
+STOP_TIMEOUT = 30
+MAX_BACKOFF = 60
+# Процесс, проработавший дольше, считается здоровым и паузу перезапуска сбрасывает
+HEALTHY_UPTIME = 60
+
+
+def shard_ranges(shard_count, workers):
+    # Непрерывные диапазоны примерно одинакового размера: [0, 1], [2, 3], ...
+    base, extra = divmod(shard_count, workers)
+    ranges, start = [], 0
+    for index in range(workers):
+        size = base + (1 if index < extra else 0)
+        ranges.append(list(range(start, start + size)))
+        start += size
+    return ranges
+
+
+async def stop_process(process):
+    # SIGTERM, чтобы бот сбросил буферы и закрыл пул, как при Ctrl+C. Сигнал
+    # ровно один: процессы в своих сессиях, Ctrl+C в терминале их не достаёт
+    if process.returncode is not None:
+        return
+    process.send_signal(signal.SIGTERM)
+    try:
+        await asyncio.wait_for(process.wait(), STOP_TIMEOUT)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+
+
+async def run_worker(index, shard_ids, args, delay, stopping):
+    name = f"процесс {index} (шарды {shard_ids[0]}-{shard_ids[-1]})"
+    env = dict(
+        os.environ,
+        SHARD_COUNT=str(args.shards),
+        SHARD_IDS=",".join(map(str, shard_ids)),
+        PORT=str(args.port + index),
+    )
+    backoff = 1
+    try:
+        await asyncio.wait_for(stopping.wait(), delay)
+        return
+    except asyncio.TimeoutError:
+        pass
+
+    while not stopping.is_set():
+        print(f"🚀 Запускаю {name}, порт {args.port + index}")
+        started = time.monotonic()
+        # Своя сессия: иначе Ctrl+C пришёл бы процессу от терминала, а затем второй
+        # раз от stop_process и прервал бы сброс буферов посреди остановки
+        process = await asyncio.create_subprocess_exec(sys.executable, MAIN, env=env, start_new_session=True)
+        stop_wait = asyncio.ensure_future(stopping.wait())
+        exit_wait = asyncio.ensure_future(process.wait())
+        await asyncio.wait({stop_wait, exit_wait}, return_when=asyncio.FIRST_COMPLETED)
+        if stopping.is_set():
+            exit_wait.cancel()
+            await stop_process(process)
+            print(f"🛑 {name} остановлен")
+            return
+        stop_wait.cancel()
+
+        if time.monotonic() - started > HEALTHY_UPTIME:
+            backoff = 1
+        print(f"⚠ {name} завершился с кодом {process.returncode}, перезапуск через {backoff} с")
+        try:
+            await asyncio.wait_for(stopping.wait(), backoff)
+        except asyncio.TimeoutError:
+            pass
+        backoff = min(backoff * 2, MAX_BACKOFF)
+
+
+async def run(args):
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+
+    # Процессы стартуют по очереди: следующий ждёт, пока предыдущие подключат свои шарды
+    workers, delay = [], 0
+    for index, shard_ids in enumerate(shard_ranges(args.shards, args.workers)):
+        workers.append(run_worker(index, shard_ids, args, delay, stopping))
+        delay += len(shard_ids) * IDENTIFY_DELAY
+    await asyncio.gather(*workers)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Запуск бота несколькими процессами с шардами")
+    parser.add_argument("--shards", type=int, default=int(os.getenv("SHARD_COUNT", "0")),
+                        help="всего шардов (по умолчанию SHARD_COUNT)")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WORKERS", "2")), help="процессов")
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8080")),
+                        help="порт здоровья первого процесса, у следующих +1")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.shards < 1:
+        sys.exit("❌ Укажите число шардов: --shards или SHARD_COUNT")
+    if not 1 <= args.workers <= args.shards:
+        sys.exit("❌ Процессов должно быть от 1 до числа шардов")
+    asyncio.run(run(args))
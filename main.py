@@ -1,10 +1,22 @@
 import discord
 from discord.ext import commands
 from discord.ext.commands import CommandOnCooldown
-import random
 import os
+import signal
+import sys
+import re
 import asyncpg
 import asyncio
+import time
+import math
+import json
+import heapq
+import contextvars
+from functools import lru_cache, partial
+from datetime import datetime, timedelta, timezone
+from contextlib import asynccontextmanager, contextmanager
+from bisect import bisect_left, insort
+from collections import Counter, OrderedDict
 
 # ==================== КОНФИГ ====================
 TOKEN = os.getenv("DISCORD_TOKEN")
@@ -18,590 +30,3244 @@ SUCCESS_CHANCE = 40
 CLAN_CREATION_PRICE = 5000
 MUTE_ROLE_NAME = "Muted"
 
-# Проверка переменных
-if not TOKEN:
-    print("❌ Ошибка: Не установлен DISCORD_TOKEN")
-    exit(1)
-
-if not DATABASE_URL:
-    print("❌ Ошибка: Не установлен DATABASE_URL")
-    exit(1)
+# Пул соединений с БД
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "5"))
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", "10"))
+DB_ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", "10"))
+
+# Кэш балансов с отложенной записью (BALANCE_CACHE=1 чтобы включить)
+BALANCE_CACHE = os.getenv("BALANCE_CACHE", "0") == "1"
+BALANCE_CACHE_SIZE = int(os.getenv("BALANCE_CACHE_SIZE", "10000"))
+BALANCE_FLUSH_INTERVAL_MS = int(os.getenv("BALANCE_FLUSH_INTERVAL_MS", "2000"))
+BALANCE_FLUSH_BATCH = int(os.getenv("BALANCE_FLUSH_BATCH", "200"))
+BALANCE_MAX_STALENESS = float(os.getenv("BALANCE_MAX_STALENESS", "60"))
+
+# Массовая настройка прав каналов: сколько запросов к API одновременно
+PERMISSION_FANOUT_CONCURRENCY = int(os.getenv("PERMISSION_FANOUT_CONCURRENCY", "5"))
+PERMISSION_PROGRESS_INTERVAL = 3
+
+# !очистить: предел за один вызов, сколько сообщений просмотреть с фильтрами и
+# сколько сообщений старше 14 дней (их нельзя удалить пачкой) удалять по одному
+PURGE_MAX = int(os.getenv("PURGE_MAX", "10000"))
+PURGE_SCAN_LIMIT = int(os.getenv("PURGE_SCAN_LIMIT", "50000"))
+PURGE_OLD_LIMIT = int(os.getenv("PURGE_OLD_LIMIT", "200"))
+PURGE_OLD_CONCURRENCY = int(os.getenv("PURGE_OLD_CONCURRENCY", "2"))
+# Как часто (в секундах) обновлять сообщение о ходе очистки
+PURGE_PROGRESS_INTERVAL = 3
+
+# HTTP-эндпоинт здоровья и метрик (порт задаёт хостинг через PORT)
+HEALTH_HOST = os.getenv("HEALTH_HOST", "0.0.0.0")
+HEALTH_PORT = int(os.getenv("PORT", "8080"))
+HEALTH_DB_TIMEOUT = 2
+
+# Порог медленных команд и запросов для логирования, мс
+SLOW_COMMAND_MS = float(os.getenv("SLOW_COMMAND_MS", "1000"))
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+
+# Кэш профилей: сколько пользователей держать в памяти
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "1000"))
+
+# Лидерборды: сколько строк держать в памяти и как часто сверяться с БД
+LEADERBOARD_SIZE = int(os.getenv("LEADERBOARD_SIZE", "50"))
+LEADERBOARD_TTL = float(os.getenv("LEADERBOARD_TTL", "60"))
+NAME_CACHE_TTL = float(os.getenv("NAME_CACHE_TTL", "3600"))
+NAME_CACHE_SIZE = int(os.getenv("NAME_CACHE_SIZE", "5000"))
+
+# Экономия памяти (LOW_MEMORY=1): участники не кэшируются целиком и не загружаются
+# при старте, а подгружаются по требованию в LRU с TTL
+LOW_MEMORY = os.getenv("LOW_MEMORY", "0") == "1"
+MEMBER_CACHE_SIZE = int(os.getenv("MEMBER_CACHE_SIZE", "2000"))
+MEMBER_CACHE_TTL = float(os.getenv("MEMBER_CACHE_TTL", "300"))
+
+# Активность: счётчики сообщений сбрасываются в БД раз в интервал, с.
+# Награда начисляется не больше чем за ACTIVITY_REWARD_CAP сообщений за интервал
+ACTIVITY_FLUSH_INTERVAL = float(os.getenv("ACTIVITY_FLUSH_INTERVAL", "30"))
+ACTIVITY_REWARD = int(os.getenv("ACTIVITY_REWARD", "1"))
+ACTIVITY_REWARD_CAP = int(os.getenv("ACTIVITY_REWARD_CAP", "10"))
+
+# Журнал операций: пакетная запись и предел буфера на случай недоступности БД
+LEDGER_FLUSH_INTERVAL_MS = int(os.getenv("LEDGER_FLUSH_INTERVAL_MS", "1000"))
+LEDGER_FLUSH_BATCH = int(os.getenv("LEDGER_FLUSH_BATCH", "500"))
+LEDGER_MAX_BUFFER = int(os.getenv("LEDGER_MAX_BUFFER", "100000"))
+HISTORY_PAGE_SIZE = 10
+
+# Кулдауны: начиная с этой длительности, с, они хранятся в БД и общие для всех
+# процессов; короткие живут в памяти процесса. Просроченные удаляются раз в интервал
+COOLDOWN_SHARED_MIN_SECONDS = float(os.getenv("COOLDOWN_SHARED_MIN_SECONDS", "60"))
+COOLDOWN_CLEANUP_INTERVAL = float(os.getenv("COOLDOWN_CLEANUP_INTERVAL", "300"))
+COOLDOWN_CLEANUP_BATCH = 1000
+
+# Исходящие ответы: сколько секунд после своего сообщения новые ответы дописываются
+# в него правкой и сколько секунд не повторять одинаковое уведомление (0 — выключить)
+OUTBOX_EDIT_WINDOW = float(os.getenv("OUTBOX_EDIT_WINDOW", "3"))
+OUTBOX_DEDUPE_WINDOW = float(os.getenv("OUTBOX_DEDUPE_WINDOW", "10"))
+MESSAGE_LIMIT = 2000
+# Сколько секунд при остановке ждать отправки оставшихся ответов
+OUTBOX_CLOSE_TIMEOUT = 10
+
+# Канал NOTIFY, в который snapshot.py сообщает о загрузке снимка: бот сбрасывает
+# кэши восстановленных гильдий. Имя совпадает с RESTORE_CHANNEL в snapshot.py
+RESTORE_CHANNEL = "economy_restored"
+
+# Шардинг: SHARD_COUNT — всего шардов, SHARD_IDS — шарды этого процесса через запятую
+# (их выставляет launcher.py). Без SHARD_COUNT бот работает одним подключением
+SHARD_COUNT = int(os.getenv("SHARD_COUNT")) if os.getenv("SHARD_COUNT") else None
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv("SHARD_IDS").split(",")] if os.getenv("SHARD_IDS") else None
+
+# Экономика у каждой гильдии своя. Данные, накопленные до разделения по гильдиям,
+# миграция переносит в гильдию LEGACY_GUILD_ID (нужна, только если такие данные есть)
+LEGACY_GUILD_ID = os.getenv("LEGACY_GUILD_ID", "")
+
+def check_config():
+    # Проверка переменных при запуске бота, а не при импорте (коги, bench.py)
+    if not TOKEN:
+        print("❌ Ошибка: Не установлен DISCORD_TOKEN")
+        sys.exit(1)
+
+    if not DATABASE_URL:
+        print("❌ Ошибка: Не установлен DATABASE_URL")
+        sys.exit(1)
+
+    if SHARD_IDS is not None and (SHARD_COUNT is None or any(not 0 <= i < SHARD_COUNT for i in SHARD_IDS)):
+        print("❌ Ошибка: SHARD_IDS должны быть от 0 до SHARD_COUNT - 1")
+        sys.exit(1)
+
+    if LEGACY_GUILD_ID and not LEGACY_GUILD_ID.isdigit():
+        print("❌ Ошибка: LEGACY_GUILD_ID должен быть ID гильдии")
+        sys.exit(1)
 
 intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True
 
-bot = commands.Bot(command_prefix="!", intents=intents)
+class DrainOnClose:
+    """Перед отключением от Discord отправляет накопленные в bot.outbox ответы."""
+
+    async def close(self):
+        # Очереди отправляются, пока подключение ещё открыто: async with bot,
+        # Ctrl+C и SIGTERM закрывают клиента через close()
+        try:
+            await asyncio.wait_for(self.outbox.close(), OUTBOX_CLOSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"⚠ Не все ответы отправлены до остановки, в очереди: {self.outbox.depth()}")
+        await super().close()
+
+class Bot(DrainOnClose, commands.Bot):
+    pass
+
+class ShardedBot(DrainOnClose, commands.AutoShardedBot):
+    pass
+
+bot_options = {"command_prefix": "!", "intents": intents}
+if LOW_MEMORY:
+    # Интент участников остаётся: без него нельзя найти участника по ID или имени
+    bot_options.update(member_cache_flags=discord.MemberCacheFlags.none(), chunk_guilds_at_startup=False)
+if SHARD_COUNT:
+    bot = ShardedBot(shard_count=SHARD_COUNT, shard_ids=SHARD_IDS, **bot_options)
+else:
+    bot = Bot(**bot_options)
+bot.balance_cache = None
+
+def shard_stats():
+    # (id шарда, задержка в секундах или None, гильдий) для шардов этого процесса
+    guilds = Counter(guild.shard_id for guild in bot.guilds)
+    if isinstance(bot, commands.AutoShardedBot):
+        shards = [(shard_id, info.latency) for shard_id, info in sorted(bot.shards.items())]
+    else:
+        shards = [(0, bot.latency)]
+    return [(shard_id, latency if math.isfinite(latency) else None, guilds[shard_id])
+            for shard_id, latency in shards]
+
+# ==================== ИНСТРУМЕНТАЦИЯ ====================
+PROCESS_STARTED = time.monotonic()
+bot.startup_seconds = None
+
+def resident_memory_mb() -> float:
+    # Текущий RSS процесса из /proc (Linux), иначе пиковый из getrusage
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# Команда, в рамках которой сейчас выполняется код (для учёта запросов и ожидания пула)
+current_command = contextvars.ContextVar("current_command", default=None)
+
+
+class LatencyStats:
+    __slots__ = ("count", "errors", "rejected", "queries", "total_ms", "max_ms", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.rejected = 0
+        self.queries = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def observe(self, ms: float, error=False):
+        self.count += 1
+        self.errors += error
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        self.buckets[bisect_left(LATENCY_BUCKETS_MS, ms)] += 1
+
+    def quantile(self, q: float) -> float:
+        # Верхняя граница корзины, в которую попадает квантиль
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS_MS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return float(bound)
+        return self.max_ms
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "rejected": self.rejected,
+            "queries": self.queries,
+            "avg_ms": round(self.total_ms / self.count, 2) if self.count else 0.0,
+            "p50_ms": self.quantile(0.5),
+            "p99_ms": self.quantile(0.99),
+            "max_ms": round(self.max_ms, 2),
+            "buckets": dict(zip([*map(str, LATENCY_BUCKETS_MS), "+Inf"], self.buckets)),
+        }
+
+
+@lru_cache(maxsize=512)
+def sql_key(sql: str) -> str:
+    # Запросы — константные строки, так что ключ считается один раз на запрос
+    return " ".join(sql.split())[:120]
+
+
+class Stats:
+    """Гистограммы задержек команд, SQL-запросов и ожидания соединения из пула."""
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.commands = {}
+        self.queries = {}
+        self.pool_wait = {}
+        self.sends = {}
+
+    @staticmethod
+    def _get(table, key) -> LatencyStats:
+        stats = table.get(key)
+        if stats is None:
+            stats = table[key] = LatencyStats()
+        return stats
+
+    def command(self, name: str, ms: float, error=False):
+        self._get(self.commands, name).observe(ms, error)
+        if ms >= SLOW_COMMAND_MS:
+            print(f"🐢 Медленная команда !{name}: {ms:.0f} мс")
+
+    def reject(self, name: str):
+        self._get(self.commands, name).rejected += 1
+
+    @contextmanager
+    def query(self, sql: str):
+        started = time.perf_counter()
+        error = True
+        try:
+            yield
+            error = False
+        finally:
+            ms = (time.perf_counter() - started) * 1000
+            key = sql_key(sql)
+            self._get(self.queries, key).observe(ms, error)
+            command = current_command.get()
+            if command:
+                self._get(self.commands, command).queries += 1
+            if ms >= SLOW_QUERY_MS:
+                print(f"🐢 Медленный запрос ({ms:.0f} мс, команда {command or '-'}): {key}")
+
+    def wait(self, ms: float):
+        self._get(self.pool_wait, current_command.get() or "-").observe(ms)
+
+    def send(self, kind: str, ms: float, error=False):
+        # От постановки ответа в очередь до его появления в канале
+        self._get(self.sends, kind).observe(ms, error)
+
+    def as_dict(self):
+        return {
+            "uptime_s": round(time.time() - self.started_at),
+            "commands": {name: stats.as_dict() for name, stats in self.commands.items()},
+            "queries": {key: stats.as_dict() for key, stats in self.queries.items()},
+            "pool_wait": {name: stats.as_dict() for name, stats in self.pool_wait.items()},
+            "sends": {kind: stats.as_dict() for kind, stats in self.sends.items()},
+        }
+
+bot.stats = Stats()
+
+
+@bot.before_invoke
+async def before_command(ctx):
+    ctx.started_at = time.perf_counter()
+    current_command.set(ctx.command.qualified_name)
+
+@bot.after_invoke
+async def after_command(ctx):
+    ms = (time.perf_counter() - ctx.started_at) * 1000
+    bot.stats.command(ctx.command.qualified_name, ms, ctx.command_failed)
+    current_command.set(None)
+
+# ==================== МИГРАЦИИ ====================
+# Каждая миграция применяется один раз и записывается в schema_migrations.
+# Новые миграции добавляются только в конец списка, старые не редактируются.
+MIGRATIONS = [
+    (1, "Базовые таблицы", """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            balance INTEGER DEFAULT 0,
+            profile_description TEXT
+        );
+        CREATE TABLE IF NOT EXISTS custom_roles (
+            user_id BIGINT PRIMARY KEY,
+            role_id BIGINT,
+            role_name TEXT,
+            role_color TEXT
+        );
+        CREATE TABLE IF NOT EXISTS clans (
+            name TEXT PRIMARY KEY,
+            owner_id BIGINT,
+            balance INTEGER DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS user_clans (
+            user_id BIGINT PRIMARY KEY,
+            clan_name TEXT
+        );
+    """),
+    (2, "Индексы для топов и состава кланов", """
+        -- Топ, страницы и ранг: keyset по (balance, user_id)
+        CREATE INDEX IF NOT EXISTS users_balance_idx ON users (balance, user_id);
+        -- Топ кланов
+        CREATE INDEX IF NOT EXISTS clans_balance_idx ON clans (balance, name);
+        -- Участники клана
+        CREATE INDEX IF NOT EXISTS user_clans_clan_name_idx ON user_clans (clan_name);
+    """),
+    (3, "Сроки временных мутов", """
+        CREATE TABLE IF NOT EXISTS mute_expirations (
+            guild_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            expires_at TIMESTAMPTZ NOT NULL,
+            PRIMARY KEY (guild_id, user_id)
+        );
+        CREATE INDEX IF NOT EXISTS mute_expirations_expires_at_idx ON mute_expirations (expires_at);
+    """),
+    (4, "Счётчик сообщений", """
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS messages BIGINT NOT NULL DEFAULT 0;
+    """),
+    (5, "Журнал операций", """
+        -- Разделы по месяцам создаёт LedgerWriter; старые можно отсоединять целиком
+        CREATE TABLE IF NOT EXISTS ledger (
+            id BIGSERIAL,
+            user_id BIGINT NOT NULL,
+            amount INTEGER NOT NULL,
+            balance INTEGER NOT NULL,
+            reason TEXT NOT NULL,
+            counterparty BIGINT,
+            created_at TIMESTAMPTZ NOT NULL,
+            PRIMARY KEY (created_at, id)
+        ) PARTITION BY RANGE (created_at);
+        -- !история: keyset по (created_at, id) внутри пользователя
+        CREATE INDEX IF NOT EXISTS ledger_user_idx ON ledger (user_id, created_at, id);
+    """),
+    (6, "Агрегаты кланов", """
+        ALTER TABLE clans ADD COLUMN IF NOT EXISTS member_count INTEGER NOT NULL DEFAULT 0;
+        ALTER TABLE clans ADD COLUMN IF NOT EXISTS member_balance BIGINT NOT NULL DEFAULT 0;
+        UPDATE clans c SET member_count = a.member_count, member_balance = a.member_balance
+        FROM (
+            SELECT uc.clan_name, count(*) AS member_count, COALESCE(sum(u.balance), 0) AS member_balance
+            FROM user_clans uc LEFT JOIN users u USING (user_id)
+            GROUP BY uc.clan_name
+        ) a
+        WHERE c.name = a.clan_name;
+
+        -- Топы кланов по составу и богатству участников
+        CREATE INDEX IF NOT EXISTS clans_member_count_idx ON clans (member_count, name);
+        CREATE INDEX IF NOT EXISTS clans_member_balance_idx ON clans (member_balance, name);
+
+        -- Триггеры уровня оператора: пакетные записи (сброс кэша балансов,
+        -- активность, массовые начисления) дают один UPDATE на клан, а не на строку
+        CREATE OR REPLACE FUNCTION clan_members_changed() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                UPDATE clans c SET member_count = c.member_count - d.members,
+                                   member_balance = c.member_balance - d.total
+                FROM (
+                    SELECT o.clan_name, count(*) AS members, COALESCE(sum(u.balance), 0) AS total
+                    FROM old_rows o LEFT JOIN users u USING (user_id)
+                    GROUP BY o.clan_name
+                ) d
+                WHERE c.name = d.clan_name;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                UPDATE clans c SET member_count = c.member_count + d.members,
+                                   member_balance = c.member_balance + d.total
+                FROM (
+                    SELECT n.clan_name, count(*) AS members, COALESCE(sum(u.balance), 0) AS total
+                    FROM new_rows n LEFT JOIN users u USING (user_id)
+                    GROUP BY n.clan_name
+                ) d
+                WHERE c.name = d.clan_name;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER user_clans_insert_aggregates AFTER INSERT ON user_clans
+            REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION clan_members_changed();
+        CREATE TRIGGER user_clans_update_aggregates AFTER UPDATE ON user_clans
+            REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION clan_members_changed();
+        CREATE TRIGGER user_clans_delete_aggregates AFTER DELETE ON user_clans
+            REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION clan_members_changed();
+
+        CREATE OR REPLACE FUNCTION clan_balances_changed() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE clans c SET member_balance = c.member_balance + d.total
+                FROM (
+                    SELECT uc.clan_name, sum(COALESCE(n.balance, 0)) AS total
+                    FROM new_rows n JOIN user_clans uc USING (user_id)
+                    GROUP BY uc.clan_name
+                ) d
+                WHERE c.name = d.clan_name AND d.total <> 0;
+            ELSE
+                UPDATE clans c SET member_balance = c.member_balance - d.total
+                FROM (
+                    SELECT uc.clan_name, sum(COALESCE(o.balance, 0)) AS total
+                    FROM old_rows o JOIN user_clans uc USING (user_id)
+                    GROUP BY uc.clan_name
+                ) d
+                WHERE c.name = d.clan_name AND d.total <> 0;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION clan_balances_updated() RETURNS trigger AS $$
+        BEGIN
+            UPDATE clans c SET member_balance = c.member_balance + d.delta
+            FROM (
+                SELECT uc.clan_name, sum(COALESCE(n.balance, 0) - COALESCE(o.balance, 0)) AS delta
+                FROM new_rows n
+                JOIN old_rows o USING (user_id)
+                JOIN user_clans uc USING (user_id)
+                GROUP BY uc.clan_name
+                HAVING sum(COALESCE(n.balance, 0) - COALESCE(o.balance, 0)) <> 0
+            ) d
+            WHERE c.name = d.clan_name;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER users_insert_clan_balance AFTER INSERT ON users
+            REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION clan_balances_changed();
+        CREATE TRIGGER users_update_clan_balance AFTER UPDATE ON users
+            REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION clan_balances_updated();
+        CREATE TRIGGER users_delete_clan_balance AFTER DELETE ON users
+            REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION clan_balances_changed();
+    """),
+    (7, "Кулдауны", """
+        -- Ведро токенов: tokens на момент updated_at, expires_at — когда ведро снова полное
+        CREATE TABLE IF NOT EXISTS cooldowns (
+            command TEXT NOT NULL,
+            user_id BIGINT NOT NULL,
+            tokens DOUBLE PRECISION NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL,
+            expires_at TIMESTAMPTZ NOT NULL,
+            PRIMARY KEY (command, user_id)
+        );
+        CREATE INDEX IF NOT EXISTS cooldowns_expires_at_idx ON cooldowns (expires_at);
+    """),
+    (8, "Экономика по гильдиям", """
+        -- Старые таблицы уступают имена новым и удаляются после переноса данных
+        ALTER TABLE users RENAME TO users_global;
+        ALTER TABLE clans RENAME TO clans_global;
+        ALTER TABLE user_clans RENAME TO user_clans_global;
+        ALTER TABLE custom_roles RENAME TO custom_roles_global;
+        ALTER INDEX users_pkey RENAME TO users_global_pkey;
+        ALTER INDEX clans_pkey RENAME TO clans_global_pkey;
+        ALTER INDEX user_clans_pkey RENAME TO user_clans_global_pkey;
+        ALTER INDEX custom_roles_pkey RENAME TO custom_roles_global_pkey;
+
+        -- Ключи начинаются с guild_id, таблицы разбиты на 16 хеш-разделов по нему:
+        -- запросы одной гильдии читают и блокируют только её раздел
+        CREATE TABLE users (
+            guild_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            balance INTEGER DEFAULT 0,
+            profile_description TEXT,
+            messages BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (guild_id, user_id)
+        ) PARTITION BY HASH (guild_id);
+        CREATE TABLE custom_roles (
+            guild_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            role_id BIGINT,
+            role_name TEXT,
+            role_color TEXT,
+            PRIMARY KEY (guild_id, user_id)
+        ) PARTITION BY HASH (guild_id);
+        CREATE TABLE clans (
+            guild_id BIGINT NOT NULL,
+            name TEXT NOT NULL,
+            owner_id BIGINT,
+            balance INTEGER DEFAULT 0,
+            member_count INTEGER NOT NULL DEFAULT 0,
+            member_balance BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (guild_id, name)
+        ) PARTITION BY HASH (guild_id);
+        CREATE TABLE user_clans (
+            guild_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            clan_name TEXT,
+            PRIMARY KEY (guild_id, user_id)
+        ) PARTITION BY HASH (guild_id);
+
+        DO $$
+        DECLARE
+            legacy BIGINT := NULLIF(current_setting('economy.legacy_guild_id', true), '')::bigint;
+        BEGIN
+            FOR i IN 0..15 LOOP
+                EXECUTE format('CREATE TABLE users_p%s PARTITION OF users FOR VALUES WITH (MODULUS 16, REMAINDER %s)', i, i);
+                EXECUTE format('CREATE TABLE custom_roles_p%s PARTITION OF custom_roles FOR VALUES WITH (MODULUS 16, REMAINDER %s)', i, i);
+                EXECUTE format('CREATE TABLE clans_p%s PARTITION OF clans FOR VALUES WITH (MODULUS 16, REMAINDER %s)', i, i);
+                EXECUTE format('CREATE TABLE user_clans_p%s PARTITION OF user_clans FOR VALUES WITH (MODULUS 16, REMAINDER %s)', i, i);
+            END LOOP;
+
+            IF legacy IS NULL AND (EXISTS (SELECT 1 FROM users_global) OR EXISTS (SELECT 1 FROM clans_global)
+                                   OR EXISTS (SELECT 1 FROM custom_roles_global)) THEN
+                RAISE EXCEPTION 'Экономика уже есть: укажите LEGACY_GUILD_ID, чтобы перенести её в свою гильдию';
+            END IF;
+
+            -- Агрегаты кланов переносятся как есть, триггеры создаются после переноса
+            INSERT INTO users (guild_id, user_id, balance, profile_description, messages)
+            SELECT legacy, user_id, balance, profile_description, messages FROM users_global;
+            INSERT INTO custom_roles (guild_id, user_id, role_id, role_name, role_color)
+            SELECT legacy, user_id, role_id, role_name, role_color FROM custom_roles_global;
+            INSERT INTO clans (guild_id, name, owner_id, balance, member_count, member_balance)
+            SELECT legacy, name, owner_id, balance, member_count, member_balance FROM clans_global;
+            INSERT INTO user_clans (guild_id, user_id, clan_name)
+            SELECT legacy, user_id, clan_name FROM user_clans_global;
+
+            -- Журнал: столбец со значением по умолчанию добавляется без перезаписи таблицы
+            EXECUTE format('ALTER TABLE ledger ADD COLUMN guild_id BIGINT NOT NULL DEFAULT %s', COALESCE(legacy, 0));
+            ALTER TABLE ledger ALTER COLUMN guild_id DROP DEFAULT;
+        END $$;
+
+        DROP TABLE users_global, clans_global, user_clans_global, custom_roles_global;
+
+        CREATE INDEX users_balance_idx ON users (guild_id, balance, user_id);
+        CREATE INDEX clans_balance_idx ON clans (guild_id, balance, name);
+        CREATE INDEX clans_member_count_idx ON clans (guild_id, member_count, name);
+        CREATE INDEX clans_member_balance_idx ON clans (guild_id, member_balance, name);
+        CREATE INDEX user_clans_clan_name_idx ON user_clans (guild_id, clan_name);
+        DROP INDEX ledger_user_idx;
+        CREATE INDEX ledger_user_idx ON ledger (guild_id, user_id, created_at, id);
+
+        CREATE OR REPLACE FUNCTION clan_members_changed() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                UPDATE clans c SET member_count = c.member_count - d.members,
+                                   member_balance = c.member_balance - d.total
+                FROM (
+                    SELECT o.guild_id, o.clan_name, count(*) AS members, COALESCE(sum(u.balance), 0) AS total
+                    FROM old_rows o LEFT JOIN users u USING (guild_id, user_id)
+                    GROUP BY o.guild_id, o.clan_name
+                ) d
+                WHERE c.guild_id = d.guild_id AND c.name = d.clan_name;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                UPDATE clans c SET member_count = c.member_count + d.members,
+                                   member_balance = c.member_balance + d.total
+                FROM (
+                    SELECT n.guild_id, n.clan_name, count(*) AS members, COALESCE(sum(u.balance), 0) AS total
+                    FROM new_rows n LEFT JOIN users u USING (guild_id, user_id)
+                    GROUP BY n.guild_id, n.clan_name
+                ) d
+                WHERE c.guild_id = d.guild_id AND c.name = d.clan_name;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION clan_balances_changed() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE clans c SET member_balance = c.member_balance + d.total
+                FROM (
+                    SELECT uc.guild_id, uc.clan_name, sum(COALESCE(n.balance, 0)) AS total
+                    FROM new_rows n JOIN user_clans uc USING (guild_id, user_id)
+                    GROUP BY uc.guild_id, uc.clan_name
+                ) d
+                WHERE c.guild_id = d.guild_id AND c.name = d.clan_name AND d.total <> 0;
+            ELSE
+                UPDATE clans c SET member_balance = c.member_balance - d.total
+                FROM (
+                    SELECT uc.guild_id, uc.clan_name, sum(COALESCE(o.balance, 0)) AS total
+                    FROM old_rows o JOIN user_clans uc USING (guild_id, user_id)
+                    GROUP BY uc.guild_id, uc.clan_name
+                ) d
+                WHERE c.guild_id = d.guild_id AND c.name = d.clan_name AND d.total <> 0;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION clan_balances_updated() RETURNS trigger AS $$
+        BEGIN
+            UPDATE clans c SET member_balance = c.member_balance + d.delta
+            FROM (
+                SELECT uc.guild_id, uc.clan_name, sum(COALESCE(n.balance, 0) - COALESCE(o.balance, 0)) AS delta
+                FROM new_rows n
+                JOIN old_rows o USING (guild_id, user_id)
+                JOIN user_clans uc USING (guild_id, user_id)
+                GROUP BY uc.guild_id, uc.clan_name
+                HAVING sum(COALESCE(n.balance, 0) - COALESCE(o.balance, 0)) <> 0
+            ) d
+            WHERE c.guild_id = d.guild_id AND c.name = d.clan_name;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER user_clans_insert_aggregates AFTER INSERT ON user_clans
+            REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION clan_members_changed();
+        CREATE TRIGGER user_clans_update_aggregates AFTER UPDATE ON user_clans
+            REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION clan_members_changed();
+        CREATE TRIGGER user_clans_delete_aggregates AFTER DELETE ON user_clans
+            REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION clan_members_changed();
+        CREATE TRIGGER users_insert_clan_balance AFTER INSERT ON users
+            REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION clan_balances_changed();
+        CREATE TRIGGER users_update_clan_balance AFTER UPDATE ON users
+            REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION clan_balances_updated();
+        CREATE TRIGGER users_delete_clan_balance AFTER DELETE ON users
+            REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION clan_balances_changed();
+    """),
+    (9, "Порядок блокировок агрегатов кланов", """
+        -- Триггеры блокируют строки кланов заранее и в одном порядке: иначе UPDATE ... FROM
+        -- берёт их в порядке соединения, и два многострочных оператора (перевод между
+        -- участниками разных кланов, сброс кэша балансов) блокируют их навстречу друг другу
+        CREATE OR REPLACE FUNCTION lock_clans(guild_ids BIGINT[], names TEXT[]) RETURNS void AS $$
+        BEGIN
+            PERFORM 1 FROM clans
+            WHERE (guild_id, name) IN (SELECT * FROM unnest(guild_ids, names))
+            ORDER BY guild_id, name
+            FOR NO KEY UPDATE;
+        END
+        $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION clan_members_changed() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                PERFORM lock_clans(array_agg(guild_id), array_agg(clan_name)) FROM new_rows;
+            ELSIF TG_OP = 'DELETE' THEN
+                PERFORM lock_clans(array_agg(guild_id), array_agg(clan_name)) FROM old_rows;
+            ELSE
+                PERFORM lock_clans(array_agg(guild_id), array_agg(clan_name))
+                FROM (SELECT guild_id, clan_name FROM old_rows UNION SELECT guild_id, clan_name FROM new_rows) k;
+            END IF;
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                UPDATE clans c SET member_count = c.member_count - d.members,
+                                   member_balance = c.member_balance - d.total
+                FROM (
+                    SELECT o.guild_id, o.clan_name, count(*) AS members, COALESCE(sum(u.balance), 0) AS total
+                    FROM old_rows o LEFT JOIN users u USING (guild_id, user_id)
+                    GROUP BY o.guild_id, o.clan_name
+                ) d
+                WHERE c.guild_id = d.guild_id AND c.name = d.clan_name;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                UPDATE clans c SET member_count = c.member_count + d.members,
+                                   member_balance = c.member_balance + d.total
+                FROM (
+                    SELECT n.guild_id, n.clan_name, count(*) AS members, COALESCE(sum(u.balance), 0) AS total
+                    FROM new_rows n LEFT JOIN users u USING (guild_id, user_id)
+                    GROUP BY n.guild_id, n.clan_name
+                ) d
+                WHERE c.guild_id = d.guild_id AND c.name = d.clan_name;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION clan_balances_changed() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                PERFORM lock_clans(array_agg(uc.guild_id), array_agg(uc.clan_name))
+                FROM new_rows n JOIN user_clans uc USING (guild_id, user_id);
+                UPDATE clans c SET member_balance = c.member_balance + d.total
+                FROM (
+                    SELECT uc.guild_id, uc.clan_name, sum(COALESCE(n.balance, 0)) AS total
+                    FROM new_rows n JOIN user_clans uc USING (guild_id, user_id)
+                    GROUP BY uc.guild_id, uc.clan_name
+                ) d
+                WHERE c.guild_id = d.guild_id AND c.name = d.clan_name AND d.total <> 0;
+            ELSE
+                PERFORM lock_clans(array_agg(uc.guild_id), array_agg(uc.clan_name))
+                FROM old_rows o JOIN user_clans uc USING (guild_id, user_id);
+                UPDATE clans c SET member_balance = c.member_balance - d.total
+                FROM (
+                    SELECT uc.guild_id, uc.clan_name, sum(COALESCE(o.balance, 0)) AS total
+                    FROM old_rows o JOIN user_clans uc USING (guild_id, user_id)
+                    GROUP BY uc.guild_id, uc.clan_name
+                ) d
+                WHERE c.guild_id = d.guild_id AND c.name = d.clan_name AND d.total <> 0;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION clan_balances_updated() RETURNS trigger AS $$
+        BEGIN
+            PERFORM lock_clans(array_agg(uc.guild_id), array_agg(uc.clan_name))
+            FROM new_rows n
+            JOIN old_rows o USING (guild_id, user_id)
+            JOIN user_clans uc USING (guild_id, user_id)
+            WHERE n.balance IS DISTINCT FROM o.balance;
+            UPDATE clans c SET member_balance = c.member_balance + d.delta
+            FROM (
+                SELECT uc.guild_id, uc.clan_name, sum(COALESCE(n.balance, 0) - COALESCE(o.balance, 0)) AS delta
+                FROM new_rows n
+                JOIN old_rows o USING (guild_id, user_id)
+                JOIN user_clans uc USING (guild_id, user_id)
+                GROUP BY uc.guild_id, uc.clan_name
+                HAVING sum(COALESCE(n.balance, 0) - COALESCE(o.balance, 0)) <> 0
+            ) d
+            WHERE c.guild_id = d.guild_id AND c.name = d.clan_name;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql;
+    """),
+]
+
+# Ключ advisory-блокировки, чтобы несколько процессов не применяли миграции одновременно
+MIGRATIONS_LOCK_ID = 7_312_001
+
+async def run_migrations(conn):
+    latest = MIGRATIONS[-1][0]
+    try:
+        applied = await conn.fetchval("SELECT max(version) FROM schema_migrations")
+    except asyncpg.UndefinedTableError:
+        applied = None
+    if applied is not None and applied >= latest:
+        return
+
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    """)
+    await conn.execute("SELECT pg_advisory_lock($1)", MIGRATIONS_LOCK_ID)
+    # Миграция 8 переносит прежнюю общую экономику в эту гильдию
+    await conn.execute("SELECT set_config('economy.legacy_guild_id', $1, false)", LEGACY_GUILD_ID)
+    try:
+        done = {row["version"] for row in await conn.fetch("SELECT version FROM schema_migrations")}
+        for version, name, sql in MIGRATIONS:
+            if version in done:
+                continue
+            async with conn.transaction():
+                await conn.execute(sql)
+                await conn.execute(
+                    "INSERT INTO schema_migrations (version, name) VALUES ($1, $2)", version, name
+                )
+            print(f"✅ Применена миграция {version}: {name}")
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATIONS_LOCK_ID)
 
 # ==================== БАЗА ДАННЫХ ====================
+# Горячие запросы готовятся один раз на каждом соединении пула
+PREPARED_QUERIES = {
+    "get_balance": "SELECT balance FROM users WHERE guild_id = $1 AND user_id = $2",
+    "update_balance": """
+        INSERT INTO users (guild_id, user_id, balance) VALUES ($1, $2, $3)
+        ON CONFLICT (guild_id, user_id) DO UPDATE SET balance = users.balance + $3
+        RETURNING balance
+    """,
+    "get_user_clan": "SELECT clan_name FROM user_clans WHERE guild_id = $1 AND user_id = $2",
+    "get_profile": """
+        SELECT u.balance, u.profile_description, u.messages, uc.clan_name
+        FROM (SELECT $1::bigint AS guild_id, $2::bigint AS user_id) k
+        LEFT JOIN users u ON u.guild_id = k.guild_id AND u.user_id = k.user_id
+        LEFT JOIN user_clans uc ON uc.guild_id = k.guild_id AND uc.user_id = k.user_id
+    """,
+}
+
+
+class TimedStatement:
+    # Подготовленный запрос с учётом времени выполнения
+    __slots__ = ("key", "statement")
+
+    def __init__(self, name: str, statement):
+        self.key = f"prepared:{name}"
+        self.statement = statement
+
+    async def fetch(self, *args):
+        with bot.stats.query(self.key):
+            return await self.statement.fetch(*args)
+
+    async def fetchrow(self, *args):
+        with bot.stats.query(self.key):
+            return await self.statement.fetchrow(*args)
+
+    async def fetchval(self, *args):
+        with bot.stats.query(self.key):
+            return await self.statement.fetchval(*args)
+
+
+class BotConnection(asyncpg.Connection):
+    prepared = None
+
+    async def execute(self, query, *args, **kwargs):
+        with bot.stats.query(query):
+            return await super().execute(query, *args, **kwargs)
+
+    async def executemany(self, command, args, **kwargs):
+        with bot.stats.query(command):
+            return await super().executemany(command, args, **kwargs)
+
+    async def fetch(self, query, *args, **kwargs):
+        with bot.stats.query(query):
+            return await super().fetch(query, *args, **kwargs)
+
+    async def fetchrow(self, query, *args, **kwargs):
+        with bot.stats.query(query):
+            return await super().fetchrow(query, *args, **kwargs)
+
+    async def fetchval(self, query, *args, **kwargs):
+        with bot.stats.query(query):
+            return await super().fetchval(query, *args, **kwargs)
+
+
+async def init_connection(conn):
+    conn.prepared = {
+        name: TimedStatement(name, await conn.prepare(sql)) for name, sql in PREPARED_QUERIES.items()
+    }
+
+
+class Database:
+    """Пул asyncpg с учётом ожидающих и занятых соединений."""
+
+    def __init__(self, pool, acquire_timeout=DB_ACQUIRE_TIMEOUT):
+        self.pool = pool
+        self.acquire_timeout = acquire_timeout
+        self.waiting = 0
+        self.max_waiting = 0
+        self.acquire_timeouts = 0
+
+    @asynccontextmanager
+    async def acquire(self):
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        started = time.perf_counter()
+        try:
+            conn = await self.pool.acquire(timeout=self.acquire_timeout)
+        except asyncio.TimeoutError:
+            self.acquire_timeouts += 1
+            raise
+        finally:
+            self.waiting -= 1
+            bot.stats.wait((time.perf_counter() - started) * 1000)
+        try:
+            yield conn
+        finally:
+            await self.pool.release(conn)
+
+    def health(self):
+        size = self.pool.get_size()
+        idle = self.pool.get_idle_size()
+        return {
+            "size": size,
+            "idle": idle,
+            "in_use": size - idle,
+            "min_size": self.pool.get_min_size(),
+            "max_size": self.pool.get_max_size(),
+            "waiting": self.waiting,
+            "max_waiting": self.max_waiting,
+            "acquire_timeouts": self.acquire_timeouts,
+        }
+
+    def is_closed(self):
+        return self.pool.is_closing()
+
+    async def close(self):
+        await self.pool.close()
+
+
 async def create_db_pool():
+    # Миграции идут на отдельном соединении до создания пула: init пула готовит
+    # запросы к таблицам и колонкам, которых без миграций ещё нет. Без command_timeout:
+    # перенос данных на большой базе может идти дольше обычного запроса
+    conn = await asyncpg.connect(DATABASE_URL)
     try:
-        pool = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=5)
-        async with pool.acquire() as conn:
-            # Таблица пользователей
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id BIGINT PRIMARY KEY,
-                    balance INTEGER DEFAULT 0,
-                    profile_description TEXT
-                )
-            """)
-            # Таблица кастомных ролей
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS custom_roles (
-                    user_id BIGINT PRIMARY KEY,
-                    role_id BIGINT,
-                    role_name TEXT,
-                    role_color TEXT
+        await run_migrations(conn)
+    finally:
+        await conn.close()
+
+    pool = await asyncpg.create_pool(
+        DATABASE_URL,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        command_timeout=DB_COMMAND_TIMEOUT,
+        connection_class=BotConnection,
+        init=init_connection,
+    )
+    return Database(pool)
+
+def balance_changed(guild_id: int, user_id: int, balance: int, amount: int, reason: str, counterparty: int = None):
+    # Вызывается после каждого изменения баланса с его новым значением
+    bot.top_users.update(guild_id, user_id, balance)
+    bot.profiles.update((guild_id, user_id), balance=balance)
+    if amount:
+        bot.ledger.record(guild_id, user_id, amount, balance, reason, counterparty)
+
+@asynccontextmanager
+async def external_balance_write():
+    # Для запросов, меняющих users.balance мимо API балансов. Отдаёт функцию
+    # (guild_id, user_id, баланс из БД) -> актуальный баланс с учётом кэша балансов
+    if bot.balance_cache:
+        async with bot.balance_cache.external_write() as merge:
+            yield merge
+    else:
+        yield lambda guild_id, user_id, balance: balance
+
+def clan_changed(guild_id: int, user_id: int):
+    # Вызывается после вступления в клан или выхода из него. Состав и суммы
+    # кланов меняют триггеры в БД, топы кланов перечитаются при следующем запросе
+    bot.profiles.invalidate((guild_id, user_id))
+    for boards in bot.top_clans.values():
+        boards.invalidate(guild_id)
+
+async def get_balance(guild_id: int, user_id: int):
+    if bot.balance_cache:
+        return await bot.balance_cache.get(guild_id, user_id)
+    async with bot.db.acquire() as conn:
+        return await conn.prepared["get_balance"].fetchval(guild_id, user_id) or 0
+
+async def update_balance(guild_id: int, user_id: int, amount: int, reason: str, counterparty: int = None) -> int:
+    # Безусловное начисление/списание, возвращает новый баланс
+    if bot.balance_cache:
+        balance = await bot.balance_cache.add(guild_id, user_id, amount)
+    else:
+        async with bot.db.acquire() as conn:
+            balance = await conn.prepared["update_balance"].fetchval(guild_id, user_id, amount)
+    balance_changed(guild_id, user_id, balance, amount, reason, counterparty)
+    return balance
+
+async def change_balance(guild_id: int, user_id: int, amount: int, required: int, reason: str,
+                         counterparty: int = None):
+    # Меняет баланс на amount, только если на счету не меньше required.
+    # Возвращает (успех, баланс после операции или текущий баланс при отказе)
+    if bot.balance_cache:
+        success, balance = await bot.balance_cache.change(guild_id, user_id, amount, required)
+    else:
+        async with bot.db.acquire() as conn:
+            result = await conn.fetchrow("""
+                WITH current AS (
+                    SELECT balance FROM users WHERE guild_id = $1 AND user_id = $2
+                ), changed AS (
+                    UPDATE users SET balance = balance + $3
+                    WHERE guild_id = $1 AND user_id = $2 AND balance >= $4
+                    RETURNING balance
                 )
-            """)
-            # Таблица кланов
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS clans (
-                    name TEXT PRIMARY KEY,
-                    owner_id BIGINT,
-                    balance INTEGER DEFAULT 0
+                SELECT (SELECT balance FROM changed) AS new_balance,
+                       (SELECT balance FROM current) AS old_balance
+            """, guild_id, user_id, amount, required)
+        success = result["new_balance"] is not None
+        balance = result["new_balance"] if success else result["old_balance"] or 0
+    if success and amount:
+        balance_changed(guild_id, user_id, balance, amount, reason, counterparty)
+    return success, balance
+
+async def withdraw_balance(guild_id: int, user_id: int, amount: int, reason: str, counterparty: int = None):
+    # Списание только при достаточном балансе
+    return await change_balance(guild_id, user_id, -amount, amount, reason, counterparty)
+
+async def take_balance(guild_id: int, user_id: int, amount: int, reason: str):
+    # Списывает до amount кредитов, не уводя баланс в минус. Возвращает (списано, баланс)
+    if bot.balance_cache:
+        taken, balance = await bot.balance_cache.take(guild_id, user_id, amount)
+    else:
+        async with bot.db.acquire() as conn:
+            result = await conn.fetchrow("""
+                WITH current AS (
+                    SELECT balance FROM users WHERE guild_id = $1 AND user_id = $2 FOR UPDATE
                 )
-            """)
-            # Таблица связи пользователей и кланов
+                UPDATE users SET balance = users.balance - LEAST($3, GREATEST(current.balance, 0))
+                FROM current
+                WHERE users.guild_id = $1 AND users.user_id = $2
+                RETURNING current.balance - users.balance AS taken, users.balance
+            """, guild_id, user_id, amount)
+        taken, balance = (result["taken"], result["balance"]) if result else (0, 0)
+    if taken:
+        balance_changed(guild_id, user_id, balance, -taken, reason)
+    return taken, balance
+
+async def transfer_balance(guild_id: int, sender_id: int, receiver_id: int, amount: int):
+    # Перевод одной транзакцией. Возвращает (баланс отправителя, баланс получателя) или None
+    if bot.balance_cache:
+        result = await bot.balance_cache.transfer(guild_id, sender_id, receiver_id, amount)
+    else:
+        async with bot.db.acquire() as conn, conn.transaction():
+            # Строки блокируются по возрастанию user_id: встречные переводы A→B и B→A
+            # ждут друг друга, а не ловят взаимную блокировку
             await conn.execute("""
-                CREATE TABLE IF NOT EXISTS user_clans (
-                    user_id BIGINT PRIMARY KEY,
-                    clan_name TEXT
+                SELECT 1 FROM users WHERE guild_id = $1 AND user_id = ANY($2::bigint[])
+                ORDER BY user_id FOR UPDATE
+            """, guild_id, [sender_id, receiver_id])
+            row = await conn.fetchrow("""
+                WITH debit AS (
+                    UPDATE users SET balance = balance - $4
+                    WHERE guild_id = $1 AND user_id = $2 AND balance >= $4
+                    RETURNING balance
+                ), credit AS (
+                    INSERT INTO users (guild_id, user_id, balance) SELECT $1, $3, $4 FROM debit
+                    ON CONFLICT (guild_id, user_id) DO UPDATE SET balance = users.balance + EXCLUDED.balance
+                    RETURNING balance
                 )
-            """)
-        return pool
-    except Exception as e:
-        print(f"❌ Ошибка базы данных: {e}")
-        exit(1)
-
-async def get_balance(user_id: int):
+                SELECT (SELECT balance FROM debit) AS sender, (SELECT balance FROM credit) AS receiver
+            """, guild_id, sender_id, receiver_id, amount)
+        result = None if row["sender"] is None else (row["sender"], row["receiver"])
+    if result:
+        balance_changed(guild_id, sender_id, result[0], -amount, "transfer", receiver_id)
+        balance_changed(guild_id, receiver_id, result[1], amount, "transfer", sender_id)
+    return result
+
+async def bulk_change_balance(guild_id: int, user_ids, amount: int, reason: str, counterparty: int = None,
+                              dry_run: bool = False):
+    # Одинаковое начисление/списание для многих пользователей одним запросом.
+    # Списание пропускает тех, у кого не хватает кредитов. Возвращает (затронуто, пропущено)
+    user_ids = list(dict.fromkeys(user_ids))
+    if amount > 0 and dry_run:
+        return len(user_ids), 0
+
+    async with external_balance_write() as merge:
+        async with bot.db.acquire() as conn:
+            if amount > 0:
+                rows = await conn.fetch("""
+                    INSERT INTO users (guild_id, user_id, balance) SELECT $1, unnest($2::bigint[]), $3
+                    ON CONFLICT (guild_id, user_id) DO UPDATE SET balance = users.balance + EXCLUDED.balance
+                    RETURNING user_id, balance
+                """, guild_id, user_ids, amount)
+            else:
+                # Баланс в БД может отставать от кэша на несброшенные дельты
+                pending = (bot.balance_cache.pending(guild_id, user_ids) if bot.balance_cache
+                           else [0] * len(user_ids))
+                if dry_run:
+                    affected = await conn.fetchval("""
+                        SELECT count(*) FROM users u
+                        JOIN unnest($2::bigint[], $3::int[]) AS t(user_id, pending) USING (user_id)
+                        WHERE u.guild_id = $1 AND u.balance + t.pending >= $4
+                    """, guild_id, user_ids, pending, -amount)
+                    return affected, len(user_ids) - affected
+                rows = await conn.fetch("""
+                    UPDATE users u SET balance = u.balance - $4
+                    FROM unnest($2::bigint[], $3::int[]) AS t(user_id, pending)
+                    WHERE u.guild_id = $1 AND u.user_id = t.user_id AND u.balance + t.pending >= $4
+                    RETURNING u.user_id, u.balance
+                """, guild_id, user_ids, pending, -amount)
+        balances = {row["user_id"]: merge(guild_id, row["user_id"], row["balance"]) for row in rows}
+
+    for user_id, balance in balances.items():
+        balance_changed(guild_id, user_id, balance, amount, reason, counterparty)
+    return len(balances), len(user_ids) - len(balances)
+
+async def get_custom_role(guild_id: int, user_id: int):
     async with bot.db.acquire() as conn:
-        result = await conn.fetchrow("SELECT balance FROM users WHERE user_id = $1", user_id)
-        return result["balance"] if result else 0
+        return await conn.fetchrow(
+            "SELECT * FROM custom_roles WHERE guild_id = $1 AND user_id = $2", guild_id, user_id
+        )
 
-async def update_balance(user_id: int, amount: int):
+async def create_custom_role(guild_id: int, user_id: int, role_id: int, role_name: str, role_color: str):
+    # Возвращает role_id предыдущей кастомной роли (если была)
     async with bot.db.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO users (user_id, balance) VALUES ($1, $2)
-            ON CONFLICT (user_id) DO UPDATE SET balance = users.balance + $2
-        """, user_id, amount)
-
-async def get_custom_role(user_id: int):
+        return await conn.fetchval("""
+            INSERT INTO custom_roles (guild_id, user_id, role_id, role_name, role_color)
+            VALUES ($1, $2, $3, $4, $5)
+            ON CONFLICT (guild_id, user_id) DO UPDATE SET
+            role_id = $3, role_name = $4, role_color = $5
+            RETURNING (SELECT role_id FROM custom_roles WHERE guild_id = $1 AND user_id = $2)
+        """, guild_id, user_id, role_id, role_name, role_color)
+
+async def create_clan_for(guild_id: int, user_id: int, clan_name: str, price: int):
+    # Проверка, списание и создание клана одним запросом.
+    # Возвращает (ошибка или None, баланс)
+    if bot.balance_cache:
+        error, balance = await _create_clan_cached(guild_id, user_id, clan_name, price)
+    else:
+        error, balance = await _create_clan_db(guild_id, user_id, clan_name, price)
+    if not error:
+        balance_changed(guild_id, user_id, balance, -price, "clan")
+        clan_changed(guild_id, user_id)
+    return error, balance
+
+async def _create_clan_db(guild_id: int, user_id: int, clan_name: str, price: int):
     async with bot.db.acquire() as conn:
-        return await conn.fetchrow("SELECT * FROM custom_roles WHERE user_id = $1", user_id)
-
-async def create_custom_role(user_id: int, role_id: int, role_name: str, role_color: str):
+        try:
+            result = await conn.fetchrow("""
+                WITH state AS (
+                    SELECT COALESCE((SELECT balance FROM users WHERE guild_id = $1 AND user_id = $3), 0) AS balance,
+                           EXISTS(SELECT 1 FROM user_clans WHERE guild_id = $1 AND user_id = $3) AS in_clan,
+                           EXISTS(SELECT 1 FROM clans WHERE guild_id = $1 AND name = $2) AS clan_exists
+                ), debit AS (
+                    UPDATE users SET balance = users.balance - $4
+                    FROM state
+                    WHERE users.guild_id = $1 AND users.user_id = $3 AND users.balance >= $4
+                      AND NOT state.in_clan AND NOT state.clan_exists
+                    RETURNING users.balance
+                ), clan AS (
+                    -- Триггеры увидят и списание, и вступление этого же запроса, и
+                    -- списание попадёт в member_balance дважды: стартовое значение его компенсирует
+                    INSERT INTO clans (guild_id, name, owner_id, balance, member_balance)
+                    SELECT $1, $2, $3, 0, $4 FROM debit
+                    RETURNING name
+                ), member AS (
+                    INSERT INTO user_clans (guild_id, user_id, clan_name) SELECT $1, $3, name FROM clan
+                )
+                SELECT state.balance, state.in_clan, state.clan_exists,
+                       (SELECT balance FROM debit) AS new_balance
+                FROM state
+            """, guild_id, clan_name, user_id, price)
+        except asyncpg.UniqueViolationError as e:
+            # Параллельное создание клана с тем же именем или параллельное вступление.
+            # Ошибку поднимает раздел таблицы: user_clans_p3 и т. п.
+            return ("in_clan" if e.table_name.startswith("user_clans") else "clan_exists"), None
+    if result["in_clan"]:
+        return "in_clan", result["balance"]
+    if result["clan_exists"]:
+        return "clan_exists", result["balance"]
+    if result["new_balance"] is None:
+        return "no_funds", result["balance"]
+    return None, result["new_balance"]
+
+async def _create_clan_cached(guild_id: int, user_id: int, clan_name: str, price: int):
+    # С кэшем балансов деньги резервируются в памяти, а в БД уходит только сам клан
+    success, balance = await bot.balance_cache.change(guild_id, user_id, -price, price)
+    if not success:
+        return "no_funds", balance
+
+    error = None
     async with bot.db.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO custom_roles (user_id, role_id, role_name, role_color)
-            VALUES ($1, $2, $3, $4)
-            ON CONFLICT (user_id) DO UPDATE SET
-            role_id = $2, role_name = $3, role_color = $4
-        """, user_id, role_id, role_name, role_color)
+        try:
+            result = await conn.fetchrow("""
+                WITH state AS (
+                    SELECT EXISTS(SELECT 1 FROM user_clans WHERE guild_id = $1 AND user_id = $3) AS in_clan,
+                           EXISTS(SELECT 1 FROM clans WHERE guild_id = $1 AND name = $2) AS clan_exists
+                ), clan AS (
+                    INSERT INTO clans (guild_id, name, owner_id, balance)
+                    SELECT $1, $2, $3, 0 FROM state WHERE NOT state.in_clan AND NOT state.clan_exists
+                    RETURNING name
+                ), member AS (
+                    INSERT INTO user_clans (guild_id, user_id, clan_name) SELECT $1, $3, name FROM clan
+                )
+                SELECT in_clan, clan_exists FROM state
+            """, guild_id, clan_name, user_id)
+            if result["in_clan"]:
+                error = "in_clan"
+            elif result["clan_exists"]:
+                error = "clan_exists"
+        except asyncpg.UniqueViolationError as e:
+            error = "in_clan" if e.table_name.startswith("user_clans") else "clan_exists"
+
+    if error:
+        balance = await bot.balance_cache.add(guild_id, user_id, price)
+    return error, balance
+
+async def get_user_clan(guild_id: int, user_id: int):
+    async with bot.db.acquire() as conn:
+        return await conn.prepared["get_user_clan"].fetchval(guild_id, user_id)
 
-async def get_user_clan(user_id: int):
+async def join_clan(guild_id: int, user_id: int, clan_name: str):
+    # Вступление в существующий клан. Возвращает ошибку или None.
+    # Строка клана блокируется до вставки: роспуск клана в leave_clan дождётся
+    # вступления, а вступление после роспуска не найдёт клан
+    async with bot.db.acquire() as conn:
+        try:
+            joined = await conn.fetchval("""
+                INSERT INTO user_clans (guild_id, user_id, clan_name)
+                SELECT guild_id, $2, name FROM clans WHERE guild_id = $1 AND name = $3
+                FOR NO KEY UPDATE
+                RETURNING clan_name
+            """, guild_id, user_id, clan_name)
+        except asyncpg.UniqueViolationError:
+            return "in_clan"
+    if joined is None:
+        return "no_clan"
+    clan_changed(guild_id, user_id)
+    return None
+
+async def leave_clan(guild_id: int, user_id: int):
+    # Выход из клана. Лидер может выйти только последним, тогда клан распускается.
+    # Возвращает (ошибка или None, название клана, распущен ли клан)
     async with bot.db.acquire() as conn:
-        return await conn.fetchval("SELECT clan_name FROM user_clans WHERE user_id = $1", user_id)
+        async with conn.transaction():
+            clan = await conn.fetchrow("""
+                SELECT c.name, c.owner_id, c.member_count
+                FROM user_clans uc JOIN clans c ON c.guild_id = uc.guild_id AND c.name = uc.clan_name
+                WHERE uc.guild_id = $1 AND uc.user_id = $2
+                FOR UPDATE OF c
+            """, guild_id, user_id)
+            if clan is None:
+                return "not_in_clan", None, False
+            dissolve = clan["owner_id"] == user_id
+            if dissolve and clan["member_count"] > 1:
+                return "owner", clan["name"], False
+            await conn.execute("DELETE FROM user_clans WHERE guild_id = $1 AND user_id = $2", guild_id, user_id)
+            if dissolve:
+                await conn.execute("DELETE FROM clans WHERE guild_id = $1 AND name = $2", guild_id, clan["name"])
+    clan_changed(guild_id, user_id)
+    return None, clan["name"], dissolve
+
+async def get_clan_info(guild_id: int, clan_name: str = None, user_id: int = None):
+    # Клан по названию или клан пользователя; агрегаты уже посчитаны триггерами
+    async with bot.db.acquire() as conn:
+        return await conn.fetchrow("""
+            SELECT name, owner_id, balance, member_count, member_balance FROM clans
+            WHERE guild_id = $1
+              AND name = COALESCE($2, (SELECT clan_name FROM user_clans WHERE guild_id = $1 AND user_id = $3))
+        """, guild_id, clan_name, user_id)
 
-async def add_user_to_clan(user_id: int, clan_name: str):
+async def add_user_to_clan(guild_id: int, user_id: int, clan_name: str):
     async with bot.db.acquire() as conn:
         await conn.execute("""
-            INSERT INTO user_clans (user_id, clan_name) VALUES ($1, $2)
-            ON CONFLICT (user_id) DO UPDATE SET clan_name = $2
-        """, user_id, clan_name)
+            INSERT INTO user_clans (guild_id, user_id, clan_name) VALUES ($1, $2, $3)
+            ON CONFLICT (guild_id, user_id) DO UPDATE SET clan_name = $3
+        """, guild_id, user_id, clan_name)
+    clan_changed(guild_id, user_id)
+
+async def get_profile(guild_id: int, user_id: int):
+    # Повторные просмотры берутся из кэша профилей
+    return await bot.profiles.get((guild_id, user_id), load_profile)
 
-async def get_profile_description(user_id: int):
+async def load_profile(guild_id: int, user_id: int):
+    # Баланс, клан и описание одним запросом
+    async with bot.db.acquire() as conn:
+        row = await conn.prepared["get_profile"].fetchrow(guild_id, user_id)
+    profile = {
+        "balance": row["balance"] or 0,
+        "clan": row["clan_name"],
+        "description": row["profile_description"] or "Описание отсутствует",
+        "messages": row["messages"] or 0,
+    }
+    if bot.balance_cache:
+        # В БД может ещё не быть отложенных изменений баланса
+        profile["balance"] = await bot.balance_cache.get(guild_id, user_id)
+    return profile
+
+async def get_profile_description(guild_id: int, user_id: int):
     async with bot.db.acquire() as conn:
-        result = await conn.fetchrow("SELECT profile_description FROM users WHERE user_id = $1", user_id)
+        result = await conn.fetchrow(
+            "SELECT profile_description FROM users WHERE guild_id = $1 AND user_id = $2", guild_id, user_id
+        )
         return result["profile_description"] if result and result["profile_description"] else "Описание отсутствует"
 
-async def update_profile_description(user_id: int, description: str):
+async def update_profile_description(guild_id: int, user_id: int, description: str):
     async with bot.db.acquire() as conn:
         await conn.execute("""
-            INSERT INTO users (user_id, profile_description) VALUES ($1, $2)
-            ON CONFLICT (user_id) DO UPDATE SET profile_description = $2
-        """, user_id, description)
+            INSERT INTO users (guild_id, user_id, profile_description) VALUES ($1, $2, $3)
+            ON CONFLICT (guild_id, user_id) DO UPDATE SET profile_description = $3
+        """, guild_id, user_id, description)
+    bot.profiles.invalidate((guild_id, user_id))
 
-# ==================== ЭКОНОМИКА ====================
-class Economy(commands.Cog):
-    def __init__(self, bot):
-        self.bot = bot
+# ==================== КЭШ БАЛАНСОВ ====================
+class _BalanceEntry:
+    __slots__ = ("balance", "pending", "loaded_at")
 
-    def is_admin(self, member):
-        return any(role.name.lower() in [r.lower() for r in ADMIN_ROLES] for role in member.roles)
+    def __init__(self, balance: int, loaded_at: float):
+        self.balance = balance
+        self.pending = 0
+        self.loaded_at = loaded_at
 
-    @commands.command(name="славанн")
-    @commands.cooldown(1, 7200, commands.BucketType.user)
-    async def slav_party(self, ctx):
-        user = ctx.author
-        role = discord.utils.get(ctx.guild.roles, name=ROLE_NAME)
 
-        if not role:
-            await ctx.send('❌ Роль не найдена!')
-            return
+class BalanceCache:
+    """LRU-кэш балансов с отложенной пакетной записью изменений в users.
+    Ключ записи — (guild_id, user_id)."""
+
+    def __init__(self, bot, max_size=BALANCE_CACHE_SIZE, flush_interval_ms=BALANCE_FLUSH_INTERVAL_MS,
+                 flush_batch=BALANCE_FLUSH_BATCH, max_staleness=BALANCE_MAX_STALENESS):
+        self.bot = bot
+        self.max_size = max_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.flush_batch = flush_batch
+        self.max_staleness = max_staleness
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._inflight = {}
+        self._pins = {}
+        self._pending_count = 0
+        self._flush_lock = asyncio.Lock()
+        self._external_epoch = 0
+        self._wake = asyncio.Event()
+        self._closing = False
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        # Останавливаем цикл и гарантированно сбрасываем всё накопленное в БД.
+        # Без cancel(): отмена, совпавшая с таймаутом wait_for, может потеряться,
+        # и close() повиснет, а сброс посреди запроса не прервётся
+        if self._task:
+            self._closing = True
+            self._wake.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    async def _flush_loop(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"⚠ Ошибка сброса кэша балансов: {e}")
+
+    async def _entry(self, key: tuple) -> _BalanceEntry:
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry.loaded_at <= self.max_staleness:
+            self._entries.move_to_end(key)
+            return entry
+
+        # Один запрос в БД на ключ, даже если его ждут несколько команд
+        loading = self._loading.get(key)
+        if loading is None:
+            loading = asyncio.ensure_future(self._load(key))
+            self._loading[key] = loading
+            loading.add_done_callback(lambda _: self._loading.pop(key, None))
+        return await asyncio.shield(loading)
+
+    async def _load(self, key: tuple) -> _BalanceEntry:
+        entry = self._entries.get(key)
+        if entry is not None and entry.pending:
+            return await self._resync(key, entry)
+
+        started = time.monotonic()
+        epoch = self._external_epoch
+        async with self.bot.db.acquire() as conn:
+            balance = await conn.prepared["get_balance"].fetchval(*key) or 0
+        # Если параллельно прошла внешняя запись, прочитанное могло устареть:
+        # отдаём его, но при следующем обращении запись перечитается
+        loaded_at = time.monotonic() if epoch == self._external_epoch else float("-inf")
+
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = _BalanceEntry(balance, loaded_at)
+            self._entries[key] = entry
+            self._evict()
+        elif entry.loaded_at < started:
+            # Пока шёл запрос, могли прийти новые дельты. Если за это время
+            # запись обновил сброс пакета, его значение свежее нашего
+            entry.balance = balance + entry.pending
+            entry.loaded_at = loaded_at
+            self._entries.move_to_end(key)
+        return entry
+
+    async def _resync(self, key: tuple, entry: _BalanceEntry) -> _BalanceEntry:
+        # Устаревшая запись с несброшенной дельтой: сбрасываем и перечитываем одним запросом.
+        # Под блокировкой сброса, чтобы не пересечься с пакетной записью
+        async with self._flush_lock:
+            if time.monotonic() - entry.loaded_at <= self.max_staleness:
+                return entry
+            sent, entry.pending = entry.pending, 0
+            self._inflight[key] = sent
+            try:
+                async with self.bot.db.acquire() as conn:
+                    balance = await conn.prepared["update_balance"].fetchval(*key, sent)
+            except BaseException:
+                entry.pending += sent
+                raise
+            finally:
+                del self._inflight[key]
+            entry.balance = balance + entry.pending
+            entry.loaded_at = time.monotonic()
+            self._entries.move_to_end(key)
+            return entry
+
+    def _evict(self):
+        # Вытесняем только чистые записи: несброшенные дельты терять нельзя.
+        # Закреплённые ждёт команда — дельта к вытесненной записи пропала бы
+        while len(self._entries) > self.max_size:
+            for key, entry in self._entries.items():
+                if not entry.pending and key not in self._inflight and key not in self._pins:
+                    del self._entries[key]
+                    break
+            else:
+                self._wake.set()
+                return
 
-        if role in user.roles:
-            await ctx.send(f'🟥 {user.mention}, ты уже Патриот!')
+    @contextmanager
+    def _pinned(self, *keys):
+        # Пока команда ждёт загрузки, запись не вытесняется и не выбрасывается:
+        # изменение применяется к той же записи, что лежит в кэше
+        for key in keys:
+            self._pins[key] = self._pins.get(key, 0) + 1
+        try:
+            yield
+        finally:
+            for key in keys:
+                if self._pins[key] == 1:
+                    del self._pins[key]
+                else:
+                    self._pins[key] -= 1
+
+    def _apply(self, key: tuple, entry: _BalanceEntry, amount: int):
+        if not amount:
             return
+        entry.balance += amount
+        entry.pending += amount
+        self._pending_count += 1
+        if self._pending_count >= self.flush_batch:
+            self._wake.set()
+
+    async def get(self, guild_id: int, user_id: int) -> int:
+        return (await self._entry((guild_id, user_id))).balance
+
+    async def add(self, guild_id: int, user_id: int, amount: int) -> int:
+        key = (guild_id, user_id)
+        with self._pinned(key):
+            entry = await self._entry(key)
+        self._apply(key, entry, amount)
+        return entry.balance
+
+    async def change(self, guild_id: int, user_id: int, amount: int, required: int):
+        key = (guild_id, user_id)
+        with self._pinned(key):
+            entry = await self._entry(key)
+        if entry.balance < required:
+            return False, entry.balance
+        self._apply(key, entry, amount)
+        return True, entry.balance
+
+    async def take(self, guild_id: int, user_id: int, amount: int):
+        key = (guild_id, user_id)
+        with self._pinned(key):
+            entry = await self._entry(key)
+        taken = min(amount, max(entry.balance, 0))
+        self._apply(key, entry, -taken)
+        return taken, entry.balance
+
+    async def transfer(self, guild_id: int, sender_id: int, receiver_id: int, amount: int):
+        sender_key, receiver_key = (guild_id, sender_id), (guild_id, receiver_id)
+        with self._pinned(sender_key, receiver_key):
+            receiver = await self._entry(receiver_key)
+            sender = await self._entry(sender_key)
+        if sender.balance < amount:
+            return None
+        self._apply(sender_key, sender, -amount)
+        self._apply(receiver_key, receiver, amount)
+        return sender.balance, receiver.balance
+
+    @asynccontextmanager
+    async def external_write(self):
+        # Запись балансов в users мимо кэша. Пока она идёт, пакетный сброс стоит,
+        # так что все несброшенные дельты — ровно pending записей. Отдаёт функцию,
+        # которая сводит баланс из БД с кэшем и возвращает итоговое значение
+        async with self._flush_lock:
+            self._external_epoch += 1
+            yield self._merge_external
+
+    def _merge_external(self, guild_id: int, user_id: int, db_balance: int) -> int:
+        entry = self._entries.get((guild_id, user_id))
+        if entry is None:
+            return db_balance
+        entry.balance = db_balance + entry.pending
+        entry.loaded_at = time.monotonic()
+        return entry.balance
+
+    def pending(self, guild_id: int, user_ids) -> list:
+        # Несброшенные дельты; внутри external_write это всё, чего ещё нет в БД
+        return [entry.pending if (entry := self._entries.get((guild_id, user_id))) else 0 for user_id in user_ids]
+
+    def forget_guilds(self, guild_ids=None):
+        # Балансы гильдий заменены снимком (None — всех). Чистые записи выбрасываются,
+        # записи с несброшенной дельтой перечитаются при следующем обращении, а
+        # идущие сейчас чтения отдадут старое значение только один раз
+        self._external_epoch += 1
+        for key, entry in list(self._entries.items()):
+            if guild_ids is not None and key[0] not in guild_ids:
+                continue
+            if entry.pending or key in self._inflight or key in self._pins:
+                entry.loaded_at = float("-inf")
+            else:
+                del self._entries[key]
+
+    async def flush(self):
+        async with self._flush_lock:
+            batch = {key: entry.pending for key, entry in self._entries.items() if entry.pending}
+            self._pending_count = 0
+            if not batch:
+                return
 
-        roll = random.randint(1, 100)
-        balance = await get_balance(user.id)
+            for key, delta in batch.items():
+                self._entries[key].pending = 0
+                self._inflight[key] = self._inflight.get(key, 0) + delta
 
-        if roll <= CRIT_CHANCE:
-            await user.add_roles(role)
-            await update_balance(user.id, 1000)
-            await ctx.send(f'💥 **КРИТ!** {user.mention}, ты получил роль + 1000 социального рейтинга! (Баланс: {await get_balance(user.id)})')
+            guild_ids, user_ids = zip(*batch)
+            try:
+                async with self.bot.db.acquire() as conn:
+                    rows = await conn.fetch("""
+                        INSERT INTO users (guild_id, user_id, balance)
+                        SELECT * FROM unnest($1::bigint[], $2::bigint[], $3::int[])
+                        ON CONFLICT (guild_id, user_id) DO UPDATE SET balance = users.balance + EXCLUDED.balance
+                        RETURNING guild_id, user_id, balance
+                    """, list(guild_ids), list(user_ids), list(batch.values()))
+            except BaseException:
+                # Возвращаем дельты, чтобы не потерять их при ошибке
+                for key, delta in batch.items():
+                    entry = self._entries.get(key)
+                    if entry is None:
+                        entry = _BalanceEntry(0, float("-inf"))
+                        self._entries[key] = entry
+                    entry.pending += delta
+                    self._pending_count += 1
+                raise
+            finally:
+                for key, delta in batch.items():
+                    self._inflight[key] -= delta
+                    if not self._inflight[key]:
+                        del self._inflight[key]
+
+            now = time.monotonic()
+            for row in rows:
+                entry = self._entries.get((row["guild_id"], row["user_id"]))
+                if entry is not None:
+                    entry.balance = row["balance"] + entry.pending
+                    entry.loaded_at = now
+
+# ==================== ЖУРНАЛ ОПЕРАЦИЙ ====================
+# Подписи причин для !история
+LEDGER_REASONS = {
+    "patriot": "🔴 Славанн",
+    "farm": "🌾 Фарм",
+    "daily": "🎁 Ежедневная награда",
+    "roulette": "🎰 Рулетка",
+    "transfer": "💸 Перевод",
+    "admin": "⚙️ Администратор",
+    "buy_role": "🎨 Покупка роли",
+    "refund": "↩️ Возврат",
+    "clan": "👥 Создание клана",
+    "activity": "💬 Активность",
+}
+
+class LedgerWriter:
+    """Журнал изменений балансов. Записи копятся в памяти и вставляются пачкой,
+    команды не ждут БД. Месячные разделы ledger создаются по мере надобности."""
+
+    def __init__(self, bot, flush_interval_ms=LEDGER_FLUSH_INTERVAL_MS,
+                 flush_batch=LEDGER_FLUSH_BATCH, max_buffer=LEDGER_MAX_BUFFER):
+        self.bot = bot
+        self.flush_interval = flush_interval_ms / 1000
+        self.flush_batch = flush_batch
+        self.max_buffer = max_buffer
+        self._buffer = []
+        self._partitions = set()
+        self._flush_lock = asyncio.Lock()
+        self._wake = asyncio.Event()
+        self._task = None
+        self.dropped = 0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
 
-        elif roll <= SUCCESS_CHANCE:
-            await user.add_roles(role)
-            await update_balance(user.id, 100)
-            await ctx.send(f'🟥 {user.mention}, ты получил роль + 100 рейтинга! (Баланс: {await get_balance(user.id)})')
+    def record(self, guild_id: int, user_id: int, amount: int, balance: int, reason: str, counterparty: int = None):
+        self._buffer.append((guild_id, user_id, amount, balance, reason, counterparty, datetime.now(timezone.utc)))
+        if len(self._buffer) >= self.flush_batch:
+            self._wake.set()
 
-        else:
-            penalty = min(10, balance)
-            await update_balance(user.id, -penalty)
-            await ctx.send(f'🕊 {user.mention}, -{penalty} рейтинга. Попробуй ещё! (Баланс: {await get_balance(user.id)})')
-
-    @commands.command(name="фарм")
-    @commands.cooldown(1, 1200, commands.BucketType.user)
-    async def farm(self, ctx):
-        user = ctx.author
-        role = discord.utils.get(ctx.guild.roles, name=ROLE_NAME)
-
-        if not role or role not in user.roles:
-            await ctx.send("⛔ Эта команда доступна только для Патриотов.")
-            return
+    def pending(self) -> int:
+        return len(self._buffer)
 
-        reward = random.randint(30, 70)
-        await update_balance(user.id, reward)
-        await ctx.send(f"🌾 {user.mention}, вы заработали {reward} соц. кредитов! (Баланс: {await get_balance(user.id)})")
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"⚠ Ошибка записи журнала операций: {e}")
+
+    async def _ensure_partitions(self, conn, batch):
+        months = {(record[6].year, record[6].month) for record in batch} - self._partitions
+        for year, month in sorted(months):
+            start = datetime(year, month, 1, tzinfo=timezone.utc)
+            end = datetime(year + month // 12, month % 12 + 1, 1, tzinfo=timezone.utc)
+            await conn.execute(
+                f"CREATE TABLE IF NOT EXISTS ledger_{year}_{month:02d} PARTITION OF ledger "
+                f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+            )
+            self._partitions.add((year, month))
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._buffer:
+                return
+            batch, self._buffer = self._buffer, []
+            try:
+                async with self.bot.db.acquire() as conn:
+                    await self._ensure_partitions(conn, batch)
+                    await conn.execute("""
+                        INSERT INTO ledger (guild_id, user_id, amount, balance, reason, counterparty, created_at)
+                        SELECT * FROM unnest($1::bigint[], $2::bigint[], $3::int[], $4::int[], $5::text[],
+                                             $6::bigint[], $7::timestamptz[])
+                    """, *(list(column) for column in zip(*batch)))
+            except BaseException:
+                # Возвращаем записи в начало буфера; при долгой недоступности БД
+                # отбрасываем самые старые, чтобы не съесть всю память
+                self._buffer[:0] = batch
+                overflow = len(self._buffer) - self.max_buffer
+                if overflow > 0:
+                    del self._buffer[:overflow]
+                    self.dropped += overflow
+                    print(f"⚠ Журнал операций переполнен, отброшено записей: {overflow}")
+                raise
+
+async def load_history(guild_id: int, user_id: int, before=None, limit: int = HISTORY_PAGE_SIZE):
+    # Страница истории от новых к старым; before — (created_at, id) последней показанной записи
+    async with bot.db.acquire() as conn:
+        if before is None:
+            return await conn.fetch("""
+                SELECT id, amount, balance, reason, counterparty, created_at FROM ledger
+                WHERE guild_id = $1 AND user_id = $2
+                ORDER BY created_at DESC, id DESC LIMIT $3
+            """, guild_id, user_id, limit)
+        return await conn.fetch("""
+            SELECT id, amount, balance, reason, counterparty, created_at FROM ledger
+            WHERE guild_id = $1 AND user_id = $2 AND (created_at, id) < ($3, $4)
+            ORDER BY created_at DESC, id DESC LIMIT $5
+        """, guild_id, user_id, before[0], before[1], limit)
+
+class HistoryView(discord.ui.View):
+    """Кнопки листания !история. Курсор начала каждой открытой страницы
+    хранится в стеке, поэтому назад листается тем же keyset-запросом."""
+
+    def __init__(self, author_id: int, member):
+        super().__init__(timeout=180)
+        self.author_id = author_id
+        self.member = member
+        self.cursors = [None]
+        self.rows = []
+        self.message = None
+
+    async def load(self):
+        rows = await load_history(self.member.guild.id, self.member.id, self.cursors[-1], HISTORY_PAGE_SIZE + 1)
+        self.rows = rows[:HISTORY_PAGE_SIZE]
+        self.previous_page.disabled = len(self.cursors) == 1
+        self.next_page.disabled = len(rows) <= HISTORY_PAGE_SIZE
+
+    def embed(self):
+        lines = []
+        for row in self.rows:
+            line = (f"<t:{int(row['created_at'].timestamp())}:f> {LEDGER_REASONS.get(row['reason'], row['reason'])} "
+                    f"**{row['amount']:+}** → {row['balance']}")
+            if row["counterparty"]:
+                line += f" (<@{row['counterparty']}>)"
+            lines.append(line)
+        embed = discord.Embed(
+            title=f"📜 История {self.member.name}",
+            description="\n".join(lines) or "Операций пока нет",
+            color=discord.Color.blue()
+        )
+        embed.set_footer(text=f"Страница {len(self.cursors)}")
+        return embed
+
+    async def interaction_check(self, interaction):
+        if interaction.user.id != self.author_id:
+            await interaction.response.send_message("❌ Листать может только тот, кто вызвал команду", ephemeral=True)
+            return False
+        return True
 
-    @commands.command(name="баланс")
-    @commands.cooldown(1, 5, commands.BucketType.user)
-    async def balance(self, ctx):
-        bal = await get_balance(ctx.author.id)
-        await ctx.send(f'💰 {ctx.author.mention}, ваш баланс: {bal}')
+    async def on_timeout(self):
+        if self.message:
+            try:
+                await self.message.edit(view=None)
+            except discord.HTTPException:
+                pass
 
-    @commands.command(name="перевести")
-    async def transfer(self, ctx, member: discord.Member, amount: int):
-        if amount <= 0:
-            await ctx.send("❌ Сумма должна быть положительной!")
+    @discord.ui.button(label="◀", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction, button):
+        self.cursors.pop()
+        await self.load()
+        await interaction.response.edit_message(embed=self.embed(), view=self)
+
+    @discord.ui.button(label="▶", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction, button):
+        last = self.rows[-1]
+        self.cursors.append((last["created_at"], last["id"]))
+        await self.load()
+        await interaction.response.edit_message(embed=self.embed(), view=self)
+
+bot.ledger = LedgerWriter(bot)
+
+# ==================== ЛИДЕРБОРДЫ ====================
+class Leaderboard:
+    """Топ-K в памяти: обновляется по мере изменения значений и перечитывается
+    из БД только по TTL или когда в памяти не хватает строк.
+
+    Порядок везде (значение DESC, ключ DESC), чтобы страницы за пределами памяти
+    дочитывались из БД по ключу (keyset) через индекс на (значение, ключ)."""
+
+    def __init__(self, loader, page_loader=None, rank_loader=None, size=LEADERBOARD_SIZE, ttl=LEADERBOARD_TTL):
+        self.loader = loader
+        self.page_loader = page_loader
+        self.rank_loader = rank_loader
+        self.size = size
+        self.ttl = ttl
+        self.version = 0
+        self._values = None
+        self._order = []
+        self._complete = False
+        self._loaded_at = 0.0
+        self._lock = asyncio.Lock()
+        self._rendered = {}
+        self._cursors = {}
+
+    def _fresh(self, limit: int) -> bool:
+        return (self._values is not None
+                and time.monotonic() - self._loaded_at <= self.ttl
+                and (self._complete or len(self._order) >= limit))
+
+    async def top(self, limit: int):
+        if not self._fresh(limit):
+            async with self._lock:
+                if not self._fresh(limit):
+                    self._set(await self.loader(self.size))
+        return [(key, value) for value, key in reversed(self._order[-limit:])] if limit else []
+
+    def _set(self, rows):
+        self._values = {key: value for key, value in rows}
+        self._order = sorted((value, key) for key, value in rows)
+        # Если строк меньше, чем просили, в памяти вся таблица
+        self._complete = len(rows) < self.size
+        self._loaded_at = time.monotonic()
+        self._cursors.clear()
+        self.version += 1
+
+    def update(self, key, value: int):
+        if self._values is None:
             return
-        if member == ctx.author:
-            await ctx.send("❌ Нельзя переводить самому себе!")
+        old = self._values.get(key)
+        if old == value:
             return
 
-        sender_balance = await get_balance(ctx.author.id)
-        if sender_balance < amount:
-            await ctx.send("❌ Недостаточно средств!")
+        if old is not None:
+            del self._order[bisect_left(self._order, (old, key))]
+            del self._values[key]
+
+        # За пределами памяти нет значений выше нижней строки, так что вставлять
+        # можно всё, что не ниже неё. Выпавшие вниз строки просто сокращают топ
+        if self._complete or (self._order and (value, key) > self._order[0]):
+            insort(self._order, (value, key))
+            self._values[key] = value
+            if len(self._order) > self.size:
+                _, dropped = self._order.pop(0)
+                del self._values[dropped]
+                self._complete = False
+        elif old is None:
             return
+        elif not self._order:
+            self._values = None
+        self.version += 1
+
+    def invalidate(self):
+        self._values = None
+
+    async def page(self, number: int, per_page: int):
+        start = (number - 1) * per_page
+        if start + per_page <= self.size or self.page_loader is None:
+            rows = await self.top(min(start + per_page, self.size))
+            return rows[start:start + per_page]
+
+        # Ищем ближайшую известную границу выше нужной страницы: нижнюю строку
+        # памяти или курсор ранее прочитанной страницы, и читаем от неё по индексу
+        rows = await self.top(self.size)
+        anchor_index, anchor = len(rows), (rows[-1][1], rows[-1][0]) if rows else None
+        if self._complete:
+            return []
+        for index, cursor in self._cursors.items():
+            if anchor_index < index <= start:
+                anchor_index, anchor = index, cursor
+
+        rows = await self.page_loader(anchor, start - anchor_index, per_page)
+        if rows:
+            self._cursors[start + len(rows)] = (rows[-1][1], rows[-1][0])
+        return rows
+
+    async def rank(self, key, value: int) -> int:
+        if self._values is not None and self._values.get(key) == value:
+            return len(self._order) - bisect_left(self._order, (value, key))
+        return await self.rank_loader(key, value)
+
+    async def render(self, build, number: int = 1, per_page: int = 10):
+        # Готовый текст страниц из памяти переиспользуется, пока таблица не изменилась
+        rows = await self.page(number, per_page)
+        if number * per_page > self.size:
+            return await build(rows, (number - 1) * per_page)
+        version = self.version
+        cached = self._rendered.get((number, per_page))
+        if cached and cached[0] == version:
+            return cached[1]
+        text = await build(rows, (number - 1) * per_page)
+        self._rendered[(number, per_page)] = (version, text)
+        return text
+
+
+class GuildBoards:
+    """Лидерборды по гильдиям: у каждой гильдии свой топ, он создаётся при первом
+    запросе. Изменения гильдий, чей топ ещё не смотрели, просто пропускаются."""
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._boards = {}
+
+    def get(self, guild_id: int) -> Leaderboard:
+        board = self._boards.get(guild_id)
+        if board is None:
+            board = self._boards[guild_id] = self.factory(guild_id)
+        return board
+
+    def update(self, guild_id: int, key, value: int):
+        board = self._boards.get(guild_id)
+        if board is not None:
+            board.update(key, value)
+
+    def invalidate(self, guild_id: int):
+        board = self._boards.get(guild_id)
+        if board is not None:
+            board.invalidate()
+
+    def forget(self, guild_id: int):
+        self._boards.pop(guild_id, None)
+
+    def clear(self):
+        self._boards.clear()
+
+    def __len__(self):
+        return len(self._boards)
+
+
+class NameResolver:
+    """Имена пользователей: кэш участников, затем TTL-кэш, затем один запрос к API."""
+
+    def __init__(self, bot, ttl=NAME_CACHE_TTL, max_size=NAME_CACHE_SIZE):
+        self.bot = bot
+        self.ttl = ttl
+        self.max_size = max_size
+        self._names = OrderedDict()
+        self._fetching = {}
+
+    def _store(self, user_id: int, name):
+        self._names[user_id] = (name, time.monotonic() + self.ttl)
+        self._names.move_to_end(user_id)
+        while len(self._names) > self.max_size:
+            self._names.popitem(last=False)
+        return name
+
+    async def resolve(self, user_ids, guild=None):
+        names = {}
+        missing = []
+        now = time.monotonic()
+        for user_id in user_ids:
+            cached = self._names.get(user_id)
+            if cached and cached[1] > now:
+                names[user_id] = cached[0]
+                continue
+            user = (guild.get_member(user_id) if guild else None) or self.bot.get_user(user_id)
+            if user:
+                names[user_id] = self._store(user_id, user.name)
+            else:
+                missing.append(user_id)
+
+        if missing:
+            fetched = await asyncio.gather(*(self._fetch(user_id) for user_id in missing))
+            names.update(zip(missing, fetched))
+        return names
+
+    async def _fetch(self, user_id: int):
+        # Одновременные запросы одного и того же имени объединяются
+        task = self._fetching.get(user_id)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch_user(user_id))
+            self._fetching[user_id] = task
+            task.add_done_callback(lambda _: self._fetching.pop(user_id, None))
+        return await asyncio.shield(task)
+
+    async def _fetch_user(self, user_id: int):
+        try:
+            user = await self.bot.fetch_user(user_id)
+        except discord.NotFound:
+            return self._store(user_id, None)
+        except discord.HTTPException as e:
+            print(f"⚠ Не удалось получить пользователя {user_id}: {e}")
+            return None
+        return self._store(user_id, user.name)
+
+
+async def load_top_users(guild_id: int, limit: int):
+    if bot.balance_cache:
+        # Отложенные изменения должны попасть в БД до чтения топа
+        await bot.balance_cache.flush()
+    async with bot.db.acquire() as conn:
+        rows = await conn.fetch("""
+            SELECT user_id, balance FROM users WHERE guild_id = $1
+            ORDER BY balance DESC, user_id DESC LIMIT $2
+        """, guild_id, limit)
+    return [(row["user_id"], row["balance"]) for row in rows]
+
+async def load_users_page(guild_id: int, after, offset: int, limit: int):
+    # after — (баланс, user_id) последней строки перед страницей
+    async with bot.db.acquire() as conn:
+        rows = await conn.fetch("""
+            SELECT user_id, balance FROM users
+            WHERE guild_id = $1 AND (balance, user_id) < ($2, $3)
+            ORDER BY balance DESC, user_id DESC
+            OFFSET $4 LIMIT $5
+        """, guild_id, after[0], after[1], offset, limit)
+    return [(row["user_id"], row["balance"]) for row in rows]
+
+async def load_user_rank(guild_id: int, user_id: int, balance: int) -> int:
+    async with bot.db.acquire() as conn:
+        return await conn.fetchval(
+            "SELECT count(*) + 1 FROM users WHERE guild_id = $1 AND (balance, user_id) > ($2, $3)",
+            guild_id, balance, user_id
+        )
 
-        await update_balance(ctx.author.id, -amount)
-        await update_balance(member.id, amount)
-        await ctx.send(f'✅ {ctx.author.mention} перевел {amount} рейтинга {member.mention}!')
+# Сортировки !клантоп: колонка clans (у каждой свой индекс) и подпись значения
+CLAN_SORTS = {
+    "казна": ("balance", "кредитов в казне"),
+    "участники": ("member_count", "участников"),
+    "богатство": ("member_balance", "кредитов у участников"),
+}
 
-    @commands.command(name="топ")
-    @commands.cooldown(1, 5, commands.BucketType.user)
-    async def top(self, ctx):
+def clan_loader(column: str):
+    async def load_top_clans(guild_id: int, limit: int):
         async with bot.db.acquire() as conn:
-            top_users = await conn.fetch("SELECT user_id, balance FROM users ORDER BY balance DESC LIMIT 10")
+            rows = await conn.fetch(f"""
+                SELECT name, {column} AS value FROM clans WHERE guild_id = $1
+                ORDER BY {column} DESC, name DESC LIMIT $2
+            """, guild_id, limit)
+        return [(row["name"], row["value"]) for row in rows]
+    return load_top_clans
+
+def user_board(guild_id: int) -> Leaderboard:
+    return Leaderboard(partial(load_top_users, guild_id), partial(load_users_page, guild_id),
+                       partial(load_user_rank, guild_id))
+
+def clan_boards(column: str) -> GuildBoards:
+    loader = clan_loader(column)
+    return GuildBoards(lambda guild_id: Leaderboard(partial(loader, guild_id)))
+
+bot.names = NameResolver(bot)
+bot.top_users = GuildBoards(user_board)
+bot.top_clans = {sort: clan_boards(column) for sort, (column, _) in CLAN_SORTS.items()}
+
+# ==================== УЧАСТНИКИ ====================
+class MemberResolver:
+    """Участники по ID: кэш гильдии, затем LRU с TTL, затем один запрос к API.
+    Нужен в режиме экономии памяти, когда кэш участников гильдий пуст."""
+
+    def __init__(self, bot, ttl=MEMBER_CACHE_TTL, max_size=MEMBER_CACHE_SIZE):
+        self.bot = bot
+        self.ttl = ttl
+        self.max_size = max_size
+        self._members = OrderedDict()
+        self._fetching = {}
+
+    def __len__(self):
+        return len(self._members)
+
+    def remember(self, member):
+        key = (member.guild.id, member.id)
+        self._members[key] = (member, time.monotonic() + self.ttl)
+        self._members.move_to_end(key)
+        while len(self._members) > self.max_size:
+            self._members.popitem(last=False)
+        return member
+
+    def forget(self, guild_id: int, user_id: int):
+        self._members.pop((guild_id, user_id), None)
+
+    async def get(self, guild, user_id: int):
+        member = guild.get_member(user_id)
+        if member is not None:
+            return member
+        key = (guild.id, user_id)
+        cached = self._members.get(key)
+        if cached and cached[1] > time.monotonic():
+            self._members.move_to_end(key)
+            return cached[0]
+
+        # Одновременные запросы одного и того же участника объединяются
+        task = self._fetching.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(guild, user_id))
+            self._fetching[key] = task
+            task.add_done_callback(lambda _: self._fetching.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, guild, user_id: int):
+        try:
+            member = await guild.fetch_member(user_id)
+        except discord.NotFound:
+            self.forget(guild.id, user_id)
+            return None
+        return self.remember(member)
 
-        if not top_users:
-            await ctx.send("😔 Таблица пуста.")
-            return
+bot.members = MemberResolver(bot)
+
+class CachedMember(commands.MemberConverter):
+    """Аргумент-участник: упоминание или ID ищется через bot.members,
+    остальное (имя, ник) — обычным конвертером discord.py."""
 
-        leaderboard = []
-        for i, record in enumerate(top_users, start=1):
+    async def convert(self, ctx, argument):
+        match = re.match(r"<@!?([0-9]{15,20})>$", argument) or re.match(r"([0-9]{15,20})$", argument)
+        if match and ctx.guild:
             try:
-                user = await bot.fetch_user(record['user_id'])
-                leaderboard.append(f"{i}. {user.name} — {record['balance']} кредитов")
-            except:
-                leaderboard.append(f"{i}. [Неизвестный пользователь] — {record['balance']} кредитов")
+                member = await bot.members.get(ctx.guild, int(match.group(1)))
+            except discord.HTTPException:
+                member = None
+            if member is not None:
+                return member
+        member = await super().convert(ctx, argument)
+        if member.guild is not None:
+            bot.members.remember(member)
+        return member
+
+async def role_members(role):
+    # В режиме экономии памяти role.members видит только закэшированных участников,
+    # поэтому состав гильдии запрашивается у гейтвея без сохранения в кэш
+    if not LOW_MEMORY:
+        return role.members
+    members = await role.guild.chunk(cache=False)
+    return [member for member in members if member.get_role(role.id)]
+
+# ==================== КЭШ РОЛЕЙ ====================
+class RoleCache:
+    """ID настроенных ролей (Патриот, Muted, админские) для каждой гильдии.
+    Строится один раз при первом обращении и обновляется событиями ролей."""
+
+    def __init__(self):
+        self._admin_names = {name.lower() for name in ADMIN_ROLES}
+        self._guilds = {}
+
+    def _slots(self, guild):
+        slots = self._guilds.get(guild.id)
+        if slots is None:
+            slots = {"patriot": None, "mute": None, "admin": set()}
+            for role in guild.roles:
+                self._add(slots, role)
+            self._guilds[guild.id] = slots
+        return slots
+
+    def _add(self, slots, role):
+        # При одинаковых именах побеждает первая роль, как в discord.utils.get
+        if role.name == ROLE_NAME and slots["patriot"] is None:
+            slots["patriot"] = role.id
+        if role.name == MUTE_ROLE_NAME and slots["mute"] is None:
+            slots["mute"] = role.id
+        if role.name.lower() in self._admin_names:
+            slots["admin"].add(role.id)
+
+    def _discard(self, slots, role):
+        if slots["patriot"] == role.id:
+            slots["patriot"] = None
+        if slots["mute"] == role.id:
+            slots["mute"] = None
+        slots["admin"].discard(role.id)
+
+    def patriot_role(self, guild):
+        role_id = self._slots(guild)["patriot"]
+        return guild.get_role(role_id) if role_id else None
+
+    def mute_role(self, guild):
+        role_id = self._slots(guild)["mute"]
+        return guild.get_role(role_id) if role_id else None
+
+    def is_admin(self, member) -> bool:
+        return any(member.get_role(role_id) for role_id in self._slots(member.guild)["admin"])
+
+    def role_changed(self, role):
+        self.role_deleted(role)
+        slots = self._guilds.get(role.guild.id)
+        if slots is not None:
+            self._add(slots, role)
+
+    def role_deleted(self, role):
+        slots = self._guilds.get(role.guild.id)
+        if slots is None:
+            return
+        if role.id in (slots["patriot"], slots["mute"]):
+            # Могла остаться другая роль с тем же именем: перестроим при следующем обращении
+            del self._guilds[role.guild.id]
+        else:
+            self._discard(slots, role)
 
-        await ctx.send("🏆 **Топ 10 Патриотов:**\n" + "\n".join(leaderboard))
+    def forget_guild(self, guild):
+        self._guilds.pop(guild.id, None)
 
-    @commands.command(name="допкредит")
-    async def add_credits(self, ctx, member: discord.Member, amount: int):
-        if not self.is_admin(ctx.author):
-            await ctx.send("❌ Эта команда доступна только для администраторов!")
-            return
-        
-        if amount <= 0:
-            await ctx.send("❌ Сумма должна быть положительной!")
-            return
-        
-        await update_balance(member.id, amount)
-        new_balance = await get_balance(member.id)
-        await ctx.send(f"✅ Администратор {ctx.author.mention} добавил {amount} кредитов пользователю {member.mention}\n💰 Новый баланс: {new_balance} кредитов")
-
-    @commands.command(name="минускредит")
-    async def remove_credits(self, ctx, member: discord.Member, amount: int):
-        if not self.is_admin(ctx.author):
-            await ctx.send("❌ Эта команда доступна только для администраторов!")
+bot.role_cache = RoleCache()
+
+
+class NotAdmin(commands.CheckFailure):
+    pass
+
+
+def admin_only():
+    # Проверка команды: автор должен иметь одну из ADMIN_ROLES
+    async def predicate(ctx):
+        if ctx.guild is None or not bot.role_cache.is_admin(ctx.author):
+            raise NotAdmin()
+        return True
+    return commands.check(predicate)
+
+@bot.check
+async def guild_only(ctx):
+    # Экономика у каждой гильдии своя, поэтому команды работают только на сервере
+    if ctx.guild is None:
+        raise commands.NoPrivateMessage()
+    return True
+
+# ==================== КУЛДАУНЫ ====================
+class CooldownStore:
+    """Кулдауны по схеме «ведро токенов» на (команда, пользователь). Длинные
+    хранятся в cooldowns и переживают перезапуск; память только отсекает
+    заведомые отказы, потому что другие процессы токены лишь забирают."""
+
+    def __init__(self, bot, shared_min=COOLDOWN_SHARED_MIN_SECONDS,
+                 cleanup_interval=COOLDOWN_CLEANUP_INTERVAL, cleanup_batch=COOLDOWN_CLEANUP_BATCH):
+        self.bot = bot
+        self.shared_min = shared_min
+        self.cleanup_interval = cleanup_interval
+        self.cleanup_batch = cleanup_batch
+        self._buckets = {}
+        self._expiry = []
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._cleanup_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def _set(self, key, tokens: float, now: float, rate: int, per: float):
+        full_at = now + (rate - tokens) * per / rate
+        self._buckets[key] = (tokens, now, full_at)
+        heapq.heappush(self._expiry, (full_at, key))
+
+    async def take(self, command: str, user_id: int, rate: int, per: float) -> float:
+        # Забирает токен. Возвращает 0 или сколько секунд ждать следующего
+        key = (command, user_id)
+        now = time.time()
+        bucket = self._buckets.get(key)
+        tokens = rate if bucket is None else min(rate, bucket[0] + (now - bucket[1]) * rate / per)
+        if tokens < 1:
+            return (1 - tokens) * per / rate
+
+        if per < self.shared_min:
+            self._set(key, tokens - 1, now, rate, per)
+            return 0
+
+        async with self.bot.db.acquire() as conn:
+            row = await conn.fetchrow("""
+                WITH taken AS (
+                    INSERT INTO cooldowns AS c (command, user_id, tokens, updated_at, expires_at)
+                    VALUES ($1, $2, $3 - 1, now(), now() + make_interval(secs => $4 / $3))
+                    ON CONFLICT (command, user_id) DO UPDATE SET
+                        tokens = LEAST($3, c.tokens + extract(epoch FROM now() - c.updated_at) * $3 / $4) - 1,
+                        updated_at = now(),
+                        expires_at = now() + make_interval(secs => ($3 + 1 - LEAST(
+                            $3, c.tokens + extract(epoch FROM now() - c.updated_at) * $3 / $4)) * $4 / $3)
+                    WHERE LEAST($3, c.tokens + extract(epoch FROM now() - c.updated_at) * $3 / $4) >= 1
+                    RETURNING tokens
+                )
+                SELECT (SELECT tokens FROM taken) AS taken,
+                       (SELECT LEAST($3, tokens + extract(epoch FROM now() - updated_at) * $3 / $4)
+                        FROM cooldowns WHERE command = $1 AND user_id = $2) AS available
+            """, command, user_id, float(rate), float(per))
+
+        if row["taken"] is not None:
+            self._set(key, row["taken"], now, rate, per)
+            return 0
+        self._set(key, row["available"], now, rate, per)
+        return (1 - row["available"]) * per / rate
+
+    def _expire_local(self):
+        # Полные вёдра не отличаются от отсутствующих
+        now = time.time()
+        while self._expiry and self._expiry[0][0] <= now:
+            full_at, key = heapq.heappop(self._expiry)
+            bucket = self._buckets.get(key)
+            if bucket is not None and bucket[2] == full_at:
+                del self._buckets[key]
+
+    async def _cleanup_loop(self):
+        while True:
+            await asyncio.sleep(self.cleanup_interval)
+            self._expire_local()
+            try:
+                while True:
+                    # Пачками по индексу expires_at, чтобы не держать длинных блокировок
+                    async with self.bot.db.acquire() as conn:
+                        deleted = await conn.fetchval("""
+                            WITH expired AS (
+                                DELETE FROM cooldowns WHERE (command, user_id) IN (
+                                    SELECT command, user_id FROM cooldowns
+                                    WHERE expires_at <= now()
+                                    ORDER BY expires_at LIMIT $1
+                                )
+                                RETURNING 1
+                            )
+                            SELECT count(*) FROM expired
+                        """, self.cleanup_batch)
+                    if deleted < self.cleanup_batch:
+                        break
+            except Exception as e:
+                print(f"⚠ Ошибка очистки кулдаунов: {e}")
+
+bot.cooldowns = CooldownStore(bot)
+
+def shared_cooldown(rate: int, per: float):
+    # Замена commands.cooldown(rate, per, BucketType.user), общая для процессов.
+    # Токен берётся в before_invoke, а не в проверке: проверки вызывает и can_run
+    # (например, !help при выводе списка команд), а он тратить кулдаун не должен
+    async def take(*args):
+        ctx = args[-1]  # для команд кога хук получает (cog, ctx)
+        retry_after = await bot.cooldowns.take(ctx.command.qualified_name, ctx.author.id, rate, per)
+        if retry_after:
+            raise commands.CommandOnCooldown(commands.Cooldown(rate, per), retry_after, commands.BucketType.user)
+    return commands.before_invoke(take)
+
+# ==================== МАССОВЫЕ ПРАВА ====================
+class PermissionFanout:
+    """Ставит одинаковое переопределение прав для роли во всех каналах гильдии.
+
+    Запросы идут с ограниченной параллельностью (очереди и 429 по бакетам
+    разбирает HTTP-клиент discord.py). Каналы, где переопределение уже стоит,
+    пропускаются, поэтому прерванный прогон просто запускается заново."""
+
+    def __init__(self, guild, target, reason=None, concurrency=PERMISSION_FANOUT_CONCURRENCY, **permissions):
+        self.guild = guild
+        self.target = target
+        self.reason = reason
+        self.overwrite = discord.PermissionOverwrite(**permissions)
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self.total = 0
+        self.done = 0
+        self.failed = []
+        self._progress = None
+        self._reported_at = 0.0
+
+    def plan(self):
+        # Сначала категории, потом каналы. Каналы, синхронизированные с обновляемой
+        # категорией, получают её права вместе с ней, отдельный запрос им не нужен
+        categories = {}
+        channels = []
+        for channel in self.guild.channels:
+            if isinstance(channel, discord.CategoryChannel) and channel.overwrites_for(self.target) != self.overwrite:
+                categories[channel] = []
+        updating = {category.id: children for category, children in categories.items()}
+        for channel in self.guild.channels:
+            if isinstance(channel, discord.CategoryChannel) or channel.overwrites_for(self.target) == self.overwrite:
+                continue
+            if channel.permissions_synced and channel.category_id in updating:
+                updating[channel.category_id].append(channel)
+            else:
+                channels.append(channel)
+        return categories, channels
+
+    async def run(self, progress=None):
+        self._progress = progress
+        categories, channels = self.plan()
+        self.total = len(categories) + sum(map(len, categories.values())) + len(channels)
+        await asyncio.gather(*(self._apply(category, children) for category, children in categories.items()))
+        await asyncio.gather(*(self._apply(channel) for channel in channels))
+        await self._report(force=True)
+        return self
+
+    async def _apply(self, channel, inherited=()):
+        # inherited — синхронизированные каналы категории: их судьба та же, что у неё
+        async with self._semaphore:
+            try:
+                await channel.set_permissions(self.target, overwrite=self.overwrite, reason=self.reason)
+            except discord.HTTPException as e:
+                print(f"⚠ Не удалось настроить права в #{channel.name}: {e}")
+                self.failed.append(channel)
+                self.failed.extend(inherited)
+            self.done += 1 + len(inherited)
+        await self._report()
+
+    async def _report(self, force=False):
+        if self._progress is None:
             return
-        
-        if amount <= 0:
-            await ctx.send("❌ Сумма должна быть положительной!")
+        now = time.monotonic()
+        if not force and now - self._reported_at < PERMISSION_PROGRESS_INTERVAL:
             return
-        
-        current_balance = await get_balance(member.id)
-        if current_balance < amount:
-            await ctx.send(f"❌ У пользователя только {current_balance} кредитов, нельзя снять {amount}!")
+        self._reported_at = now
+        try:
+            await self._progress(self)
+        except discord.HTTPException:
+            pass
+
+
+def start_permission_fanout(fanout, progress=None):
+    # Один прогон на пару (гильдия, роль): повторный вызов вернёт уже идущую задачу
+    key = (fanout.guild.id, fanout.target.id)
+    task = bot.permission_jobs.get(key)
+    if task is None or task.done():
+        task = asyncio.create_task(fanout.run(progress))
+        bot.permission_jobs[key] = task
+        task.add_done_callback(lambda _: bot.permission_jobs.pop(key, None))
+    return task
+
+bot.permission_jobs = {}
+
+# ==================== ОЧИСТКА ЧАТА ====================
+BULK_DELETE_SIZE = 100
+# Discord удаляет пачкой только сообщения моложе 14 дней; запас на расхождение часов
+BULK_DELETE_MAX_AGE = timedelta(days=14) - timedelta(minutes=5)
+# Сколько пачек удаляется, пока читается следующая страница истории
+PURGE_PIPELINE = 2
+
+class MessagePurge:
+    """Удаляет сообщения канала потоком: история читается страницами по мере
+    удаления, свежие сообщения уходят пачками по 100, а старше 14 дней — по
+    одному с ограниченной параллельностью и не больше old_limit за прогон."""
+
+    def __init__(self, channel, limit, before=None, after=None, author=None, contains=None, bots=False,
+                 scan_limit=PURGE_SCAN_LIMIT, old_limit=PURGE_OLD_LIMIT, old_concurrency=PURGE_OLD_CONCURRENCY):
+        self.channel = channel
+        self.limit = limit
+        self.before = before
+        self.after = after
+        self.author = author
+        self.contains = contains.lower() if contains else None
+        self.bots = bots
+        self.scan_limit = scan_limit
+        self.old_limit = old_limit
+        self._semaphore = asyncio.Semaphore(old_concurrency)
+        self.scanned = 0
+        self.matched = 0
+        self.deleted = 0
+        self.failed = 0
+        self.old = 0
+        self.finished = False
+        self._progress = None
+        self._reported_at = 0.0
+
+    def matches(self, message) -> bool:
+        if message.pinned:
+            return False
+        if self.author is not None and message.author.id != self.author.id:
+            return False
+        if self.bots and not message.author.bot:
+            return False
+        if self.contains is not None and self.contains not in message.content.lower():
+            return False
+        return True
+
+    async def run(self, progress=None):
+        self._progress = progress
+        bulk_after = discord.utils.utcnow() - BULK_DELETE_MAX_AGE
+        chunk, deleting, old = [], set(), []
+        # oldest_first=False явно: с after discord.py иначе читает от старых к новым
+        async for message in self.channel.history(
+            limit=self.scan_limit, before=self.before, after=self.after, oldest_first=False
+        ):
+            self.scanned += 1
+            if self.matches(message):
+                self.matched += 1
+                if message.created_at > bulk_after:
+                    chunk.append(message)
+                    if len(chunk) == BULK_DELETE_SIZE:
+                        deleting.add(asyncio.create_task(self._bulk(chunk)))
+                        chunk = []
+                        if len(deleting) >= PURGE_PIPELINE:
+                            _, deleting = await asyncio.wait(deleting, return_when=asyncio.FIRST_COMPLETED)
+                else:
+                    old.append(message)
+                # Дальше история только старее, так что после лимита старых читать нечего
+                if self.matched >= self.limit or len(old) >= self.old_limit:
+                    break
+            await self._report()
+
+        if chunk:
+            deleting.add(asyncio.create_task(self._bulk(chunk)))
+        if deleting:
+            await asyncio.gather(*deleting)
+        self.old = len(old)
+        await asyncio.gather(*(self._single(message) for message in old))
+        self.finished = True
+        await self._report(force=True)
+        return self
+
+    async def _bulk(self, messages):
+        try:
+            await self.channel.delete_messages(messages)
+            self.deleted += len(messages)
+        except discord.HTTPException as e:
+            print(f"⚠ Не удалось удалить пачку сообщений в #{self.channel}: {e}")
+            self.failed += len(messages)
+        await self._report()
+
+    async def _single(self, message):
+        async with self._semaphore:
+            try:
+                await message.delete()
+                self.deleted += 1
+            except discord.NotFound:
+                self.deleted += 1
+            except discord.HTTPException as e:
+                print(f"⚠ Не удалось удалить сообщение {message.id}: {e}")
+                self.failed += 1
+        await self._report()
+
+    async def _report(self, force=False):
+        if self._progress is None:
             return
-        
-        await update_balance(member.id, -amount)
-        new_balance = await get_balance(member.id)
-        await ctx.send(f"✅ Администратор {ctx.author.mention} снял {amount} кредитов у пользователя {member.mention}\n💰 Новый баланс: {new_balance} кредитов")
-
-    @commands.command(name="магазин")
-    async def shop(self, ctx):
-        shop_text = f"""
-🛍 **Магазин социального кредита:**
-
-🎨 `!купитьроль "Название" #Цвет` - Купить кастомную роль ({CUSTOM_ROLE_PRICE} кредитов)
-Пример: `!купитьроль "Богач" #ff0000`
-
-💰 Ваш баланс: {await get_balance(ctx.author.id)} кредитов
-"""
-        await ctx.send(shop_text)
-
-    @commands.command(name="купитьроль")
-    async def buy_role(self, ctx, role_name: str, role_color: str):
-        user = ctx.author
-        balance = await get_balance(user.id)
-        
-        if balance < CUSTOM_ROLE_PRICE:
-            await ctx.send(f"❌ Недостаточно средств! Нужно {CUSTOM_ROLE_PRICE} кредитов, у вас {balance}.")
+        now = time.monotonic()
+        if not force and now - self._reported_at < PURGE_PROGRESS_INTERVAL:
             return
-        
-        existing_role = await get_custom_role(user.id)
-        if existing_role:
-            try:
-                old_role = ctx.guild.get_role(existing_role['role_id'])
-                if old_role:
-                    await old_role.delete()
-            except:
-                pass
-        
+        self._reported_at = now
         try:
-            color = discord.Color.from_str(role_color)
-            new_role = await ctx.guild.create_role(
-                name=role_name,
-                color=color,
-                reason=f"Кастомная роль для {user.name}"
-            )
-            
-            await user.add_roles(new_role)
-            await create_custom_role(user.id, new_role.id, role_name, role_color)
-            await update_balance(user.id, -CUSTOM_ROLE_PRICE)
-            
-            await ctx.send(f"✅ {user.mention}, вы успешно купили роль {new_role.mention} за {CUSTOM_ROLE_PRICE} кредитов!")
-        except ValueError:
-            await ctx.send("❌ Неверный формат цвета! Используйте HEX формат, например: `#ff0000`")
-        except Exception as e:
-            print(f"Ошибка при создании роли: {e}")
-            await ctx.send("❌ Произошла ошибка при создании роли. Попробуйте позже.")
+            await self._progress(self)
+        except discord.HTTPException:
+            pass
 
-    # КОМАНДА ПОМОЩЬ - ИСПРАВЛЕННАЯ
-    @commands.command(name="помощь")
-    async def help_command(self, ctx):
-        try:
-            help_text = """
-📜 Команды бота:
-
-🔴 !славанн — попытка стать Патриотом (2ч кд)
-🌾 !фарм — заработать кредиты (20м кд, только для Патриотов)  
-💰 !баланс — показать баланс (5с кд)
-💸 !перевести @юзер сумма — перевод кредитов
-🏆 !топ — топ-10 по балансу (5с кд)
-🎰 !рулетка ставка — игра в рулетку (30с кд)
-🛍 !магазин — просмотреть магазин
-🎨 !купитьроль "Название" #Цвет — купить кастомную роль (2000 кредитов)
-➕ !допкредит @юзер сумма — добавить кредиты (админы)
-➖ !минускредит @юзер сумма — снять кредиты (админы)  
-👥 !создатьклан название — создать клан
-👥 !войтивклан название — вступить в клан
-🏆 !клантоп — топ кланов
-👤 !профиль @юзер — посмотреть профиль
-📝 !описание_профиль текст — изменить описание профиля
-🎁 !ежедневный — ежедневная награда (24ч кд)
-ℹ️ !помощь — это сообщение
-"""
-            await ctx.send(help_text)
-        except Exception as e:
-            print(f"Ошибка в команде помощь: {e}")
-            await ctx.send("Произошла ошибка при выполнении команды")
-            
-# ==================== КЛАНЫ ====================
-class Clans(commands.Cog):
-    def __init__(self, bot):
-        self.bot = bot
+bot.purge_jobs = {}
 
-    @commands.command(name="создатьклан")
-    async def create_clan(self, ctx, clan_name: str):
-        user = ctx.author
-        balance = await get_balance(user.id)
-        
-        if balance < CLAN_CREATION_PRICE:
-            await ctx.send(f"❌ Нужно {CLAN_CREATION_PRICE} кредитов для создания клана!")
-            return
-        
-        current_clan = await get_user_clan(user.id)
-        if current_clan:
-            await ctx.send("❌ Вы уже состоите в клане!")
-            return
-        
-        async with bot.db.acquire() as conn:
-            clan_exists = await conn.fetchval(
-                "SELECT EXISTS(SELECT 1 FROM clans WHERE name = $1)",
-                clan_name
-            )
-            if clan_exists:
-                await ctx.send("❌ Клан с таким именем уже существует!")
-                return
-            
-            await conn.execute(
-                "INSERT INTO clans (name, owner_id, balance) VALUES ($1, $2, $3)",
-                clan_name, user.id, 0
-            )
-            await conn.execute(
-                "INSERT INTO user_clans (user_id, clan_name) VALUES ($1, $2)",
-                user.id, clan_name
-            )
-        
-        await update_balance(user.id, -CLAN_CREATION_PRICE)
-        await ctx.send(f"✅ Клан '{clan_name}' создан! Вы стали лидером.")
-
-    @commands.command(name="войтивклан")
-    async def join_clan(self, ctx, clan_name: str):
-        user = ctx.author
-        
-        current_clan = await get_user_clan(user.id)
-        if current_clan:
-            await ctx.send("❌ Вы уже состоите в клане!")
-            return
-        
-        async with bot.db.acquire() as conn:
-            clan_exists = await conn.fetchval(
-                "SELECT EXISTS(SELECT 1 FROM clans WHERE name = $1)",
-                clan_name
-            )
-            
-            if not clan_exists:
-                await ctx.send("❌ Такого клана не существует!")
-                return
-            
-            await conn.execute(
-                "INSERT INTO user_clans (user_id, clan_name) VALUES ($1, $2)",
-                user.id, clan_name
-            )
-        
-        await ctx.send(f"✅ Вы вступили в клан '{clan_name}'!")
+class YesNo(commands.Converter):
+    """Флаг да/нет: кроме русских слов понимает то же, что bool в discord.py."""
 
-    @commands.command(name="клантоп")
-    async def clan_top(self, ctx):
-        async with bot.db.acquire() as conn:
-            top_clans = await conn.fetch(
-                "SELECT name, balance FROM clans ORDER BY balance DESC LIMIT 10"
-            )
-        
-        if not top_clans:
-            await ctx.send("😔 Кланов пока нет.")
-            return
-        
-        leaderboard = []
-        for i, clan in enumerate(top_clans, start=1):
-            leaderboard.append(f"{i}. {clan['name']} — {clan['balance']} кредитов")
-        
-        await ctx.send("🏆 **Топ кланов:**\n" + "\n".join(leaderboard))
-
-# ==================== ПРОФИЛЬ ====================
-class Profile(commands.Cog):
-    def __init__(self, bot):
-        self.bot = bot
+    YES = {"да", "д", "вкл", "yes", "y", "true", "t", "1", "enable", "on"}
+    NO = {"нет", "н", "выкл", "no", "n", "false", "f", "0", "disable", "off"}
 
-    @commands.command(name="профиль")
-    async def profile(self, ctx, member: discord.Member = None):
-        if not member:
-            member = ctx.author
-        
-        balance = await get_balance(member.id)
-        clan = await get_user_clan(member.id)
-        description = await get_profile_description(member.id)
-        
-        embed = discord.Embed(
-            title=f"Профиль {member.name}",
-            color=member.color
-        )
-        
-        avatar_url = member.avatar.url if member.avatar else member.default_avatar.url
-        embed.set_thumbnail(url=avatar_url)
-        
-        embed.add_field(name="💰 Баланс", value=f"{balance} кредитов", inline=True)
-        embed.add_field(name="👥 Клан", value=clan if clan else "Нет клана", inline=True)
-        embed.add_field(name="📝 Описание", value=description, inline=False)
-        embed.set_footer(text=f"ID: {member.id}")
-        
-        await ctx.send(embed=embed)
-
-    @commands.command(name="описание_профиль")
-    async def set_profile_description(self, ctx, *, description: str):
-        if len(description) > 200:
-            await ctx.send("❌ Описание не должно превышать 200 символов!")
-            return
-        
-        await update_profile_description(ctx.author.id, description)
-        await ctx.send("✅ Описание профиля обновлено!")
+    async def convert(self, ctx, argument):
+        lowered = argument.lower()
+        if lowered in self.YES:
+            return True
+        if lowered in self.NO:
+            return False
+        raise commands.BadArgument(f"Ожидается «да» или «нет», а не «{argument}»")
+
+class PurgeFlags(commands.FlagConverter):
+    author: CachedMember = commands.flag(name="от", default=None)
+    contains: str = commands.flag(name="текст", default=None)
+    minutes: int = commands.flag(name="за", default=None)
+    bots: YesNo = commands.flag(name="боты", default=False)
+
+# ==================== ВРЕМЕННЫЕ МУТЫ ====================
+class MuteScheduler:
+    """Снимает временные муты. Сроки хранятся в mute_expirations, а в памяти —
+    min-куча, по которой одна задача спит до ближайшего срока."""
+
+    RETRY_DELAY = 60
 
-# ==================== МОДЕРАЦИЯ ====================
-class Mod(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self._heap = []
+        self._deadlines = {}
+        self._wake = asyncio.Event()
+        self._task = None
+
+    async def start(self):
+        # Только гильдии своих шардов: чужие сроки снимает процесс, который их видит
+        async with self.bot.db.acquire() as conn:
+            if SHARD_IDS is None:
+                rows = await conn.fetch("SELECT guild_id, user_id, expires_at FROM mute_expirations")
+            else:
+                rows = await conn.fetch("""
+                    SELECT guild_id, user_id, expires_at FROM mute_expirations
+                    WHERE ((guild_id >> 22) % $1)::int = ANY($2::int[])
+                """, SHARD_COUNT, SHARD_IDS)
+        for row in rows:
+            key = (row["guild_id"], row["user_id"])
+            self._deadlines[key] = row["expires_at"].timestamp()
+        self._heap = [(deadline, key) for key, deadline in self._deadlines.items()]
+        heapq.heapify(self._heap)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
 
-    def is_admin(self, member):
-        return any(role.name.lower() in [r.lower() for r in ADMIN_ROLES] for role in member.roles)
+    def _push(self, key, deadline: float):
+        self._deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, key))
+        if self._heap[0][1] == key:
+            self._wake.set()
 
-    @commands.command(name="мут")
-    async def mute(self, ctx, member: discord.Member, time: int, *, reason: str = "Не указана"):
-        if not self.is_admin(ctx.author):
-            await ctx.send("❌ Эта команда доступна только для администраторов!")
+    async def schedule(self, guild_id: int, user_id: int, deadline: float):
+        async with self.bot.db.acquire() as conn:
+            await conn.execute("""
+                INSERT INTO mute_expirations (guild_id, user_id, expires_at) VALUES ($1, $2, $3)
+                ON CONFLICT (guild_id, user_id) DO UPDATE SET expires_at = $3
+            """, guild_id, user_id, datetime.fromtimestamp(deadline, timezone.utc))
+        self._push((guild_id, user_id), deadline)
+
+    async def cancel(self, guild_id: int, user_id: int):
+        # Из кучи запись не удаляем: устаревшие элементы отбрасываются при извлечении
+        if self._deadlines.pop((guild_id, user_id), None) is None:
             return
-        
-        mute_role = discord.utils.get(ctx.guild.roles, name=MUTE_ROLE_NAME)
-        if not mute_role:
-            mute_role = await ctx.guild.create_role(
-                name=MUTE_ROLE_NAME,
-                reason="Создание роли для мьюта"
+        async with self.bot.db.acquire() as conn:
+            await conn.execute(
+                "DELETE FROM mute_expirations WHERE guild_id = $1 AND user_id = $2", guild_id, user_id
             )
-            
-            for channel in ctx.guild.channels:
-                await channel.set_permissions(mute_role, send_messages=False, speak=False)
-        
-        await member.add_roles(mute_role)
-        await ctx.send(f"✅ {member.mention} замьючен на {time} минут по причине: {reason}")
-
-    @commands.command(name="размут")
-    async def unmute(self, ctx, member: discord.Member):
-        if not self.is_admin(ctx.author):
-            await ctx.send("❌ Эта команда доступна только для администраторов!")
-            return
-        
-        mute_role = discord.utils.get(ctx.guild.roles, name=MUTE_ROLE_NAME)
-        if mute_role and mute_role in member.roles:
-            await member.remove_roles(mute_role)
-            await ctx.send(f"✅ {member.mention} размьючен!")
-        else:
-            await ctx.send("❌ Пользователь не замьючен!")
 
-# ==================== РАЗВЛЕЧЕНИЯ ====================
-class Fun(commands.Cog):
-    def __init__(self, bot):
+    async def _run(self):
+        await self.bot.wait_until_ready()
+        while True:
+            self._wake.clear()
+            now = time.time()
+            due = []
+            while self._heap and self._heap[0][0] <= now:
+                deadline, key = heapq.heappop(self._heap)
+                if self._deadlines.get(key) == deadline:
+                    due.append((key, deadline))
+            if due:
+                # Просроченные (например, за время простоя бота) снимаются одной пачкой
+                try:
+                    await self._expire(due)
+                except Exception as e:
+                    print(f"⚠ Ошибка снятия мутов: {e}")
+                    for key, deadline in due:
+                        if self._deadlines.get(key) == deadline:
+                            self._push(key, now + self.RETRY_DELAY)
+                continue
+
+            timeout = self._heap[0][0] - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _expire(self, due):
+        results = await asyncio.gather(*(self._unmute(*key) for key, _ in due))
+        finished = [(key, deadline) for (key, deadline), ok in zip(due, results) if ok]
+        retry = [(key, deadline) for (key, deadline), ok in zip(due, results) if not ok]
+
+        if finished:
+            async with self.bot.db.acquire() as conn:
+                # Удаляем только те сроки, которые не продлили, пока снимали мут
+                await conn.execute("""
+                    DELETE FROM mute_expirations m
+                    USING unnest($1::bigint[], $2::bigint[], $3::timestamptz[]) AS d(guild_id, user_id, expires_at)
+                    WHERE m.guild_id = d.guild_id AND m.user_id = d.user_id AND m.expires_at <= d.expires_at
+                """, [key[0] for key, _ in finished], [key[1] for key, _ in finished],
+                    [datetime.fromtimestamp(deadline, timezone.utc) for _, deadline in finished])
+            for key, deadline in finished:
+                if self._deadlines.get(key) == deadline:
+                    del self._deadlines[key]
+
+        now = time.time()
+        for key, deadline in retry:
+            if self._deadlines.get(key) == deadline:
+                self._push(key, now + self.RETRY_DELAY)
+
+    async def _unmute(self, guild_id: int, user_id: int) -> bool:
+        # True — мут снят или снимать уже нечего, False — повторить позже
+        guild = self.bot.get_guild(guild_id)
+        if guild is None:
+            return True
+        mute_role = self.bot.role_cache.mute_role(guild)
+        if mute_role is None:
+            return True
+        try:
+            member = await self.bot.members.get(guild, user_id)
+            if member is None:
+                return True
+            if member.get_role(mute_role.id):
+                await member.remove_roles(mute_role, reason="Срок мута истёк")
+        except (discord.NotFound, discord.Forbidden):
+            return True
+        except discord.HTTPException as e:
+            print(f"⚠ Не удалось снять мут с {user_id}: {e}")
+            return False
+        return True
+
+# ==================== КЭШ ПРОФИЛЕЙ ====================
+class ProfileCache:
+    """LRU данных профиля по ключу (guild_id, user_id). Запись сбрасывается при смене
+    клана или описания, баланс обновляется на месте. Вместе с данными хранится готовый embed."""
+
+    def __init__(self, max_size=PROFILE_CACHE_SIZE):
+        self.max_size = max_size
+        self._profiles = OrderedDict()
+        self._loading = {}
+        self._stale = set()
+
+    async def get(self, key: tuple, loader):
+        profile = self._profiles.get(key)
+        if profile is not None:
+            self._profiles.move_to_end(key)
+            return profile
+        task = self._loading.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._load(key, loader))
+            self._loading[key] = task
+        return await asyncio.shield(task)
+
+    async def _load(self, key: tuple, loader):
+        try:
+            profile = await loader(*key)
+        finally:
+            del self._loading[key]
+        # Если во время чтения профиль изменился, прочитанное уже устарело
+        if key in self._stale:
+            self._stale.discard(key)
+        else:
+            self._profiles[key] = profile
+            while len(self._profiles) > self.max_size:
+                self._profiles.popitem(last=False)
+        return profile
+
+    def update(self, key: tuple, **fields):
+        profile = self._profiles.get(key)
+        if profile is not None:
+            profile.update(fields)
+            profile.pop("embed", None)
+        elif key in self._loading:
+            self._stale.add(key)
+
+    def invalidate(self, key: tuple):
+        self._profiles.pop(key, None)
+        if key in self._loading:
+            self._stale.add(key)
+
+    def forget_guilds(self, guild_ids=None):
+        for key in list(self._profiles):
+            if guild_ids is None or key[0] in guild_ids:
+                del self._profiles[key]
+        self._stale.update(key for key in self._loading if guild_ids is None or key[0] in guild_ids)
+
+bot.profiles = ProfileCache()
+
+# ==================== АКТИВНОСТЬ ====================
+class ActivityTracker:
+    """Счётчики сообщений в памяти. Раз в интервал все счётчики одним запросом
+    прибавляются к users.messages вместе с наградой в балансе."""
+
+    def __init__(self, bot, flush_interval=ACTIVITY_FLUSH_INTERVAL,
+                 reward=ACTIVITY_REWARD, reward_cap=ACTIVITY_REWARD_CAP):
         self.bot = bot
+        self.flush_interval = flush_interval
+        self.reward = reward
+        self.reward_cap = reward_cap
+        self._counts = Counter()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
 
-    @commands.command(name="ежедневный")
-    @commands.cooldown(1, 86400, commands.BucketType.user)
-    async def daily(self, ctx):
-        reward = random.randint(100, 500)
-        await update_balance(ctx.author.id, reward)
-        await ctx.send(f"🎁 {ctx.author.mention}, вы получили {reward} кредитов!")
-
-    @commands.command(name="рулетка")
-    @commands.cooldown(1, 30, commands.BucketType.user)
-    async def roulette(self, ctx, bet: int):
-        if bet <= 0:
-            await ctx.send("❌ Ставка должна быть положительной!")
-            return
+    def record(self, guild_id: int, user_id: int):
+        self._counts[guild_id, user_id] += 1
 
-        balance = await get_balance(ctx.author.id)
-        if balance < bet:
-            await ctx.send("❌ Недостаточно кредитов!")
-            return
+    def pending(self) -> int:
+        return len(self._counts)
 
-        outcome = random.choice(["win", "lose", "refund"])
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"⚠ Ошибка сброса активности: {e}")
 
-        if outcome == "win":
-            await update_balance(ctx.author.id, bet)
-            await ctx.send(f"🎉 {ctx.author.mention} выиграл {bet} кредитов!")
-        elif outcome == "lose":
-            await update_balance(ctx.author.id, -bet)
-            await ctx.send(f"💀 {ctx.author.mention} проиграл {bet} кредитов...")
-        else:
-            await ctx.send(f"🔄 {ctx.author.mention} вернул свои {bet} кредитов.")
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._counts:
+                return
+            counts, self._counts = self._counts, Counter()
+            keys = list(counts)
+            guild_ids = [guild_id for guild_id, _ in keys]
+            user_ids = [user_id for _, user_id in keys]
+            messages = [counts[key] for key in keys]
+            rewards = [min(count, self.reward_cap) * self.reward for count in messages]
 
-# ==================== СОБЫТИЯ ====================
-class Events(commands.Cog):
-    def __init__(self, bot):
+            try:
+                async with external_balance_write() as merge:
+                    async with self.bot.db.acquire() as conn:
+                        rows = await conn.fetch("""
+                            INSERT INTO users (guild_id, user_id, balance, messages)
+                            SELECT * FROM unnest($1::bigint[], $2::bigint[], $3::int[], $4::bigint[])
+                            ON CONFLICT (guild_id, user_id) DO UPDATE SET
+                                balance = users.balance + EXCLUDED.balance,
+                                messages = users.messages + EXCLUDED.messages
+                            RETURNING guild_id, user_id, balance, messages
+                        """, guild_ids, user_ids, rewards, messages)
+                    balances = {(row["guild_id"], row["user_id"]): merge(row["guild_id"], row["user_id"], row["balance"])
+                                for row in rows}
+            except BaseException:
+                # Возвращаем счётчики, чтобы не потерять их при ошибке
+                self._counts.update(counts)
+                raise
+
+            rewarded = dict(zip(keys, rewards))
+            for row in rows:
+                key = (row["guild_id"], row["user_id"])
+                balance_changed(*key, balances[key], rewarded[key], "activity")
+                bot.profiles.update(key, messages=row["messages"])
+
+# ==================== ИСХОДЯЩИЕ СООБЩЕНИЯ ====================
+class _Outgoing:
+    __slots__ = ("content", "key", "queued_at")
+
+    def __init__(self, content: str, key, queued_at: float):
+        self.content = content
+        self.key = key
+        self.queued_at = queued_at
+
+
+class _ChannelQueue:
+    __slots__ = ("items", "task", "wake", "last_message", "last_sent_at")
+
+    def __init__(self):
+        self.items = []
+        self.task = None
+        self.wake = asyncio.Event()
+        self.last_message = None
+        self.last_sent_at = 0.0
+
+
+class Outbox:
+    """Короткие ответы через очередь канала. Пока отправляется одно сообщение
+    (или бот ждёт лимит Discord), следующие копятся и уходят одним; ответ сразу
+    за своим же сообщением дописывается в него правкой."""
+
+    def __init__(self, bot, edit_window=OUTBOX_EDIT_WINDOW, dedupe_window=OUTBOX_DEDUPE_WINDOW):
         self.bot = bot
+        self.edit_window = edit_window
+        self.dedupe_window = dedupe_window
+        self._queues = {}
+        self._recent = {}
+        self.coalesced = 0
+        self.dropped = 0
+
+    def depth(self) -> int:
+        return sum(len(queue.items) for queue in self._queues.values())
+
+    def send(self, channel, content: str, key=None):
+        # key — ключ дедупликации: такое же уведомление в очереди заменяется,
+        # а недавно отправленное не повторяется
+        if key is not None:
+            sent_at = self._recent.get(key)
+            if sent_at is not None and time.monotonic() - sent_at < self.dedupe_window:
+                self.dropped += 1
+                return
+        queue = self._queues.get(channel.id)
+        if queue is None:
+            queue = self._queues[channel.id] = _ChannelQueue()
+        if key is not None:
+            for item in queue.items:
+                if item.key == key:
+                    item.content = content
+                    self.dropped += 1
+                    return
+        queue.items.append(_Outgoing(content, key, time.perf_counter()))
+        queue.wake.set()
+        if queue.task is None:
+            queue.task = asyncio.create_task(self._drain(channel, queue))
+
+    def _take(self, queue):
+        # Сколько ответов помещается в одно сообщение
+        batch, length = [], -1
+        while queue.items and (not batch or length + 1 + len(queue.items[0].content) <= MESSAGE_LIMIT):
+            item = queue.items.pop(0)
+            batch.append(item)
+            length += 1 + len(item.content)
+        return batch
+
+    async def _deliver(self, channel, queue, content: str) -> str:
+        message = queue.last_message
+        if (message is not None
+                and getattr(channel, "last_message_id", None) == message.id
+                and time.monotonic() - queue.last_sent_at <= self.edit_window
+                and len(message.content) + 1 + len(content) <= MESSAGE_LIMIT):
+            queue.last_message = await message.edit(content=f"{message.content}\n{content}")
+            return "edit"
+        queue.last_message = await channel.send(content)
+        return "message"
+
+    async def _drain(self, channel, queue):
+        try:
+            while True:
+                while queue.items:
+                    batch = self._take(queue)
+                    kind, error = "message", False
+                    try:
+                        kind = await self._deliver(channel, queue, "\n".join(item.content for item in batch))
+                    except discord.HTTPException as e:
+                        print(f"⚠ Не удалось отправить ответ в канал {channel.id}: {e}")
+                        queue.last_message = None
+                        error = True
+                    queue.last_sent_at = time.monotonic()
+                    now = time.perf_counter()
+                    for item in batch:
+                        self.bot.stats.send(kind, (now - item.queued_at) * 1000, error)
+                        if item.key is not None:
+                            self._recent[item.key] = queue.last_sent_at
+                    self.coalesced += len(batch) - 1
+
+                # Ответы в окне правки ещё могут дописаться в последнее сообщение
+                queue.wake.clear()
+                try:
+                    await asyncio.wait_for(queue.wake.wait(), self.edit_window)
+                except asyncio.TimeoutError:
+                    break
+        finally:
+            if self._queues.get(channel.id) is queue:
+                del self._queues[channel.id]
+            self._forget_recent()
+
+    def _forget_recent(self):
+        cutoff = time.monotonic() - self.dedupe_window
+        for key in [key for key, sent_at in self._recent.items() if sent_at < cutoff]:
+            del self._recent[key]
+
+    async def close(self):
+        # Дождаться отправки всего, что уже в очередях
+        self.edit_window = 0
+        for queue in list(self._queues.values()):
+            queue.wake.set()
+        tasks = [queue.task for queue in self._queues.values() if queue.task]
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+bot.outbox = Outbox(bot)
+
+def reply(ctx, content: str, key=None):
+    # Ответ в канал команды через очередь; команда не ждёт отправки
+    bot.outbox.send(ctx.channel, content, key)
+
+# ==================== ЗДОРОВЬЕ И МЕТРИКИ ====================
+async def ping_db() -> bool:
+    async with bot.db.acquire() as conn:
+        return await conn.fetchval("SELECT 1") == 1
 
-    @commands.Cog.listener()
-    async def on_ready(self):
-        print("✅ Таблицы в БД готовы!")
-
-    @commands.Cog.listener()
-    async def on_command_error(self, ctx, error):
-        if isinstance(error, commands.CommandOnCooldown):
-            seconds = int(error.retry_after)
-            minutes = seconds // 60
-            seconds = seconds % 60
-            await ctx.send(f"⏳ Подождите {minutes}м {seconds}с, прежде чем использовать эту команду снова.")
+async def check_health():
+    db_ok = False
+    if hasattr(bot, "db") and not bot.db.is_closed():
+        # Таймаут на ожидание соединения и запрос вместе: занятый пул не должен
+        # держать /health дольше HEALTH_DB_TIMEOUT
+        try:
+            db_ok = await asyncio.wait_for(ping_db(), HEALTH_DB_TIMEOUT)
+        except Exception:
+            db_ok = False
+    gateway_ok = bot.is_ready() and not bot.is_closed()
+    latency = bot.latency if gateway_ok and math.isfinite(bot.latency) else None
+    return {
+        "ok": gateway_ok and db_ok,
+        "gateway_connected": gateway_ok,
+        "latency_ms": round(latency * 1000, 1) if latency is not None else None,
+        "db_reachable": db_ok,
+        "guilds": len(bot.guilds),
+        "startup_s": round(bot.startup_seconds, 1) if bot.startup_seconds is not None else None,
+        "rss_mb": round(resident_memory_mb(), 1),
+        "low_memory": LOW_MEMORY,
+        "shards": [
+            {"id": shard_id, "latency_ms": round(latency * 1000, 1) if latency is not None else None, "guilds": guilds}
+            for shard_id, latency, guilds in shard_stats()
+        ],
+    }
+
+def render_metrics():
+    # Текстовый формат Prometheus
+    lines = []
+
+    def gauge(name, value, help_text):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+
+    ready = bot.is_ready() and not bot.is_closed()
+    gauge("bot_ready", int(ready), "Бот подключён к гейтвею")
+    if ready and math.isfinite(bot.latency):
+        gauge("bot_gateway_latency_seconds", bot.latency, "Задержка вебсокета")
+    gauge("bot_guilds", len(bot.guilds), "Количество гильдий")
+    gauge("process_resident_memory_bytes", int(resident_memory_mb() * 2**20), "Занятая процессом память")
+    if bot.startup_seconds is not None:
+        gauge("bot_startup_seconds", bot.startup_seconds, "От запуска процесса до первого READY")
+    gauge("bot_member_resolver_entries", len(bot.members), "Участников в LRU по требованию")
+    if hasattr(bot, "db"):
+        health = bot.db.health()
+        gauge("db_pool_size", health["size"], "Открытых соединений в пуле")
+        gauge("db_pool_in_use", health["in_use"], "Занятых соединений")
+        gauge("db_pool_max_size", health["max_size"], "Максимальный размер пула")
+        gauge("db_pool_waiting", health["waiting"], "Ожидающих соединения")
+        gauge("db_pool_acquire_timeouts", health["acquire_timeouts"], "Таймаутов получения соединения")
+    if bot.balance_cache:
+        gauge("balance_cache_entries", len(bot.balance_cache._entries), "Записей в кэше балансов")
+    gauge("ledger_pending", bot.ledger.pending(), "Записей журнала в буфере")
+    gauge("leaderboard_guilds", len(bot.top_users), "Гильдий с топом в памяти")
+    gauge("cooldown_buckets", len(bot.cooldowns), "Кулдаунов в памяти")
+    gauge("ledger_dropped", bot.ledger.dropped, "Отброшено записей журнала из-за переполнения")
+    if hasattr(bot, "activity"):
+        gauge("activity_pending_users", bot.activity.pending(), "Пользователей с несброшенной активностью")
+
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+    def histogram(name, label, table, help_text):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} histogram")
+        for key, stats in table.items():
+            value = escape(key)
+            cumulative = 0
+            for bound, count in zip([*(b / 1000 for b in LATENCY_BUCKETS_MS), "+Inf"], stats.buckets):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{label}="{value}",le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_sum{{{label}="{value}"}} {stats.total_ms / 1000}')
+            lines.append(f'{name}_count{{{label}="{value}"}} {stats.count}')
+
+    def counter(name, label, table, field, help_text):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} counter")
+        for key, stats in table.items():
+            value = escape(key)
+            lines.append(f'{name}{{{label}="{value}"}} {getattr(stats, field)}')
+
+    histogram("bot_command_duration_seconds", "command", bot.stats.commands, "Время выполнения команд")
+    counter("bot_command_errors_total", "command", bot.stats.commands, "errors", "Команды, завершившиеся ошибкой")
+    counter("bot_command_rejected_total", "command", bot.stats.commands, "rejected", "Команды, отклонённые до выполнения")
+    counter("bot_command_db_queries_total", "command", bot.stats.commands, "queries", "Запросы к БД из команд")
+    histogram("db_query_duration_seconds", "query", bot.stats.queries, "Время выполнения SQL-запросов")
+    counter("db_query_errors_total", "query", bot.stats.queries, "errors", "SQL-запросы с ошибкой")
+    histogram("db_pool_wait_seconds", "command", bot.stats.pool_wait, "Ожидание соединения из пула")
+    histogram("bot_message_send_seconds", "kind", bot.stats.sends, "От постановки ответа в очередь до отправки")
+    gauge("bot_outbox_depth", bot.outbox.depth(), "Ответов в очередях каналов")
+    gauge("bot_outbox_channels", len(bot.outbox._queues), "Каналов с активной очередью")
+    lines.append("# HELP bot_outbox_coalesced_total Ответов, отправленных в чужом сообщении")
+    lines.append("# TYPE bot_outbox_coalesced_total counter")
+    lines.append(f"bot_outbox_coalesced_total {bot.outbox.coalesced}")
+    lines.append("# HELP bot_outbox_dropped_total Отброшенных повторных уведомлений")
+    lines.append("# TYPE bot_outbox_dropped_total counter")
+    lines.append(f"bot_outbox_dropped_total {bot.outbox.dropped}")
+
+    shards = shard_stats()
+    lines.append("# HELP bot_shard_latency_seconds Задержка вебсокета шарда")
+    lines.append("# TYPE bot_shard_latency_seconds gauge")
+    for shard_id, latency, _ in shards:
+        if latency is not None:
+            lines.append(f'bot_shard_latency_seconds{{shard="{shard_id}"}} {latency}')
+    lines.append("# HELP bot_shard_guilds Гильдий на шарде")
+    lines.append("# TYPE bot_shard_guilds gauge")
+    for shard_id, _, guilds in shards:
+        lines.append(f'bot_shard_guilds{{shard="{shard_id}"}} {guilds}')
+    return "\n".join(lines) + "\n"
+
+async def handle_http(reader, writer):
+    # Минимальный HTTP/1.1 на цикле событий бота: GET /, /health, /metrics
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        while True:
+            header = await asyncio.wait_for(reader.readline(), 5)
+            if header in (b"\r\n", b"\n", b""):
+                break
+        parts = request_line.decode("latin-1").split()
+        path = parts[1].split("?")[0] if len(parts) >= 2 else "/"
+
+        if path in ("/", "/health"):
+            health = await check_health()
+            status = "200 OK" if health["ok"] else "503 Service Unavailable"
+            if path == "/":
+                body, content_type = ("Bot OK" if health["ok"] else "Bot not ready"), "text/plain; charset=utf-8"
+            else:
+                body, content_type = json.dumps(health), "application/json"
+        elif path == "/metrics":
+            status, body, content_type = "200 OK", render_metrics(), "text/plain; version=0.0.4; charset=utf-8"
         else:
-            print(f"⚠ Ошибка команды: {error}")
-            await ctx.send("❌ Произошла ошибка при выполнении команды")
+            status, body, content_type = "404 Not Found", "Not Found", "text/plain; charset=utf-8"
+
+        payload = body.encode()
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode() + payload
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def start_health_server():
+    server = await asyncio.start_server(handle_http, HEALTH_HOST, HEALTH_PORT)
+    print(f"✅ Эндпоинт здоровья слушает {HEALTH_HOST}:{HEALTH_PORT}")
+    return server
 
 # ==================== ЗАПУСК БОТА ====================
+# Коги — расширения из cogs/. Их можно перезагрузить командой !перезагрузить без
+# перезапуска процесса: пул, кэши и подключение к гейтвею живут здесь и не трогаются
+EXTENSIONS = ["cogs.economy", "cogs.clans", "cogs.profile", "cogs.mod", "cogs.fun", "cogs.events"]
+
 async def setup():
-    await bot.add_cog(Economy(bot))
-    await bot.add_cog(Clans(bot))
-    await bot.add_cog(Profile(bot))
-    await bot.add_cog(Mod(bot))
-    await bot.add_cog(Fun(bot))
-    await bot.add_cog(Events(bot))
+    for extension in EXTENSIONS:
+        await bot.load_extension(extension)
+
+@bot.command(name="перезагрузить")
+@admin_only()
+async def reload_extensions(ctx, name: str):
+    # Команда в main, а не в коге: она доступна, даже если ког не загрузился
+    if name == "все":
+        extensions = EXTENSIONS
+    elif f"cogs.{name}" in EXTENSIONS:
+        extensions = [f"cogs.{name}"]
+    else:
+        names = ", ".join(extension.split(".")[1] for extension in EXTENSIONS)
+        await ctx.send(f"❌ Нет такого расширения. Доступны: {names}, все")
+        return
+
+    for extension in extensions:
+        try:
+            # При ошибке discord.py оставляет загруженной прежнюю версию
+            await bot.reload_extension(extension)
+        except commands.ExtensionError as e:
+            print(f"⚠ Ошибка перезагрузки {extension}: {e}")
+            await ctx.send(f"❌ Не удалось перезагрузить {extension}: {e}")
+            return
+    await ctx.send(f"🔄 Перезагружено: {', '.join(extensions)}")
 
 @bot.event
-async def on_ready():
+async def setup_hook():
+    # Вызывается один раз до подключения к гейтвею: пул и коги живут
+    # до остановки бота и переживают переподключения
     try:
         bot.db = await create_db_pool()
-        await setup()
-        print(f"✅ Бот запущен как {bot.user}")
     except Exception as e:
-        print(f"❌ Ошибка при запуске: {e}")
-        await bot.close()
+        print(f"❌ Ошибка базы данных: {e}")
+        raise
+    if BALANCE_CACHE:
+        bot.balance_cache = BalanceCache(bot)
+        bot.balance_cache.start()
+    bot.ledger.start()
+    bot.cooldowns.start()
+    bot.activity = ActivityTracker(bot)
+    bot.activity.start()
+    bot.mute_scheduler = MuteScheduler(bot)
+    await bot.mute_scheduler.start()
+    bot.health_server = await start_health_server()
+    bot.restore_listener = RestoreListener(bot)
+    await bot.restore_listener.start()
+    await setup()
+
+@bot.event
+async def on_ready():
+    # on_ready повторяется после переподключений, время старта — только первое
+    if bot.startup_seconds is None:
+        bot.startup_seconds = time.monotonic() - PROCESS_STARTED
+    mode = ", экономия памяти" if LOW_MEMORY else ""
+    print(f"✅ Бот запущен как {bot.user} за {bot.startup_seconds:.1f} с, "
+          f"память {resident_memory_mb():.0f} МБ{mode}")
+
+# ==================== ЗАГРУЗКА СНИМКОВ ====================
+def forget_economy(guild_ids):
+    # Экономика гильдий заменена в БД (None — всех): всё, что держится
+    # в памяти, перечитывается из БД при следующем обращении
+    if guild_ids is not None:
+        guild_ids = set(guild_ids)
+    if bot.balance_cache:
+        bot.balance_cache.forget_guilds(guild_ids)
+    bot.profiles.forget_guilds(guild_ids)
+    for boards in (bot.top_users, *bot.top_clans.values()):
+        if guild_ids is None:
+            boards.clear()
+        else:
+            for guild_id in guild_ids:
+                boards.forget(guild_id)
+
+
+class RestoreListener:
+    """Слушает RESTORE_CHANNEL на отдельном соединении вне пула. Оборванное соединение
+    переподключается с нарастающей паузой; пока его не было, уведомление могло
+    потеряться, поэтому после переподключения кэши экономики сбрасываются целиком."""
+
+    CHECK_INTERVAL = 30
+    CHECK_TIMEOUT = 5
+    MAX_BACKOFF = 60
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._conn = None
+        self._lost = asyncio.Event()
+        self._task = None
+
+    async def start(self):
+        # Первое подключение при запуске: ошибка останавливает бота, как и ошибка пула
+        await self._connect()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._conn is not None and not self._conn.is_closed():
+            await self._conn.close()
+
+    async def _connect(self):
+        conn = await asyncpg.connect(DATABASE_URL)
+        try:
+            await conn.add_listener(RESTORE_CHANNEL, self._notified)
+        except BaseException:
+            await conn.close()
+            raise
+        self._lost.clear()
+        conn.add_termination_listener(lambda _conn: self._lost.set())
+        self._conn = conn
+
+    def _notified(self, _conn, _pid, _channel, payload):
+        guild_ids = json.loads(payload)
+        forget_economy(guild_ids)
+        scope = "всех гильдий" if guild_ids is None else f"гильдий: {len(guild_ids)}"
+        print(f"♻ Загружен снимок экономики, кэши сброшены для {scope}")
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._lost.wait(), self.CHECK_INTERVAL)
+            except asyncio.TimeoutError:
+                # Обрыв без закрытия сокета сам не обнаружится: проверяем соединение запросом
+                try:
+                    await self._conn.execute("SELECT 1", timeout=self.CHECK_TIMEOUT)
+                except Exception:
+                    self._conn.terminate()
+                continue
+
+            print("⚠ Соединение для уведомлений о снимках потеряно, переподключаюсь")
+            backoff = 1
+            while True:
+                try:
+                    await self._connect()
+                    break
+                except Exception as e:
+                    print(f"⚠ Не удалось переподключиться ({e}), повтор через {backoff} с")
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, self.MAX_BACKOFF)
+            forget_economy(None)
+            print("♻ Уведомления о снимках снова доступны, кэши экономики сброшены")
 
 async def close_db():
+    if hasattr(bot, 'restore_listener'):
+        await bot.restore_listener.stop()
     if hasattr(bot, 'db') and not bot.db.is_closed():
+        if bot.balance_cache:
+            # Перед закрытием пула сбрасываем отложенные изменения балансов
+            cache, bot.balance_cache = bot.balance_cache, None
+            await cache.close()
+        try:
+            await bot.ledger.close()
+        except Exception as e:
+            print(f"⚠ Ошибка записи журнала операций: {e}")
         await bot.db.close()
         print("✅ Соединение с базой данных закрыто")
 
-@bot.event
-async def on_disconnect():
-    await close_db()
+async def main():
+    # docker stop и systemd шлют SIGTERM: закрываем бота так же, как при Ctrl+C,
+    # чтобы finally ниже сбросил кэш балансов, журнал операций и активность
+    stopping = []
+    try:
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGTERM, lambda: stopping.append(asyncio.ensure_future(bot.close())))
+    except NotImplementedError:
+        pass  # Windows: обработчиков сигналов в цикле событий нет
+    try:
+        async with bot:
+            await bot.start(TOKEN)
+    finally:
+        if hasattr(bot, 'health_server'):
+            bot.health_server.close()
+        if hasattr(bot, 'mute_scheduler'):
+            await bot.mute_scheduler.stop()
+        await bot.cooldowns.stop()
+        if hasattr(bot, 'activity') and hasattr(bot, 'db') and not bot.db.is_closed():
+            # Активность пишется через кэш балансов, поэтому сбрасывается раньше него
+            try:
+                await bot.activity.close()
+            except Exception as e:
+                print(f"⚠ Ошибка сброса активности: {e}")
+        await close_db()
 
 def run_bot():
     try:
-        asyncio.run(bot.start(TOKEN))
+        asyncio.run(main())
     except KeyboardInterrupt:
         print("\n🛑 Получен сигнал прерывания, завершаю работу...")
     except Exception as e:
         print(f"❌ Неожиданная ошибка: {e}")
 
-# Добавь в самый конец main.py
-from flask import Flask
-from threading import Thread
-
-app = Flask('')
-
-@app.route('/')
-def home():
-    return "Bot OK"
-
-def run_flask():
-    app.run(host='0.0.0.0', port=8080)
-
-# Запускаем Flask в отдельном потоке
-flask_thread = Thread(target=run_flask)
-flask_thread.daemon = True
-flask_thread.start()
-
 if __name__ == "__main__":
+    # Коги импортируют общие объекты через "import main"; без этого запущенный
+    # скрипт импортировался бы второй раз как отдельный модуль со своим ботом
+    sys.modules["main"] = sys.modules[__name__]
+    check_config()
     run_bot()
@@ -0,0 +1,233 @@
+"""Выгрузка и загрузка экономики (users, clans, user_clans, custom_roles) через COPY.
+
+Данные идут потоком в сжатые gzip файлы и обратно, в памяти держится только
+текущий кусок, поэтому миллионы строк не требуют памяти. Пример:
+
+    python snapshot.py export backup/ --format binary
+    python snapshot.py export backup-guild/ --guild 123456789012345678
+    python snapshot.py import backup/
+
+Выгрузка читает все таблицы в одной транзакции REPEATABLE READ — это
+согласованный срез, бот в это время работает как обычно. Загрузка заменяет
+экономику гильдий из снимка (или всю, если снимок полный) одной транзакцией:
+при ошибке ничего не меняется, а команды затронутых гильдий лишь ждут её
+окончания. Агрегаты кланов после загрузки пересчитываются заново.
+
+Вместе с загрузкой в канал RESTORE_CHANNEL уходит NOTIFY со списком гильдий:
+бот получает его после фиксации транзакции и сбрасывает кэши балансов, профилей
+и лидербордов этих гильдий. Несброшенные к этому моменту изменения балансов
+прибавляются к восстановленным. Оборванное соединение бот восстанавливает сам
+и на всякий случай сбрасывает кэши всех гильдий.
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import sys
+import time
+from datetime import datetime, timezone
+
+import asyncpg
+
+# Колонки перечислены явно: порядок в файлах не зависит от порядка в таблицах
+TABLES = {
+    "users": ["guild_id", "user_id", "balance", "profile_description", "messages"],
+    "clans": ["guild_id", "name", "owner_id", "balance", "member_count", "member_balance"],
+    "user_clans": ["guild_id", "user_id", "clan_name"],
+    "custom_roles": ["guild_id", "user_id", "role_id", "role_name", "role_color"],
+}
+EXTENSIONS = {"csv": "csv.gz", "binary": "bin.gz"}
+MANIFEST = "manifest.json"
+CHUNK_SIZE = 1 << 16
+PROGRESS_INTERVAL = 2
+# Канал, который слушает бот (RESTORE_CHANNEL в main.py)
+RESTORE_CHANNEL = "economy_restored"
+
+
+class Progress:
+    """Печатает объём и скорость не чаще раза в PROGRESS_INTERVAL секунд."""
+
+    def __init__(self, table: str, total: int = None):
+        self.table = table
+        self.total = total
+        self.bytes = 0
+        self.started = time.monotonic()
+        self._printed = self.started
+
+    def add(self, size: int):
+        self.bytes += size
+        now = time.monotonic()
+        if now - self._printed >= PROGRESS_INTERVAL:
+            self._printed = now
+            self.report(now)
+
+    def report(self, now: float, rows: int = None):
+        speed = self.bytes / 2**20 / max(now - self.started, 1e-9)
+        line = f"  {self.table}: {self.bytes / 2**20:.1f} МБ, {speed:.1f} МБ/с"
+        if self.total:
+            line += f", {self.bytes * 100 // self.total}%"
+        if rows is not None:
+            line += f", строк: {rows}"
+        print(line)
+
+    def done(self, rows: int):
+        self.report(time.monotonic(), rows)
+
+
+def copy_rows(status: str) -> int:
+    # asyncpg возвращает статус команды вида "COPY 1234"
+    return int(status.split()[-1])
+
+
+async def schema_version(conn) -> int:
+    return await conn.fetchval("SELECT max(version) FROM schema_migrations")
+
+
+# ==================== ВЫГРУЗКА ====================
+async def export_table(conn, table: str, columns, path: str, fmt: str, guild_id: int = None) -> int:
+    query = f"SELECT {', '.join(columns)} FROM {table}"
+    args = []
+    if guild_id is not None:
+        query += " WHERE guild_id = $1"
+        args.append(guild_id)
+
+    progress = Progress(table)
+    with gzip.open(path, "wb") as f:
+        async def write(chunk):
+            f.write(chunk)
+            progress.add(len(chunk))
+
+        status = await conn.copy_from_query(query, *args, output=write, format=fmt)
+    rows = copy_rows(status)
+    progress.done(rows)
+    return rows
+
+
+async def export_snapshot(args):
+    os.makedirs(args.path, exist_ok=True)
+    conn = await asyncpg.connect(args.dsn)
+    try:
+        manifest = {
+            "schema_version": await schema_version(conn),
+            "format": args.format,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            # None — полный снимок: при загрузке заменяется экономика всех гильдий
+            "guilds": None if args.guild is None else [args.guild],
+            "tables": {},
+        }
+        print(f"📤 Выгрузка в {args.path} ({args.format})")
+        # Один срез на все таблицы: кланы и их участники согласованы между собой
+        async with conn.transaction(isolation="repeatable_read", readonly=True):
+            for table, columns in TABLES.items():
+                file_name = f"{table}.{EXTENSIONS[args.format]}"
+                rows = await export_table(conn, table, columns, os.path.join(args.path, file_name),
+                                          args.format, args.guild)
+                manifest["tables"][table] = {"file": file_name, "columns": columns, "rows": rows}
+    finally:
+        await conn.close()
+
+    # Манифест пишется последним: без него незаконченный снимок не загрузится
+    with open(os.path.join(args.path, MANIFEST), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    total = sum(table["rows"] for table in manifest["tables"].values())
+    print(f"✅ Выгружено строк: {total}")
+
+
+# ==================== ЗАГРУЗКА ====================
+async def read_chunks(path: str, progress: Progress):
+    # Прогресс считается по сжатому файлу: его размер известен заранее
+    with open(path, "rb") as raw, gzip.open(raw, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            progress.add(raw.tell() - progress.bytes)
+            yield chunk
+
+
+async def import_table(conn, table: str, info, path: str, fmt: str) -> int:
+    progress = Progress(table, os.path.getsize(path))
+    status = await conn.copy_to_table(
+        table, source=read_chunks(path, progress), columns=info["columns"], format=fmt
+    )
+    rows = copy_rows(status)
+    if rows != info["rows"]:
+        raise RuntimeError(f"{table}: загружено {rows} строк, в снимке {info['rows']}")
+    progress.done(rows)
+    return rows
+
+
+async def recompute_clan_aggregates(conn, guilds):
+    # Триггеры уже поправили агрегаты по ходу загрузки, но кланы пришли из снимка
+    # со своими значениями: пересчитываем с нуля, чтобы не было двойного учёта
+    await conn.execute("""
+        UPDATE clans c SET member_count = a.member_count, member_balance = a.member_balance
+        FROM (
+            SELECT k.guild_id, k.name, count(uc.user_id) AS member_count,
+                   COALESCE(sum(u.balance), 0) AS member_balance
+            FROM clans k
+            LEFT JOIN user_clans uc ON uc.guild_id = k.guild_id AND uc.clan_name = k.name
+            LEFT JOIN users u ON u.guild_id = uc.guild_id AND u.user_id = uc.user_id
+            WHERE $1::bigint[] IS NULL OR k.guild_id = ANY($1)
+            GROUP BY k.guild_id, k.name
+        ) a
+        WHERE c.guild_id = a.guild_id AND c.name = a.name
+    """, guilds)
+
+
+async def import_snapshot(args):
+    with open(os.path.join(args.path, MANIFEST), encoding="utf-8") as f:
+        manifest = json.load(f)
+    guilds = manifest["guilds"]
+
+    conn = await asyncpg.connect(args.dsn)
+    try:
+        version = await schema_version(conn)
+        if version != manifest["schema_version"]:
+            sys.exit(f"❌ Снимок сделан на схеме версии {manifest['schema_version']}, в БД версия {version}")
+
+        scope = "все гильдии" if guilds is None else f"гильдии {', '.join(map(str, guilds))}"
+        print(f"📥 Загрузка из {args.path} ({manifest['format']}), заменяются {scope}")
+        started = time.monotonic()
+        async with conn.transaction():
+            # Обычный DELETE, а не TRUNCATE: он не блокирует таблицы целиком
+            for table in reversed(list(TABLES)):
+                if guilds is None:
+                    await conn.execute(f"DELETE FROM {table}")
+                else:
+                    await conn.execute(f"DELETE FROM {table} WHERE guild_id = ANY($1)", guilds)
+            total = 0
+            for table in TABLES:
+                info = manifest["tables"][table]
+                total += await import_table(conn, table, info, os.path.join(args.path, info["file"]),
+                                            manifest["format"])
+            await recompute_clan_aggregates(conn, guilds)
+            # NOTIFY доставляется только при фиксации: бот не сбросит кэши раньше времени
+            await conn.execute("SELECT pg_notify($1, $2)", RESTORE_CHANNEL, json.dumps(guilds))
+    finally:
+        await conn.close()
+    print(f"✅ Загружено строк: {total} за {time.monotonic() - started:.1f} с")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Выгрузка и загрузка экономики через COPY")
+    parser.add_argument("--dsn", default=os.getenv("DATABASE_URL"),
+                        help="строка подключения (по умолчанию DATABASE_URL)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export = commands.add_parser("export", help="выгрузить снимок в каталог")
+    export.add_argument("path", help="каталог снимка")
+    export.add_argument("--format", choices=EXTENSIONS, default="csv", help="csv или binary (быстрее)")
+    export.add_argument("--guild", type=int, help="выгрузить только эту гильдию")
+
+    load = commands.add_parser("import", help="загрузить снимок из каталога")
+    load.add_argument("path", help="каталог снимка")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if not args.dsn:
+        sys.exit("❌ Укажите --dsn или DATABASE_URL")
+    if args.command == "export":
+        asyncio.run(export_snapshot(args))
+    else:
+        asyncio.run(import_snapshot(args))
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Тесты импортируют main.py из корня репозитория так же, как его импортируют коги
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,79 @@
+import asyncio
+import random
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import main
+
+
+class FakeStatement:
+    def __init__(self, db, query):
+        self.db = db
+        self.query = query
+
+    async def fetchval(self, guild_id, user_id, amount=None):
+        await self.db.pause()
+        key = (guild_id, user_id)
+        if self.query == "update_balance":
+            self.db.balances[key] = self.db.balances.get(key, 0) + amount
+        return self.db.balances.get(key)
+
+
+class FakePool:
+    """users в памяти; каждый запрос уступает управление случайное число раз."""
+
+    def __init__(self, rng):
+        self.rng = rng
+        self.balances = {}
+
+    async def pause(self):
+        for _ in range(self.rng.randrange(4)):
+            await asyncio.sleep(0)
+
+    @asynccontextmanager
+    async def acquire(self):
+        await self.pause()
+        yield SimpleNamespace(prepared={name: FakeStatement(self, name) for name in ("get_balance", "update_balance")},
+                              fetch=self.fetch)
+
+    async def fetch(self, query, guild_ids, user_ids, deltas):
+        await self.pause()
+        rows = []
+        for key, delta in zip(zip(guild_ids, user_ids), deltas):
+            self.balances[key] = self.balances.get(key, 0) + delta
+            rows.append({"guild_id": key[0], "user_id": key[1], "balance": self.balances[key]})
+        return rows
+
+
+async def run_mutations(seed):
+    rng = random.Random(seed)
+    pool = FakePool(rng)
+    cache = main.BalanceCache(SimpleNamespace(db=pool), max_size=4, flush_interval_ms=1, flush_batch=5)
+    cache.start()
+    expected = 0
+
+    async def worker():
+        nonlocal expected
+        for _ in range(50):
+            user_id = rng.randrange(20)
+            op = rng.randrange(3)
+            if op == 0:
+                amount = rng.randrange(1, 100)
+                await cache.add(1, user_id, amount)
+                expected += amount
+            elif op == 1:
+                taken, _ = await cache.take(1, user_id, rng.randrange(1, 100))
+                expected -= taken
+            else:
+                await cache.transfer(1, user_id, rng.randrange(20), rng.randrange(1, 50))
+
+    await asyncio.gather(*(worker() for _ in range(10)))
+    await cache.close()
+    return pool, expected
+
+
+def test_mutations_survive_eviction():
+    for seed in range(20):
+        pool, expected = asyncio.run(run_mutations(seed))
+        assert sum(pool.balances.values()) == expected, f"seed {seed}"
+        assert all(balance >= 0 for balance in pool.balances.values()), f"seed {seed}"
@@ -0,0 +1,29 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from discord.ext import commands
+
+import main
+
+
+def parse(text):
+    ctx = SimpleNamespace(bot=main.bot, guild=None, command=None, current_parameter=None)
+    return asyncio.run(main.PurgeFlags.convert(ctx, text))
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("да", True), ("Да", True), ("нет", False), ("true", True), ("off", False), ("1", True),
+])
+def test_bots_flag(value, expected):
+    assert parse(f"боты: {value}").bots is expected
+
+
+def test_flags_default():
+    flags = parse("текст: привет за: 5")
+    assert (flags.author, flags.contains, flags.minutes, flags.bots) == (None, "привет", 5, False)
+
+
+def test_bots_flag_rejects_other_words():
+    with pytest.raises(commands.BadFlagArgument):
+        parse("боты: может")